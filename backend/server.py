@@ -1,40 +1,159 @@
-from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Form, Request, Query, Header
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo import monitoring
+from starlette.datastructures import Headers
+from starlette.routing import Match
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timezone, timedelta
+from typing import List, Optional, Dict, Any, AsyncIterator, Awaitable, Callable
+from datetime import date, datetime, timezone, timedelta
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from bisect import bisect_left
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import threading
+import time
+import random
+import base64
+import hashlib
+import mimetypes
+import json
 import os
 import uuid
 import jwt
 import bcrypt
 import logging
 from dotenv import load_dotenv
-import shutil
-from PIL import Image
+import socket
+import csv
+import io
+import zipfile
+from urllib.parse import quote
+from PIL import Image, ImageOps, features
 from PIL.ExifTags import TAGS, GPSTAGS
 import tempfile
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # se usa json de la biblioteca estándar
+    orjson = None
 
 # Configuración
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'memoria_viva')]
-
 # Configuración de uploads
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Almacenamiento por contenido: blobs/ab/cd/<sha256><ext>
+BLOBS_DIR = UPLOAD_DIR / "blobs"
+BLOBS_DIR.mkdir(exist_ok=True)
+BLOBS_BORRADO_LEASE_SEGUNDOS = 60  # un borrado que se cayó a medias deja de bloquear el blob
+BLOBS_BORRADO_ESPERA_SEGUNDOS = 0.05
+
+# Subidas por partes
+PARCIALES_DIR = UPLOAD_DIR / "parciales"
+PARCIALES_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 2 * 1024 ** 3))  # 2 GB
+SUBIDAS_SESIONES_MAX_POR_USUARIO = int(os.environ.get('SUBIDAS_SESIONES_MAX_POR_USUARIO', 20))  # sesiones abiertas
+SUBIDAS_SESION_EXPIRACION_SEGUNDOS = int(os.environ.get('SUBIDAS_SESION_EXPIRACION_SEGUNDOS', 24 * 3600))  # sin recibir partes
+SUBIDAS_LIMPIEZA_SEGUNDOS = 3600  # cada cuánto se borran las sesiones abandonadas y sus .part
+SUBIDAS_FINALIZACION_LEASE_SEGUNDOS = 300  # un finalizar que se cayó a medias se puede repetir pasado este tiempo
+SUBIDAS_ESCRITURA_LEASE_SEGUNDOS = 600  # una parte cuya conexión quedó colgada deja de bloquear la sesión
+
+# Configuración de derivados (miniaturas y tamaños intermedios)
+DERIVADOS_TAMANOS = [256, 1024, 2048]  # lado mayor en píxeles
+DERIVADOS_FORMATO = "WEBP" if features.check("webp") else "JPEG"
+DERIVADOS_CALIDAD = 82
+PROCESS_POOL_WORKERS = int(os.environ.get('PROCESS_POOL_WORKERS', os.cpu_count() or 2))
+
+# Entrega de archivos: "directo" (Python), "accel" (nginx X-Accel-Redirect) o "sendfile" (X-Sendfile)
+ARCHIVOS_MODO_ENVIO = os.environ.get('ARCHIVOS_MODO_ENVIO', 'directo')
+ARCHIVOS_ACCEL_PREFIJO = os.environ.get('ARCHIVOS_ACCEL_PREFIJO', '/protected-uploads')
+ARCHIVOS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Configuración del mapa
+MAPA_CELDAS_POR_TESELA = 4  # celdas por tesela de 256 px en cada eje
+MAPA_MAX_CLUSTERS = 500
+
+# Caché de usuarios y familias
+CACHE_TTL_SEGUNDOS = float(os.environ.get('CACHE_TTL_SEGUNDOS', 60))
+CACHE_MAX_ENTRADAS = int(os.environ.get('CACHE_MAX_ENTRADAS', 10000))
+CACHE_FOTOS_TTL_SEGUNDOS = float(os.environ.get('CACHE_FOTOS_TTL_SEGUNDOS', 3600))
+CACHE_FOTOS_MAX_ENTRADAS = int(os.environ.get('CACHE_FOTOS_MAX_ENTRADAS', 100000))
+
+# Lecturas por lotes
+BATCH_MAX_IDS = 500
+
+# Búsqueda de texto
+BUSQUEDA_IDIOMA = "spanish"  # lematización del índice de texto
+BUSQUEDA_MAX_RESULTADOS = 1000  # el orden por relevancia se calcula en memoria: se acota la paginación
+BUSQUEDA_MAX_ALBUMES = 10
+
+# Detección de fotos casi duplicadas (dHash de 64 bits)
+DUPLICADOS_UMBRAL = int(os.environ.get('DUPLICADOS_UMBRAL', 4))  # bits distintos para considerarlas la misma foto
+DUPLICADOS_UMBRAL_MAX = 6
+DUPLICADOS_MAX_AVISOS = 5  # coincidencias devueltas por foto al subir
+DUPLICADOS_CACHE_TTL_SEGUNDOS = float(os.environ.get('DUPLICADOS_CACHE_TTL_SEGUNDOS', 600))
+DUPLICADOS_MAX_FAMILIAS = int(os.environ.get('DUPLICADOS_MAX_FAMILIAS', 200))  # índices en memoria
+
+# Importación masiva (python server.py importar)
+IMPORTACION_LOTE = 500  # fotos por insert_many y por escritura del checkpoint
+IMPORTACION_CONCURRENCIA = PROCESS_POOL_WORKERS * 2  # fotos en proceso a la vez: el pool nunca se queda sin trabajo
+IMPORTACION_NAMESPACE = uuid.UUID("6f1c4b52-8a0e-4d8b-9c57-3f0b1e2a7d94")  # ids deterministas de las fotos importadas
+
+# Migraciones de datos (colección migraciones)
+MIGRACIONES_LEASE_SEGUNDOS = 3600  # si el proceso que la ejecutaba se cayó, otro la reintenta pasado este tiempo
+
 # JWT Configuration  
 JWT_SECRET = os.environ.get('JWT_SECRET', 'memoria-viva-secret-key-2024')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 días
+TOKEN_URL_EXPIRACION_SEGUNDOS = 60  # tokens de ?token= para un solo recurso (acaban en logs e historial)
+
+# bcrypt
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 4))
+
+# Eventos en tiempo real (SSE)
+EVENTOS_HISTORIAL = 500  # eventos recientes por familia para reanudar con Last-Event-ID
+EVENTOS_COLA_MAX = 100  # eventos pendientes por cliente antes de cortar su conexión
+EVENTOS_KEEPALIVE_SEGUNDOS = 15
+EVENTOS_REINTENTO_MS = 3000
+
+# Cola de trabajos en segundo plano (colección trabajos)
+TRABAJOS_WORKERS = int(os.environ.get('TRABAJOS_WORKERS', 4))  # por proceso; 0 = solo con «python server.py trabajador»
+TRABAJOS_LEASE_SEGUNDOS = 120  # sin renovar el lease, otro trabajador puede reclamar el trabajo
+TRABAJOS_MAX_INTENTOS = 5
+TRABAJOS_REINTENTO_BASE_SEGUNDOS = 5  # espera exponencial entre intentos: 5, 10, 20, 40... s
+TRABAJOS_REINTENTO_MAX_SEGUNDOS = 3600
+TRABAJOS_SONDEO_SEGUNDOS = 2.0  # espera sin trabajos, si no los encola este mismo proceso
+TRABAJOS_RETENCION_SEGUNDOS = 7 * 24 * 3600  # los terminados se borran pasado este tiempo
+TRABAJOS_MAX_POR_FAMILIA = int(os.environ.get('TRABAJOS_MAX_POR_FAMILIA', 2))  # por proceso: una familia no acapara la cola
+
+# Control de admisión de subidas (por proceso)
+SUBIDAS_MAX_CONCURRENTES = int(os.environ.get('SUBIDAS_MAX_CONCURRENTES', 16))
+SUBIDAS_MAX_POR_FAMILIA = int(os.environ.get('SUBIDAS_MAX_POR_FAMILIA', 4))
+SUBIDAS_MAX_EN_ESPERA = int(os.environ.get('SUBIDAS_MAX_EN_ESPERA', 64))  # con la cola llena se responde 429
+SUBIDAS_MAX_EN_ESPERA_POR_FAMILIA = int(os.environ.get('SUBIDAS_MAX_EN_ESPERA_POR_FAMILIA', 16))
+SUBIDAS_ESPERA_MAX_SEGUNDOS = float(os.environ.get('SUBIDAS_ESPERA_MAX_SEGUNDOS', 30))
+SUBIDAS_REINTENTO_SEGUNDOS = 10  # Retry-After de las respuestas 429
+
+# Métricas
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PETICION_LENTA_SEGUNDOS = float(os.environ.get('PETICION_LENTA_SEGUNDOS', 2.0))
+PETICION_LENTA_MUESTREO = float(os.environ.get('PETICION_LENTA_MUESTREO', 1.0))  # fracción que se registra en el log
 
 # FastAPI app
 app = FastAPI(
@@ -43,7 +162,376 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# CORS
+# Security
+security = HTTPBearer()
+security_opcional = HTTPBearer(auto_error=False)
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Métricas en formato de exposición de Prometheus
+def formatear_etiquetas(nombres: tuple, valores: tuple) -> str:
+    escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{nombre}="{escapar(valor)}"' for nombre, valor in zip(nombres, valores))
+
+class Histograma:
+    """Histograma por etiquetas; seguro entre hilos (pymongo notifica desde sus propios hilos)"""
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple, buckets: tuple = METRICAS_BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}  # {valores: [cuentas por bucket, suma, total]}
+        self._lock = threading.Lock()
+    
+    def observar(self, valor: float, *etiquetas: str):
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            indice = bisect_left(self.buckets, valor)
+            if indice < len(self.buckets):
+                serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+    
+    def exponer(self) -> List[str]:
+        with self._lock:
+            series = [(etiquetas, list(cuentas), suma, total) for etiquetas, (cuentas, suma, total) in self._series.items()]
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for etiquetas, cuentas, suma, total in sorted(series):
+            base = formatear_etiquetas(self.etiquetas, etiquetas)
+            separador = "," if base else ""
+            acumulado = 0
+            for limite, cuenta in zip(self.buckets, cuentas):
+                acumulado += cuenta
+                lineas.append(f'{self.nombre}_bucket{{{base}{separador}le="{limite}"}} {acumulado}')
+            lineas.append(f'{self.nombre}_bucket{{{base}{separador}le="+Inf"}} {total}')
+            lineas.append(f"{self.nombre}_sum{{{base}}} {suma}")
+            lineas.append(f"{self.nombre}_count{{{base}}} {total}")
+        return lineas
+
+class Medidor:
+    """Gauge o contador por etiquetas"""
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple, tipo: str = "gauge"):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.tipo = tipo
+        self._valores: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *etiquetas: str, valor: float = 1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+    
+    def dec(self, *etiquetas: str):
+        self.inc(*etiquetas, valor=-1)
+    
+    def set(self, valor: float, *etiquetas: str):
+        with self._lock:
+            self._valores[etiquetas] = valor
+    
+    def exponer(self) -> List[str]:
+        with self._lock:
+            valores = sorted(self._valores.items())
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        for etiquetas, valor in valores:
+            base = f"{{{formatear_etiquetas(self.etiquetas, etiquetas)}}}" if self.etiquetas else ""
+            lineas.append(f"{self.nombre}{base} {valor}")
+        return lineas
+
+latencia_peticiones = Histograma(
+    "memoria_viva_http_peticion_segundos", "Duración de las peticiones HTTP", ("metodo", "ruta", "estado")
+)
+peticiones_en_curso = Medidor(
+    "memoria_viva_http_peticiones_en_curso", "Peticiones HTTP en curso", ("metodo", "ruta")
+)
+peticiones_lentas = Medidor(
+    "memoria_viva_http_peticiones_lentas_total", "Peticiones más lentas que PETICION_LENTA_SEGUNDOS",
+    ("metodo", "ruta"), tipo="counter"
+)
+latencia_mongo = Histograma(
+    "memoria_viva_mongo_comando_segundos", "Duración de los comandos de MongoDB", ("comando", "estado")
+)
+latencia_etapas_subida = Histograma(
+    "memoria_viva_subida_etapa_segundos", "Duración de cada etapa de una subida", ("etapa",)
+)
+clientes_eventos_lentos = Medidor(
+    "memoria_viva_eventos_clientes_lentos_total", "Conexiones de eventos cortadas por no leer a tiempo",
+    (), tipo="counter"
+)
+latencia_trabajos = Histograma(
+    "memoria_viva_trabajo_segundos", "Duración de cada intento de un trabajo en segundo plano", ("tipo",)
+)
+trabajos_terminados = Medidor(
+    "memoria_viva_trabajos_total", "Intentos de trabajos en segundo plano por resultado", ("tipo", "resultado"),
+    tipo="counter"
+)
+trabajos_pendientes = Medidor(
+    "memoria_viva_trabajos_pendientes", "Trabajos en cola sin empezar (incluye reintentos programados)", ()
+)
+admision_en_espera = Medidor(
+    "memoria_viva_admision_en_espera", "Peticiones esperando turno en el control de admisión", ("limite",)
+)
+admision_en_curso = Medidor(
+    "memoria_viva_admision_en_curso", "Peticiones admitidas en curso", ("limite",)
+)
+admision_rechazos = Medidor(
+    "memoria_viva_admision_rechazos_total", "Peticiones rechazadas con 429 por el control de admisión",
+    ("limite", "motivo"), tipo="counter"
+)
+latencia_admision = Histograma(
+    "memoria_viva_admision_espera_segundos", "Tiempo esperando turno en el control de admisión", ("limite",)
+)
+bcrypt_en_cola = Medidor(
+    "memoria_viva_bcrypt_en_cola", "Hashes de contraseña esperando un hilo del pool de bcrypt", ()
+)
+bcrypt_en_curso = Medidor(
+    "memoria_viva_bcrypt_en_curso", "Hashes de contraseña calculándose en el pool de bcrypt", ()
+)
+METRICAS = [
+    latencia_peticiones, peticiones_en_curso, peticiones_lentas, latencia_mongo, latencia_etapas_subida,
+    clientes_eventos_lentos, latencia_trabajos, trabajos_terminados, trabajos_pendientes,
+    admision_en_espera, admision_en_curso, admision_rechazos, latencia_admision, bcrypt_en_cola, bcrypt_en_curso
+]
+
+# Desglose por etapas de la petición en curso (para el log de peticiones lentas)
+etapas_peticion: ContextVar[Optional[Dict[str, float]]] = ContextVar("etapas_peticion", default=None)
+inicio_peticion: ContextVar[Optional[float]] = ContextVar("inicio_peticion", default=None)
+
+def registrar_etapa(etapa: str, segundos: float):
+    latencia_etapas_subida.observar(segundos, etapa)
+    etapas = etapas_peticion.get()
+    if etapas is not None:
+        # Las fotos de una subida se procesan en paralelo: se acumula por etapa
+        etapas[etapa] = etapas.get(etapa, 0.0) + segundos
+
+@contextmanager
+def medir_etapa(etapa: str):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_etapa(etapa, time.perf_counter() - inicio)
+
+async def medir_stream(chunks: AsyncIterator[bytes], etapa: str) -> AsyncIterator[bytes]:
+    """Mide el tiempo esperando cada parte del flujo (sin contar el de quien lo consume)"""
+    esperado = 0.0
+    inicio = time.perf_counter()
+    try:
+        async for chunk in chunks:
+            esperado += time.perf_counter() - inicio
+            yield chunk
+            inicio = time.perf_counter()
+        esperado += time.perf_counter() - inicio
+    finally:
+        registrar_etapa(etapa, esperado)
+
+class MonitorComandosMongo(monitoring.CommandListener):
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        latencia_mongo.observar(event.duration_micros / 1e6, event.command_name, "ok")
+    
+    def failed(self, event):
+        latencia_mongo.observar(event.duration_micros / 1e6, event.command_name, "error")
+
+def plantilla_ruta(scope: Dict[str, Any]) -> str:
+    """Plantilla de la ruta (/api/fotos/{foto_id}) para no crear una serie por cada id"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "sin_ruta"
+
+# Conexiones que duran lo que el cliente quiera: no cuentan como peticiones lentas
+RUTAS_CONEXION_LARGA = {"/api/eventos", "/api/albumes/{album_id}/export", "/api/familia/export"}
+
+class MiddlewareMetricas:
+    """Middleware ASGI: latencia y peticiones en curso por ruta, y log de las peticiones lentas"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        metodo = scope["method"]
+        ruta = plantilla_ruta(scope)
+        estado = {"codigo": 500}
+        
+        async def enviar(message):
+            if message["type"] == "http.response.start":
+                estado["codigo"] = message["status"]
+            await send(message)
+        
+        etapas = {}
+        token_etapas = etapas_peticion.set(etapas)
+        inicio = time.perf_counter()
+        token_inicio = inicio_peticion.set(inicio)
+        peticiones_en_curso.inc(metodo, ruta)
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            duracion = time.perf_counter() - inicio
+            peticiones_en_curso.dec(metodo, ruta)
+            etapas_peticion.reset(token_etapas)
+            inicio_peticion.reset(token_inicio)
+            latencia_peticiones.observar(duracion, metodo, ruta, str(estado["codigo"]))
+            if duracion >= PETICION_LENTA_SEGUNDOS and ruta not in RUTAS_CONEXION_LARGA:
+                peticiones_lentas.inc(metodo, ruta)
+                if random.random() < PETICION_LENTA_MUESTREO:
+                    desglose = ", ".join(f"{etapa}={segundos:.3f}s" for etapa, segundos in etapas.items())
+                    logger.warning(
+                        f"Petición lenta: {metodo} {scope['path']} -> {estado['codigo']} "
+                        f"en {duracion:.3f}s [{desglose or 'sin etapas'}]"
+                    )
+
+# Control de admisión: semáforos global y por familia con una cola de espera acotada
+class AdmisionRechazada(Exception):
+    pass
+
+class ControlAdmision:
+    """Limita las peticiones simultáneas en total y por familia; lo que no cabe en la cola se rechaza"""
+    def __init__(
+        self,
+        nombre: str,
+        max_global: int,
+        max_familia: int,
+        max_en_espera: int,
+        max_en_espera_familia: int,
+        espera_max: float
+    ):
+        self.nombre = nombre
+        self.max_familia = max_familia
+        self.max_en_espera = max_en_espera
+        self.max_en_espera_familia = max_en_espera_familia
+        self.espera_max = espera_max
+        self._global = asyncio.Semaphore(max_global)
+        self._familias: Dict[str, Dict[str, Any]] = {}  # {familia_id: {semaforo, usuarios, en_espera}}
+        self._en_espera = 0
+    
+    def _rechazar(self, motivo: str):
+        admision_rechazos.inc(self.nombre, motivo)
+        raise AdmisionRechazada(motivo)
+    
+    async def _adquirir(self, familia: Dict[str, Any], adquiridos: list):
+        # Primero el de la familia: quien espera a su propia familia no ocupa un hueco global
+        await familia["semaforo"].acquire()
+        adquiridos.append(familia["semaforo"])
+        await self._global.acquire()
+        adquiridos.append(self._global)
+    
+    @asynccontextmanager
+    async def admitir(self, familia_id: str):
+        familia = self._familias.get(familia_id)
+        if familia is None:
+            familia = self._familias[familia_id] = {
+                "semaforo": asyncio.Semaphore(self.max_familia), "usuarios": 0, "en_espera": 0
+            }
+        familia["usuarios"] += 1
+        adquiridos = []
+        try:
+            if not familia["semaforo"].locked() and not self._global.locked():
+                # Hay hueco: acquire() no cede el control, así que no se pasa por la cola
+                await self._adquirir(familia, adquiridos)
+            else:
+                if self._en_espera >= self.max_en_espera or familia["en_espera"] >= self.max_en_espera_familia:
+                    self._rechazar("cola_llena")
+                self._en_espera += 1
+                familia["en_espera"] += 1
+                admision_en_espera.inc(self.nombre)
+                inicio = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self._adquirir(familia, adquiridos), self.espera_max)
+                except asyncio.TimeoutError:
+                    self._rechazar("espera_agotada")
+                finally:
+                    self._en_espera -= 1
+                    familia["en_espera"] -= 1
+                    admision_en_espera.dec(self.nombre)
+                    latencia_admision.observar(time.perf_counter() - inicio, self.nombre)
+            
+            admision_en_curso.inc(self.nombre)
+            try:
+                yield
+            finally:
+                admision_en_curso.dec(self.nombre)
+        finally:
+            for semaforo in adquiridos:
+                semaforo.release()
+            familia["usuarios"] -= 1
+            if familia["usuarios"] == 0:
+                del self._familias[familia_id]
+
+admision_subidas = ControlAdmision(
+    "subidas",
+    SUBIDAS_MAX_CONCURRENTES,
+    SUBIDAS_MAX_POR_FAMILIA,
+    SUBIDAS_MAX_EN_ESPERA,
+    SUBIDAS_MAX_EN_ESPERA_POR_FAMILIA,
+    SUBIDAS_ESPERA_MAX_SEGUNDOS
+)
+
+RUTAS_SUBIDA = {
+    ("POST", "/api/fotos/upload"),
+    ("PUT", "/api/fotos/upload/sesiones/{sesion_id}"),
+    ("POST", "/api/fotos/upload/sesiones/{sesion_id}/finalizar"),
+}
+
+async def familia_de_peticion(scope: Dict[str, Any]) -> Optional[str]:
+    esquema, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+    if esquema.lower() != "bearer" or not token:
+        return None
+    try:
+        usuario = await get_current_user(HTTPAuthorizationCredentials(scheme=esquema, credentials=token))
+    except HTTPException:
+        return None
+    return usuario.familia_id
+
+class MiddlewareAdmision:
+    """Middleware ASGI: las subidas esperan turno antes de leer el cuerpo, que FastAPI lee antes del endpoint"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], plantilla_ruta(scope)) not in RUTAS_SUBIDA:
+            await self.app(scope, receive, send)
+            return
+        
+        llegada = time.perf_counter()
+        familia_id = await familia_de_peticion(scope)
+        if familia_id is None:
+            # Sin credenciales válidas: el endpoint responde 401
+            await self.app(scope, receive, send)
+            return
+        
+        try:
+            async with admision_subidas.admitir(familia_id):
+                admitida = time.perf_counter()
+                registrar_etapa("admision", admitida - llegada)
+                # La espera en cola no es recepción: las etapas del endpoint cuentan desde aquí
+                token_inicio = inicio_peticion.set(admitida)
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    inicio_peticion.reset(token_inicio)
+        except AdmisionRechazada:
+            registrar_etapa("admision", time.perf_counter() - llegada)
+            respuesta = RespuestaJSON(
+                {"detail": f"Hay demasiadas subidas en curso; vuelve a intentarlo en {SUBIDAS_REINTENTO_SEGUNDOS} segundos"},
+                status_code=429,
+                headers={"Retry-After": str(SUBIDAS_REINTENTO_SEGUNDOS)}
+            )
+            await respuesta(scope, receive, send)
+
+# De dentro hacia fuera: admisión, métricas y CORS (así los 429 se miden y llevan cabeceras CORS)
+app.add_middleware(MiddlewareAdmision)
+app.add_middleware(MiddlewareMetricas)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
@@ -52,12 +540,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Security
-security = HTTPBearer()
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MonitorComandosMongo()])
+db = client[os.environ.get('DB_NAME', 'memoria_viva')]
 
-# Logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Respuestas JSON
+class RespuestaJSON(JSONResponse):
+    """JSON sin pasar por jsonable_encoder ni modelos Pydantic.
+
+    Para documentos que ya vienen de Mongo con una proyección que quita _id y
+    campos sensibles: se codifican directamente (orjson si está instalado).
+    """
+    def render(self, content: Any) -> bytes:
+        return serializar_json(content)
+
+def serializar_json(contenido: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(contenido, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        contenido, default=_json_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+def _json_default(valor: Any) -> Any:
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+# Proyecciones de Mongo para respuestas
+SIN_ID = {"_id": 0}
+PROYECCION_USUARIO = {"_id": 0, "password": 0}
+PROYECCION_FOTO = {"_id": 0, "texto_busqueda": 0, "dhash": 0}
 
 # Models
 class User(BaseModel):
@@ -83,6 +596,9 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class TokenUrlCreate(BaseModel):
+    alcance: str = Field(..., pattern="^(eventos|export_familia|export_album:[0-9a-f-]+)$")  # recurso para el que vale el token
+
 class Familia(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     nombre: str
@@ -109,6 +625,7 @@ class Foto(BaseModel):
     archivo_url: str
     miniatura_url: Optional[str] = None
     album_id: str
+    familia_id: Optional[str] = None  # copia de album.familia_id para consultas sin $lookup
     subida_por: str
     fecha_subida: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     fecha_captura: Optional[datetime] = None
@@ -118,6 +635,14 @@ class Foto(BaseModel):
     descripcion: Optional[str] = None
     anecdota: Optional[str] = None
     metadata: Dict[str, Any] = Field(default_factory=dict)
+    derivados: Dict[str, str] = Field(default_factory=dict)  # {tamaño: url}
+    sha256: Optional[str] = None  # blob en el almacén por contenido
+    total_comentarios: int = 0
+    reacciones: Dict[str, int] = Field(default_factory=dict)  # {tipo: total}
+    texto_busqueda: Optional[str] = None  # álbum y año de captura, solo para el índice de texto
+    dia_captura: Optional[str] = None  # "MM-DD" de fecha_captura, para "en este día"
+    dhash: Optional[int] = None  # hash perceptual (int64 con signo), para detectar casi duplicados
+    estado_procesamiento: str = "lista"  # pendiente (metadatos y derivados en la cola de trabajos), lista
 
 class FotoCreate(BaseModel):
     album_id: str
@@ -135,47 +660,227 @@ class Comentario(BaseModel):
     fecha_creacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     editado: bool = False
 
+class IdsBatch(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=BATCH_MAX_IDS)
+
+TIPOS_REACCION = {"like", "love", "laugh", "wow", "sad"}
+
 class Reaccion(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     foto_id: str
     usuario_id: str
-    tipo: str  # like, love, laugh, wow, sad
+    tipo: str  # ver TIPOS_REACCION
+    fecha_creacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class SubidaCreate(BaseModel):
+    album_id: str
+    nombre_archivo: str
+    content_type: str
+    tamano_total: int
+    descripcion: Optional[str] = None
+    lugar_nombre: Optional[str] = None
+
+class SubidaSesion(SubidaCreate):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    usuario_id: str
+    recibido: int = 0
+    escritor: Optional[str] = None  # petición que está escribiendo la parte en curso
+    escribiendo_hasta: Optional[datetime] = None
+    finalizando_hasta: Optional[datetime] = None
     fecha_creacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    fecha_actualizacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+# Caché en memoria con expiración (LRU + TTL)
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._datos: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def get(self, clave: str) -> Any:
+        entrada = self._datos.get(clave)
+        if entrada is None or entrada[0] < time.monotonic():
+            if entrada is not None:
+                del self._datos[clave]
+            self.misses += 1
+            return None
+        self._datos.move_to_end(clave)
+        self.hits += 1
+        return entrada[1]
+    
+    def set(self, clave: str, valor: Any):
+        self._datos[clave] = (time.monotonic() + self.ttl, valor)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.maxsize:
+            self._datos.popitem(last=False)
+    
+    def invalidate(self, clave: str):
+        self._datos.pop(clave, None)
+    
+    def clear(self):
+        self._datos.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._datos), "hits": self.hits, "misses": self.misses}
+
+usuarios_cache = TTLCache(maxsize=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS)
+familias_cache = TTLCache(maxsize=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS)
+
+def invalidar_usuario(user_id: str):
+    """Llamar tras cualquier cambio en el usuario (login, rol, desactivación)"""
+    usuarios_cache.invalidate(user_id)
+
+def invalidar_familia(familia_id: str):
+    familias_cache.invalidate(familia_id)
+
+async def get_familia_doc(familia_id: str) -> Optional[Dict[str, Any]]:
+    """Obtener el documento de una familia (sin _id), usando la caché"""
+    familia = familias_cache.get(familia_id)
+    if familia is None:
+        familia = await db.familias.find_one({"id": familia_id}, {"_id": 0})
+        if familia is None:
+            return None
+        familias_cache.set(familia_id, familia)
+    # Copia para que los handlers puedan modificarla sin alterar la caché
+    return dict(familia)
 
 # Utilidades de autenticación
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+def necesita_rehash(hashed: str) -> bool:
+    # Formato bcrypt: $2b$<coste>$<salt+hash>
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+# bcrypt tarda cientos de ms por llamada: se ejecuta en un pool de hilos acotado
+# (bcrypt libera el GIL) para no bloquear el event loop
+_bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+bcrypt_stats = {"en_cola": 0, "en_curso": 0}
+_bcrypt_stats_lock = threading.Lock()
+
+async def _ejecutar_bcrypt(func, *args):
+    loop = asyncio.get_running_loop()
+    with _bcrypt_stats_lock:
+        bcrypt_stats["en_cola"] += 1
+    
+    def tarea():
+        with _bcrypt_stats_lock:
+            bcrypt_stats["en_cola"] -= 1
+            bcrypt_stats["en_curso"] += 1
+        try:
+            return func(*args)
+        finally:
+            with _bcrypt_stats_lock:
+                bcrypt_stats["en_curso"] -= 1
+    
+    return await loop.run_in_executor(_bcrypt_executor, tarea)
+
+async def hash_password_async(password: str) -> str:
+    return await _ejecutar_bcrypt(hash_password, password)
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    return await _ejecutar_bcrypt(verify_password, password, hashed)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def create_url_token(user_id: str, alcance: str) -> str:
+    """Token de corta duración para un único recurso, para URLs que no pueden llevar cabeceras"""
+    expire = datetime.now(timezone.utc) + timedelta(seconds=TOKEN_URL_EXPIRACION_SEGUNDOS)
+    return jwt.encode(
+        {"sub": user_id, "tipo": "url", "alcance": alcance, "exp": expire}, JWT_SECRET, algorithm=JWT_ALGORITHM
+    )
+
 def decode_access_token(token: str):
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = decode_access_token(token)
+    if payload.get("tipo") is not None:
+        # Un token de URL solo sirve para su recurso, nunca como sesión
+        raise HTTPException(status_code=401, detail="Token inválido")
+    return await usuario_de_payload(payload)
+
+async def usuario_de_payload(payload: Dict[str, Any]) -> User:
     user_id = payload.get("sub")
     if user_id is None:
         raise HTTPException(status_code=401, detail="Token inválido")
     
-    user = await db.usuarios.find_one({"id": user_id})
+    user = usuarios_cache.get(user_id)
     if user is None:
-        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+        user_doc = await db.usuarios.find_one({"id": user_id})
+        if user_doc is None:
+            raise HTTPException(status_code=401, detail="Usuario no encontrado")
+        user = User(**user_doc)
+        usuarios_cache.set(user_id, user)
     
-    return User(**user)
+    return user
+
+def get_current_user_url(alcance: str):
+    """Dependencia como get_current_user que también acepta ?token= (EventSource y las
+    descargas directas del navegador no pueden enviar la cabecera Authorization)
+
+    En la URL solo vale un token de /api/auth/token-url emitido para este recurso;
+    el alcance puede usar parámetros de la ruta, p. ej. "export_album:{album_id}".
+    """
+    async def dependencia(
+        request: Request,
+        token: Optional[str] = None,
+        credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional)
+    ) -> User:
+        if credentials is not None:
+            return await get_current_user(credentials)
+        if not token:
+            raise HTTPException(status_code=401, detail="No autenticado")
+        payload = decode_access_token(token)
+        if payload.get("tipo") != "url" or payload.get("alcance") != alcance.format(**request.path_params):
+            raise HTTPException(status_code=401, detail="Token no válido para este recurso")
+        return await usuario_de_payload(payload)
+    return dependencia
+
+# Acceso a fotos: la familia de una foto no cambia tras subirla, así que se puede cachear
+fotos_familia_cache = TTLCache(maxsize=CACHE_FOTOS_MAX_ENTRADAS, ttl=CACHE_FOTOS_TTL_SEGUNDOS)
+
+async def get_foto_autorizada(foto_id: str, current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """Dependencia: obtener una foto de la familia del usuario en una sola consulta"""
+    foto = await db.fotos.find_one({"id": foto_id}, PROYECCION_FOTO)
+    if not foto:
+        raise HTTPException(status_code=404, detail="Foto no encontrada")
+    fotos_familia_cache.set(foto_id, foto.get("familia_id"))
+    if foto.get("familia_id") != current_user.familia_id:
+        raise HTTPException(status_code=403, detail="Sin acceso a esta foto")
+    return foto
+
+async def verificar_acceso_foto(foto_id: str, current_user: User = Depends(get_current_user)) -> User:
+    """Dependencia: comprobar que la foto es de la familia del usuario (sin leer el documento)"""
+    familia_id = fotos_familia_cache.get(foto_id)
+    if familia_id is None:
+        foto = await db.fotos.find_one({"id": foto_id}, {"_id": 0, "familia_id": 1})
+        if not foto:
+            raise HTTPException(status_code=404, detail="Foto no encontrada")
+        familia_id = foto.get("familia_id")
+        fotos_familia_cache.set(foto_id, familia_id)
+    if familia_id != current_user.familia_id:
+        raise HTTPException(status_code=403, detail="Sin acceso")
+    return current_user
 
 # Extracción de metadatos de fotos
 class PhotoMetadataExtractor:
@@ -256,6 +961,231 @@ class PhotoMetadataExtractor:
             
         return decimal
 
+# Procesamiento de fotos en el pool de procesos
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS)
+    return _process_pool
+
+def extraer_metadatos(image_path: str) -> Dict[str, Any]:
+    """Extrae metadatos EXIF (se ejecuta en el pool de procesos)"""
+    return PhotoMetadataExtractor().extract_metadata(image_path)
+
+async def leer_metadatos(file_path: Path) -> Dict[str, Any]:
+    """Extrae metadatos sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    with medir_etapa("metadatos"):
+        return await loop.run_in_executor(get_process_pool(), extraer_metadatos, str(file_path))
+
+def generar_derivados(image_path: str) -> Dict[str, str]:
+    """Genera versiones reducidas de una imagen junto a ella (se ejecuta en el pool de procesos)"""
+    origen = Path(image_path)
+    extension = ".webp" if DERIVADOS_FORMATO == "WEBP" else ".jpg"
+    
+    with Image.open(image_path) as original:
+        # Solo lee la cabecera; la orientación EXIF no cambia el lado mayor
+        lado_mayor = max(original.size)
+        # No ampliar: solo se genera la miniatura más pequeña si la foto es menor
+        tamanos = [
+            tamano for tamano in sorted(DERIVADOS_TAMANOS, reverse=True)
+            if tamano <= lado_mayor or tamano == min(DERIVADOS_TAMANOS)
+        ]
+        destinos = {tamano: origen.parent / f"{origen.stem}_{tamano}{extension}" for tamano in tamanos}
+        
+        # El blob es inmutable: si ya están todos sus derivados se reutilizan
+        if not all(destino.exists() for destino in destinos.values()):
+            # Aplicar orientación EXIF antes de redimensionar
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            if DERIVADOS_FORMATO == "JPEG" and image.mode == "RGBA":
+                image = image.convert("RGB")
+            
+            for tamano, destino in destinos.items():
+                copia = image.copy()
+                copia.thumbnail((tamano, tamano), Image.LANCZOS)
+                # Escribir aparte y renombrar: un proceso que se cae a medias (o que genera
+                # los mismos derivados a la vez) nunca deja una miniatura truncada
+                temporal = destino.with_name(f".{destino.name}.{uuid.uuid4().hex}.tmp")
+                try:
+                    copia.save(temporal, DERIVADOS_FORMATO, quality=DERIVADOS_CALIDAD)
+                    os.replace(temporal, destino)
+                finally:
+                    temporal.unlink(missing_ok=True)
+                # Reducir desde el derivado anterior es más barato que desde el original
+                image = copia
+    return {str(tamano): destino.relative_to(UPLOAD_DIR).as_posix() for tamano, destino in destinos.items()}
+
+async def crear_derivados(file_path: Path) -> Dict[str, str]:
+    """Genera los derivados sin bloquear el event loop y devuelve sus URLs"""
+    loop = asyncio.get_running_loop()
+    try:
+        with medir_etapa("derivados"):
+            nombres = await loop.run_in_executor(get_process_pool(), generar_derivados, str(file_path))
+    except Exception as e:
+        logger.error(f"Error generando derivados de {file_path.name}: {str(e)}")
+        return {}
+    return {tamano: f"/api/fotos/files/{nombre}" for tamano, nombre in nombres.items()}
+
+def eliminar_derivados(file_path: Path):
+    # También los temporales que dejó un proceso caído a mitad de generar_derivados
+    for patron in (f"{file_path.stem}_*", f".{file_path.stem}_*.tmp"):
+        for derivado in file_path.parent.glob(patron):
+            derivado.unlink(missing_ok=True)
+
+# Hash perceptual (dHash): resiste cambios de tamaño y recompresiones, a diferencia del sha256
+def calcular_dhash(image_path: str) -> int:
+    """dHash de 64 bits como int64 con signo, el entero que admite BSON (se ejecuta en el pool de procesos)"""
+    with Image.open(image_path) as original:
+        # En JPEG decodifica directamente a escala reducida: basta con 9x8 píxeles
+        original.draft("L", (64, 64))
+        image = ImageOps.exif_transpose(original).convert("L").resize((9, 8), Image.LANCZOS)
+    pixeles = np.asarray(image, dtype=np.int16)
+    bits = pixeles[:, 1:] > pixeles[:, :-1]
+    return int(np.packbits(bits).view(">i8")[0])
+
+async def leer_dhash(file_path: Path) -> Optional[int]:
+    """Calcula el hash perceptual sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        with medir_etapa("hash_perceptual"):
+            return await loop.run_in_executor(get_process_pool(), calcular_dhash, str(file_path))
+    except Exception as e:
+        logger.error(f"Error calculando el hash perceptual de {file_path.name}: {str(e)}")
+        return None
+
+def a_uint64(dhash: int) -> np.uint64:
+    return np.uint64(dhash & 0xFFFFFFFFFFFFFFFF)
+
+class IndiceHashes:
+    """Hashes perceptuales de una familia en un array contiguo de uint64, comparados con XOR y popcount"""
+    def __init__(self, ids: List[str], hashes: List[int]):
+        self.ids = list(ids)
+        self.total = len(self.ids)
+        self._hashes = np.array(hashes, dtype=np.int64).view(np.uint64)
+        self._grupos: Dict[int, List[List[str]]] = {}  # por umbral, hasta la próxima foto
+
+    def agregar(self, foto_id: str, dhash: int):
+        if self.total == len(self._hashes):
+            # Crecimiento geométrico: añadir fotos de una en una no copia el array cada vez
+            ampliado = np.zeros(max(16, 2 * len(self._hashes)), dtype=np.uint64)
+            ampliado[:self.total] = self._hashes[:self.total]
+            self._hashes = ampliado
+        self._hashes[self.total] = a_uint64(dhash)
+        self.ids.append(foto_id)
+        self.total += 1
+        self._grupos.clear()
+
+    def buscar(self, dhash: int, umbral: int) -> List[tuple]:
+        """[(foto_id, distancia)] a distancia de Hamming <= umbral, de la más parecida a la menos"""
+        distancias = np.bitwise_count(self._hashes[:self.total] ^ a_uint64(dhash))
+        cercanas = np.flatnonzero(distancias <= umbral)
+        cercanas = cercanas[np.argsort(distancias[cercanas], kind="stable")]
+        return [(self.ids[i], int(distancias[i])) for i in cercanas]
+
+    def grupos(self, umbral: int) -> List[List[str]]:
+        """Grupos de fotos casi iguales (componentes conexas de los pares a distancia <= umbral)
+
+        Si dos hashes difieren en <= umbral bits y se parten en umbral + 1 franjas, al menos
+        una franja es idéntica: solo se comparan los pares que coinciden en alguna franja.
+        """
+        grupos = self._grupos.get(umbral)
+        if grupos is None:
+            total = self.total
+            grupos = self._calcular_grupos(umbral, total)
+            # Se calcula en un hilo: si entretanto llegó otra foto, el resultado ya no vale para la caché
+            if total == self.total:
+                self._grupos[umbral] = grupos
+        return grupos
+
+    def _calcular_grupos(self, umbral: int, total: int) -> List[List[str]]:
+        if total < 2:
+            return []
+        # Los hashes repetidos (p. ej. todas las imágenes lisas dan 0) se comparan una sola vez:
+        # con n fotos iguales, las franjas darían n² pares idénticos
+        hashes, valor_de_foto = np.unique(self._hashes[:total], return_inverse=True)
+        distintos = len(hashes)
+        pares = [np.empty((0, 2), dtype=np.int64)]
+        limites = np.linspace(0, 64, umbral + 2).astype(int)
+        for inicio, fin in zip(limites[:-1], limites[1:]):
+            mascara = np.uint64((1 << int(fin - inicio)) - 1)
+            franja = (hashes >> np.uint64(inicio)) & mascara
+            orden = np.argsort(franja, kind="stable")
+            claves = franja[orden]
+            # Pares (i, i + salto) dentro de cada racha de claves iguales; si un salto ya
+            # sale de la racha, los mayores también, así que los candidatos solo disminuyen
+            candidatos = np.arange(distintos - 1)
+            salto = 1
+            while len(candidatos):
+                candidatos = candidatos[candidatos + salto < distintos]
+                candidatos = candidatos[claves[candidatos] == claves[candidatos + salto]]
+                a, b = orden[candidatos], orden[candidatos + salto]
+                cercanos = np.bitwise_count(hashes[a] ^ hashes[b]) <= umbral
+                pares.append(np.stack([a[cercanos], b[cercanos]], axis=1))
+                salto += 1
+
+        # Unión de los valores en grupos (un mismo par puede salir en varias franjas)
+        padres = {}
+        def raiz(i):
+            while padres[i] != i:
+                padres[i] = padres[padres[i]]
+                i = padres[i]
+            return i
+        for a, b in np.unique(np.sort(np.concatenate(pares), axis=1), axis=0).tolist():
+            padres.setdefault(a, a)
+            padres.setdefault(b, b)
+            ra, rb = raiz(a), raiz(b)
+            if ra != rb:
+                padres[max(ra, rb)] = min(ra, rb)
+        raices = np.arange(distintos)
+        for i in padres:
+            raices[i] = raiz(i)
+
+        # De valores a fotos: cada foto va al grupo de su valor (un valor repetido ya es un grupo)
+        raiz_de_foto = raices[valor_de_foto]
+        orden = np.argsort(raiz_de_foto, kind="stable")
+        cortes = np.flatnonzero(np.diff(raiz_de_foto[orden])) + 1
+        grupos = [grupo.tolist() for grupo in np.split(orden, cortes) if len(grupo) > 1]
+        grupos.sort(key=lambda grupo: (-len(grupo), grupo[0]))
+        return [[self.ids[i] for i in grupo] for grupo in grupos]
+
+indices_hashes = TTLCache(maxsize=DUPLICADOS_MAX_FAMILIAS, ttl=DUPLICADOS_CACHE_TTL_SEGUNDOS)
+
+async def get_indice_hashes(familia_id: str) -> IndiceHashes:
+    """Índice en memoria de los hashes de una familia; las subidas de este proceso lo mantienen al día"""
+    indice = indices_hashes.get(familia_id)
+    if indice is None:
+        ids, hashes = [], []
+        async for foto in db.fotos.find({"familia_id": familia_id, "dhash": {"$ne": None}}, {"_id": 0, "id": 1, "dhash": 1}):
+            ids.append(foto["id"])
+            hashes.append(foto["dhash"])
+        indice = IndiceHashes(ids, hashes)
+        indices_hashes.set(familia_id, indice)
+    return indice
+
+def posibles_duplicados(indice: IndiceHashes, fotos: List[Foto]) -> List[List[Dict[str, Any]]]:
+    """Por cada foto nueva, las ya guardadas y las anteriores del mismo lote que parecen la misma"""
+    avisos = []
+    for posicion, foto in enumerate(fotos):
+        if foto.dhash is None:
+            avisos.append([])
+            continue
+        coincidencias = [c for c in indice.buscar(foto.dhash, DUPLICADOS_UMBRAL) if c[0] != foto.id]
+        for anterior in fotos[:posicion]:
+            if anterior.dhash is not None:
+                distancia = ((foto.dhash ^ anterior.dhash) & 0xFFFFFFFFFFFFFFFF).bit_count()
+                if distancia <= DUPLICADOS_UMBRAL:
+                    coincidencias.append((anterior.id, distancia))
+        coincidencias.sort(key=lambda coincidencia: coincidencia[1])
+        avisos.append([
+            {"foto_id": foto_id, "distancia": distancia}
+            for foto_id, distancia in coincidencias[:DUPLICADOS_MAX_AVISOS]
+        ])
+    return avisos
+
 # Endpoints de Autenticación
 @app.post("/api/auth/register")
 async def register(user_data: UserCreate):
@@ -266,7 +1196,7 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="El email ya está registrado")
     
     # Hash de la contraseña
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await hash_password_async(user_data.password)
     
     # Crear o unirse a familia
     familia_id = None
@@ -305,6 +1235,7 @@ async def register(user_data: UserCreate):
             {"id": familia_id},
             {"$set": {"admin_id": nuevo_usuario.id}}
         )
+        invalidar_familia(familia_id)
     
     # Crear token
     access_token = create_access_token({"sub": nuevo_usuario.id})
@@ -320,17 +1251,22 @@ async def login(login_data: UserLogin):
     """Inicio de sesión"""
     # Buscar usuario
     user_doc = await db.usuarios.find_one({"email": login_data.email})
-    if not user_doc or not verify_password(login_data.password, user_doc["password"]):
+    if not user_doc or not await verify_password_async(login_data.password, user_doc["password"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
     if not user_doc.get("activo", True):
+        invalidar_usuario(user_doc["id"])
         raise HTTPException(status_code=401, detail="Cuenta desactivada")
     
-    # Actualizar último acceso
+    # Actualizar último acceso (y el hash si cambió el coste de bcrypt)
+    cambios = {"ultimo_acceso": datetime.now(timezone.utc)}
+    if necesita_rehash(user_doc["password"]):
+        cambios["password"] = await hash_password_async(login_data.password)
     await db.usuarios.update_one(
         {"id": user_doc["id"]},
-        {"$set": {"ultimo_acceso": datetime.now(timezone.utc)}}
+        {"$set": cambios}
     )
+    invalidar_usuario(user_doc["id"])
     
     # Crear token
     access_token = create_access_token({"sub": user_doc["id"]})
@@ -347,29 +1283,28 @@ async def get_me(current_user: User = Depends(get_current_user)):
     """Obtener información del usuario actual"""
     return current_user
 
+@app.post("/api/auth/token-url")
+async def crear_token_url(datos: TokenUrlCreate, current_user: User = Depends(get_current_user)):
+    """Token de un minuto para abrir un recurso por URL (?token=) sin exponer el de la sesión"""
+    return {
+        "token": create_url_token(current_user.id, datos.alcance),
+        "expira_en": TOKEN_URL_EXPIRACION_SEGUNDOS
+    }
+
 # Endpoints de Familia
 @app.get("/api/familia")
 async def get_familia(current_user: User = Depends(get_current_user)):
     """Obtener información de la familia"""
-    familia = await db.familias.find_one({"id": current_user.familia_id})
+    familia = await get_familia_doc(current_user.familia_id)
     if not familia:
         raise HTTPException(status_code=404, detail="Familia no encontrada")
     
-    # Remover ObjectId para evitar problemas de serialización
-    if "_id" in familia:
-        del familia["_id"]
-    
-    # Obtener miembros de la familia
-    miembros = await db.usuarios.find({"familia_id": current_user.familia_id}).to_list(None)
-    miembros_limpio = []
-    for m in miembros:
-        if "_id" in m:
-            del m["_id"]
-        miembros_limpio.append(m)
+    # Obtener miembros de la familia (sin el hash de la contraseña)
+    familia["miembros"] = await db.usuarios.find(
+        {"familia_id": current_user.familia_id}, PROYECCION_USUARIO
+    ).to_list(None)
     
-    familia["miembros"] = miembros_limpio
-    
-    return familia
+    return RespuestaJSON(familia)
 
 @app.get("/api/familia/codigo-invitacion")
 async def get_codigo_invitacion(current_user: User = Depends(get_current_user)):
@@ -377,18 +1312,52 @@ async def get_codigo_invitacion(current_user: User = Depends(get_current_user)):
     if current_user.rol != "admin":
         raise HTTPException(status_code=403, detail="Sin permisos")
     
-    familia = await db.familias.find_one({"id": current_user.familia_id})
+    familia = await get_familia_doc(current_user.familia_id)
     if not familia:
         raise HTTPException(status_code=404, detail="Familia no encontrada")
     
     return {"codigo_invitacion": familia["codigo_invitacion"]}
 
+# Paginación por cursor (fecha_captura, fecha_subida, id)
+TIMELINE_ORDEN = [("fecha_captura", DESCENDING), ("fecha_subida", DESCENDING), ("id", DESCENDING)]
+
+def codificar_cursor(foto: Dict[str, Any]) -> str:
+    fecha_captura = foto.get("fecha_captura")
+    valores = [
+        fecha_captura.isoformat() if fecha_captura else None,
+        foto["fecha_subida"].isoformat(),
+        foto["id"]
+    ]
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode()
+
+def decodificar_cursor(cursor: str) -> Dict[str, Any]:
+    """Convertir un cursor en el filtro de las fotos posteriores a él"""
+    try:
+        fecha_captura, fecha_subida, foto_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        fecha_captura = datetime.fromisoformat(fecha_captura) if fecha_captura else None
+        fecha_subida = datetime.fromisoformat(fecha_subida)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    
+    desempate = {"$or": [
+        {"fecha_subida": {"$lt": fecha_subida}},
+        {"fecha_subida": fecha_subida, "id": {"$lt": foto_id}}
+    ]}
+    if fecha_captura is None:
+        # Las fotos sin fecha de captura van al final del orden descendente
+        return {"fecha_captura": None, **desempate}
+    return {"$or": [
+        {"fecha_captura": {"$lt": fecha_captura}},
+        {"fecha_captura": None},
+        {"fecha_captura": fecha_captura, **desempate}
+    ]}
+
 # Endpoints de Álbumes
 @app.get("/api/albumes")
 async def get_albumes(current_user: User = Depends(get_current_user)):
     """Obtener álbumes de la familia"""
-    albumes = await db.albumes.find({"familia_id": current_user.familia_id}).to_list(None)
-    return [Album(**album).dict() for album in albumes]
+    albumes = await db.albumes.find({"familia_id": current_user.familia_id}, SIN_ID).to_list(None)
+    return RespuestaJSON(albumes)
 
 @app.post("/api/albumes")
 async def create_album(album_data: dict, current_user: User = Depends(get_current_user)):
@@ -405,18 +1374,231 @@ async def create_album(album_data: dict, current_user: User = Depends(get_curren
     await db.albumes.insert_one(nuevo_album.dict())
     return nuevo_album.dict()
 
+# Campos de las fotos en listados; el detalle completo está en /api/fotos/{foto_id}
+PROYECCION_FOTO_LIGERA = {
+    "_id": 0, "id": 1, "nombre_archivo": 1, "archivo_url": 1, "miniatura_url": 1, "derivados": 1,
+    "fecha_captura": 1, "fecha_subida": 1, "descripcion": 1, "lugar_nombre": 1, "ubicacion": 1,
+    "total_comentarios": 1, "reacciones": 1
+}
+
+async def get_fotos_album_pagina(album_id: str, cursor: Optional[str], limite: int) -> Dict[str, Any]:
+    """Página de fotos de un álbum con sus totales de comentarios y reacciones"""
+    filtro = {"album_id": album_id}
+    if cursor:
+        filtro.update(decodificar_cursor(cursor))
+    
+    # Los contadores se mantienen en la propia foto: no hace falta consultar otras colecciones
+    fotos = await db.fotos.find(filtro, PROYECCION_FOTO_LIGERA).sort(TIMELINE_ORDEN).limit(limite + 1).to_list(None)
+    return {
+        "fotos": fotos[:limite],
+        "siguiente_cursor": codificar_cursor(fotos[limite - 1]) if len(fotos) > limite else None
+    }
+
 @app.get("/api/albumes/{album_id}")
-async def get_album(album_id: str, current_user: User = Depends(get_current_user)):
-    """Obtener álbum específico"""
-    album = await db.albumes.find_one({"id": album_id, "familia_id": current_user.familia_id})
+async def get_album(
+    album_id: str,
+    limite: int = Query(60, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Obtener álbum específico con la primera página de fotos"""
+    album = await db.albumes.find_one({"id": album_id, "familia_id": current_user.familia_id}, SIN_ID)
     if not album:
         raise HTTPException(status_code=404, detail="Álbum no encontrado")
     
-    # Obtener fotos del álbum
-    fotos = await db.fotos.find({"album_id": album_id}).to_list(None)
-    album["fotos"] = [Foto(**foto).dict() for foto in fotos]
+    album["total_fotos"] = await db.fotos.count_documents({"album_id": album_id})
+    album.update(await get_fotos_album_pagina(album_id, None, limite))
+    return RespuestaJSON(album)
+
+@app.get("/api/albumes/{album_id}/fotos")
+async def get_album_fotos(
+    album_id: str,
+    cursor: Optional[str] = None,
+    limite: int = Query(60, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Obtener la siguiente página de fotos de un álbum"""
+    album = await db.albumes.find_one({"id": album_id, "familia_id": current_user.familia_id}, {"_id": 0, "id": 1})
+    if not album:
+        raise HTTPException(status_code=404, detail="Álbum no encontrado")
     
-    return album
+    return RespuestaJSON(await get_fotos_album_pagina(album_id, cursor, limite))
+
+# Escritura de archivos subidos
+async def leer_upload(file: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+async def escribir_stream(
+    chunks: AsyncIterator[bytes],
+    file_path: Path,
+    offset: int = 0,
+    hasher: Optional[Any] = None
+) -> int:
+    """Escribe un flujo de bytes en disco sin bloquear el event loop"""
+    modo = "r+b" if file_path.exists() else "wb"
+    inicio = time.perf_counter()
+    buffer = await asyncio.to_thread(open, file_path, modo)
+    escritura = time.perf_counter() - inicio
+    escritos = 0
+    try:
+        if offset:
+            await asyncio.to_thread(buffer.seek, offset)
+        async for chunk in chunks:
+            # Solo cuenta la escritura: la espera de cada parte se mide en la recepción
+            inicio = time.perf_counter()
+            await asyncio.to_thread(buffer.write, chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            escritura += time.perf_counter() - inicio
+            escritos += len(chunk)
+    finally:
+        inicio = time.perf_counter()
+        await asyncio.to_thread(buffer.close)
+        registrar_etapa("escritura", escritura + time.perf_counter() - inicio)
+    return escritos
+
+# Almacenamiento por contenido con deduplicación
+def ruta_blob(sha256: str, extension: str) -> Path:
+    return BLOBS_DIR / sha256[:2] / sha256[2:4] / f"{sha256}{extension}"
+
+def url_archivo(file_path: Path) -> str:
+    return f"/api/fotos/files/{file_path.relative_to(UPLOAD_DIR).as_posix()}"
+
+def normalizar_extension(nombre_archivo: str) -> str:
+    extension = Path(nombre_archivo).suffix.lower()
+    return ".jpg" if extension == ".jpeg" else extension
+
+def hash_archivo(file_path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _mover_blob(temp_path: Path, destino: Path):
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(temp_path, destino)
+
+def sin_borrado_en_curso(ahora: datetime) -> Dict[str, Any]:
+    return {"$or": [{"borrando_hasta": None}, {"borrando_hasta": {"$lt": ahora}}]}
+
+async def almacenar_blob(temp_path: Path, sha256: str, extension: str) -> Path:
+    """Mover un archivo temporal al almacén, reutilizando el blob si ya existe"""
+    relativa = ruta_blob(sha256, extension).relative_to(UPLOAD_DIR).as_posix()
+    while True:
+        ahora = datetime.now(timezone.utc)
+        try:
+            # Un blob cuyo borrado quedó a medias se recupera: sus archivos se reponen abajo
+            blob = await db.blobs.find_one_and_update(
+                {"sha256": sha256, **sin_borrado_en_curso(ahora)},
+                {
+                    "$inc": {"referencias": 1},
+                    "$unset": {"borrando": "", "borrando_hasta": ""},
+                    "$setOnInsert": {"ruta": relativa, "fecha_creacion": ahora}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # Otra subida del mismo contenido creó el blob al mismo tiempo, o liberar_blob
+            # está borrando sus archivos: esperar a que termine y volver a intentarlo
+            await asyncio.sleep(BLOBS_BORRADO_ESPERA_SEGUNDOS)
+    
+    destino = UPLOAD_DIR / blob["ruta"]
+    if await asyncio.to_thread(destino.exists):
+        await asyncio.to_thread(temp_path.unlink, True)
+    else:
+        await asyncio.to_thread(_mover_blob, temp_path, destino)
+    return destino
+
+async def liberar_blob(sha256: str):
+    """Quitar una referencia a un blob y borrarlo si ya no se usa"""
+    blob = await db.blobs.find_one_and_update(
+        {"sha256": sha256}, {"$inc": {"referencias": -1}}, return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["referencias"] > 0:
+        return
+    # Los archivos se borran con el registro todavía marcado: una subida del mismo contenido
+    # espera a que desaparezca en vez de reutilizar un archivo a punto de borrarse
+    ahora = datetime.now(timezone.utc)
+    borrado = str(uuid.uuid4())
+    result = await db.blobs.update_one(
+        {"sha256": sha256, "referencias": {"$lte": 0}, **sin_borrado_en_curso(ahora)},
+        {"$set": {"borrando": borrado, "borrando_hasta": ahora + timedelta(seconds=BLOBS_BORRADO_LEASE_SEGUNDOS)}}
+    )
+    if not result.modified_count:
+        return
+    ruta = UPLOAD_DIR / blob["ruta"]
+    await asyncio.to_thread(ruta.unlink, True)
+    await asyncio.to_thread(eliminar_derivados, ruta)
+    await db.blobs.delete_one({"sha256": sha256, "borrando": borrado})
+
+async def guardar_archivo(chunks: AsyncIterator[bytes], nombre_archivo: str) -> tuple:
+    """Guardar un flujo en el almacén calculando su hash mientras se escribe"""
+    temp_path = PARCIALES_DIR / f"{uuid.uuid4()}.part"
+    hasher = hashlib.sha256()
+    try:
+        await escribir_stream(chunks, temp_path, hasher=hasher)
+        sha256 = hasher.hexdigest()
+        with medir_etapa("almacenamiento"):
+            return await almacenar_blob(temp_path, sha256, normalizar_extension(nombre_archivo)), sha256
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def es_imagen(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith('image/')
+
+def texto_busqueda_album(album: Dict[str, Any]) -> str:
+    """Título y etiquetas del álbum, copiados en sus fotos para buscarlas con un solo índice"""
+    return " ".join([album.get("titulo") or "", *album.get("etiquetas", [])]).strip()
+
+def registro_foto(
+    file_path: Path,
+    nombre_archivo: str,
+    album_id: str,
+    current_user: User,
+    descripcion: Optional[str] = None,
+    lugar_nombre: Optional[str] = None,
+    sha256: Optional[str] = None,
+    texto_album: Optional[str] = None
+) -> Foto:
+    """Registro de una foto ya guardada en disco, pendiente de extraer metadatos y generar derivados"""
+    return Foto(
+        nombre_archivo=nombre_archivo,
+        archivo_url=url_archivo(file_path),
+        sha256=sha256,
+        album_id=album_id,
+        familia_id=current_user.familia_id,
+        subida_por=current_user.id,
+        descripcion=descripcion,
+        lugar_nombre=lugar_nombre,
+        texto_busqueda=texto_album or None,
+        estado_procesamiento="pendiente"
+    )
+
+async def procesar_archivo_foto(file_path: Path, texto_album: Optional[str]) -> Dict[str, Any]:
+    """Campos de la foto que salen del archivo: metadatos, derivados y hash perceptual"""
+    # Extraer metadatos, generar derivados y calcular el hash perceptual en paralelo
+    metadata, derivados, dhash = await asyncio.gather(
+        leer_metadatos(file_path),
+        crear_derivados(file_path),
+        leer_dhash(file_path)
+    )
+    
+    fecha_captura = metadata.get('fecha_captura')
+    texto_busqueda = " ".join(filter(None, [texto_album, str(fecha_captura.year) if fecha_captura else None]))
+    return {
+        "miniatura_url": derivados.get(str(min(DERIVADOS_TAMANOS))),
+        "derivados": derivados,
+        "fecha_captura": fecha_captura,
+        "ubicacion": metadata.get('ubicacion'),
+        "metadata": metadata,
+        "texto_busqueda": texto_busqueda or None,
+        "dia_captura": fecha_captura.strftime("%m-%d") if fecha_captura else None,
+        "dhash": dhash,
+        "estado_procesamiento": "lista"
+    }
 
 # Endpoints de Fotos
 @app.post("/api/fotos/upload")
@@ -427,158 +1609,783 @@ async def upload_fotos(
     lugar_nombre: Optional[str] = Form(None),
     current_user: User = Depends(get_current_user)
 ):
-    """Subir fotos a un álbum"""
+    """Subir fotos a un álbum; metadatos, derivados e índices se completan en la cola de trabajos"""
+    # El cuerpo multipart ya se recibió y se analizó antes de llegar aquí
+    inicio = inicio_peticion.get()
+    if inicio is not None:
+        registrar_etapa("recepcion", time.perf_counter() - inicio)
+    
     # Verificar que el álbum existe y pertenece a la familia
     album = await db.albumes.find_one({"id": album_id, "familia_id": current_user.familia_id})
     if not album:
         raise HTTPException(status_code=404, detail="Álbum no encontrado")
     
-    extractor = PhotoMetadataExtractor()
-    fotos_subidas = []
+    resultados = [{"nombre_archivo": file.filename, "ok": False} for file in files]
     
-    for file in files:
-        if not file.content_type or not file.content_type.startswith('image/'):
+    async def guardar(file: UploadFile) -> Foto:
+        file_path, sha256 = await guardar_archivo(leer_upload(file), file.filename)
+        return registro_foto(
+            file_path,
+            file.filename,
+            album_id,
+            current_user,
+            descripcion=descripcion,
+            lugar_nombre=lugar_nombre,
+            sha256=sha256,
+            texto_album=texto_busqueda_album(album)
+        )
+    
+    # Guardar todos los archivos en paralelo
+    pendientes = {}
+    for indice, file in enumerate(files):
+        if not es_imagen(file.content_type):
+            resultados[indice]["error"] = "Tipo de archivo no permitido"
             continue
-        
+        pendientes[indice] = guardar(file)
+    
+    guardadas = await asyncio.gather(*pendientes.values(), return_exceptions=True)
+    
+    fotos_listas = []  # [(indice, Foto)]
+    for indice, foto in zip(pendientes.keys(), guardadas):
+        if isinstance(foto, Exception):
+            logger.error(f"Error guardando archivo {files[indice].filename}: {str(foto)}")
+            resultados[indice]["error"] = "Error guardando el archivo"
+        else:
+            fotos_listas.append((indice, foto))
+    
+    # Persistir el lote en una sola operación
+    fallidas = set()
+    if fotos_listas:
         try:
-            # Generar nombre único
-            file_extension = Path(file.filename).suffix.lower()
-            unique_filename = f"{uuid.uuid4()}{file_extension}"
-            file_path = UPLOAD_DIR / unique_filename
-            
-            # Guardar archivo
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            # Extraer metadatos
-            metadata = extractor.extract_metadata(str(file_path))
-            
-            # Crear registro de foto
-            nueva_foto = Foto(
-                nombre_archivo=file.filename,
-                archivo_url=f"/api/fotos/files/{unique_filename}",
-                album_id=album_id,
-                subida_por=current_user.id,
-                descripcion=descripcion,
-                lugar_nombre=lugar_nombre,
-                fecha_captura=metadata.get('fecha_captura'),
-                ubicacion=metadata.get('ubicacion'),
-                metadata=metadata
-            )
-            
-            await db.fotos.insert_one(nueva_foto.dict())
-            fotos_subidas.append(nueva_foto.dict())
-            
-            logger.info(f"Foto subida exitosamente: {file.filename}")
-            
-        except Exception as e:
-            logger.error(f"Error procesando archivo {file.filename}: {str(e)}")
-            if file_path.exists():
-                file_path.unlink()
+            with medir_etapa("insercion"):
+                await db.fotos.insert_many([foto.dict() for _, foto in fotos_listas], ordered=False)
+        except BulkWriteError as e:
+            fallidas = {error["index"] for error in e.details.get("writeErrors", [])}
+    
+    fotos_subidas = []
+    trabajos = []
+    for posicion, (indice, foto) in enumerate(fotos_listas):
+        if posicion in fallidas:
+            logger.error(f"Error guardando foto {foto.nombre_archivo}")
+            resultados[indice]["error"] = "Error guardando la foto"
+            await liberar_blob(foto.sha256)
             continue
+        trabajo = trabajo_procesar_foto(foto.id, current_user.familia_id)
+        resultados[indice].update({"ok": True, "foto_id": foto.id, "trabajo_id": trabajo["id"]})
+        fotos_subidas.append(foto.dict())
+        trabajos.append(trabajo)
+        logger.info(f"Foto subida exitosamente: {foto.nombre_archivo}")
     
+    if fotos_subidas:
+        # Los archivos ya están en disco y las fotos en Mongo: el resto no hace esperar al cliente
+        with medir_etapa("encolado"):
+            await encolar_trabajos(trabajos)
+        publicar_fotos_subidas(current_user, album_id, fotos_subidas)
     return {
         "mensaje": f"Se subieron {len(fotos_subidas)} fotos exitosamente",
-        "fotos": fotos_subidas
+        "fotos": fotos_subidas,
+        "resultados": resultados
     }
 
-@app.get("/api/fotos/files/{filename}")
-async def get_foto_file(filename: str):
-    """Servir archivo de foto"""
-    file_path = UPLOAD_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+# Subida por partes (reanudable)
+async def get_sesion_subida(sesion_id: str, current_user: User) -> Dict[str, Any]:
+    sesion = await db.subidas.find_one({"id": sesion_id, "usuario_id": current_user.id})
+    if not sesion:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada")
+    del sesion["_id"]
+    return sesion
+
+def ruta_parcial(sesion_id: str) -> Path:
+    return PARCIALES_DIR / f"{sesion_id}.part"
+
+async def cerrar_sesion_subida(sesion_id: str):
+    await db.subidas.delete_one({"id": sesion_id})
+    await asyncio.to_thread(ruta_parcial(sesion_id).unlink, True)
+
+def limite_sesiones_subida() -> datetime:
+    """Las sesiones sin actividad desde antes de este momento se consideran abandonadas"""
+    return datetime.now(timezone.utc) - timedelta(seconds=SUBIDAS_SESION_EXPIRACION_SEGUNDOS)
+
+async def limpiar_subidas_abandonadas():
+    """Borrar las sesiones expiradas y los .part que ya no pertenecen a ninguna sesión"""
+    limite = limite_sesiones_subida()
+    expiradas = {"$or": [
+        {"fecha_actualizacion": {"$lt": limite}},
+        {"fecha_actualizacion": None, "fecha_creacion": {"$lt": limite}}  # sesiones anteriores al campo
+    ]}
+    borradas = 0
+    async for sesion in db.subidas.find(expiradas, {"_id": 0, "id": 1}):
+        # Condicional: una parte recibida justo ahora mantiene viva la sesión
+        result = await db.subidas.delete_one({"id": sesion["id"], **expiradas})
+        if result.deleted_count:
+            await asyncio.to_thread(ruta_parcial(sesion["id"]).unlink, True)
+            borradas += 1
     
-    return FileResponse(path=str(file_path))
+    # Temporales huérfanos (sesiones borradas a mano, subidas directas interrumpidas por una caída...)
+    def parciales_antiguos() -> List[Path]:
+        return [
+            ruta for ruta in PARCIALES_DIR.glob("*.part")
+            if datetime.fromtimestamp(ruta.stat().st_mtime, timezone.utc) < limite
+        ]
+    antiguos = await asyncio.to_thread(parciales_antiguos)
+    if antiguos:
+        vivas = set(await db.subidas.distinct("id", {"id": {"$in": [ruta.stem for ruta in antiguos]}}))
+        for ruta in antiguos:
+            if ruta.stem not in vivas:
+                await asyncio.to_thread(ruta.unlink, True)
+                borradas += 1
+    if borradas:
+        logger.info(f"Limpieza de subidas: {borradas} sesiones o archivos parciales abandonados eliminados")
 
-@app.get("/api/fotos/{foto_id}")
-async def get_foto(foto_id: str, current_user: User = Depends(get_current_user)):
-    """Obtener información de una foto"""
-    foto = await db.fotos.find_one({"id": foto_id})
-    if not foto:
-        raise HTTPException(status_code=404, detail="Foto no encontrada")
+async def bucle_limpieza_subidas():
+    while True:
+        try:
+            await limpiar_subidas_abandonadas()
+        except Exception as e:
+            logger.error(f"Error limpiando subidas abandonadas: {str(e)}")
+        await asyncio.sleep(SUBIDAS_LIMPIEZA_SEGUNDOS)
+
+_tarea_limpieza_subidas: Optional[asyncio.Task] = None
+
+async def limitar_stream(chunks: AsyncIterator[bytes], maximo: int) -> AsyncIterator[bytes]:
+    recibidos = 0
+    async for chunk in chunks:
+        recibidos += len(chunk)
+        if recibidos > maximo:
+            raise HTTPException(status_code=413, detail="La parte excede el tamaño declarado")
+        yield chunk
+
+@app.post("/api/fotos/upload/sesiones")
+async def crear_sesion_subida(datos: SubidaCreate, current_user: User = Depends(get_current_user)):
+    """Iniciar una subida por partes"""
+    if not (es_imagen(datos.content_type) or datos.content_type.startswith('video/')):
+        raise HTTPException(status_code=400, detail="Tipo de archivo no permitido")
+    if datos.tamano_total <= 0 or datos.tamano_total > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Tamaño de archivo no permitido")
     
-    # Verificar acceso familiar
-    album = await db.albumes.find_one({"id": foto["album_id"], "familia_id": current_user.familia_id})
+    album = await db.albumes.find_one({"id": datos.album_id, "familia_id": current_user.familia_id})
     if not album:
-        raise HTTPException(status_code=403, detail="Sin acceso a esta foto")
+        raise HTTPException(status_code=404, detail="Álbum no encontrado")
     
-    return Foto(**foto).dict()
+    # Cada sesión reserva hasta MAX_UPLOAD_BYTES en disco hasta completarse o expirar
+    abiertas = await db.subidas.count_documents(
+        {"usuario_id": current_user.id, "fecha_actualizacion": {"$gte": limite_sesiones_subida()}},
+        limit=SUBIDAS_SESIONES_MAX_POR_USUARIO
+    )
+    if abiertas >= SUBIDAS_SESIONES_MAX_POR_USUARIO:
+        raise HTTPException(
+            status_code=429,
+            detail="Tienes demasiadas subidas sin terminar; complétalas o cancélalas antes de empezar otra"
+        )
+    
+    sesion = SubidaSesion(**datos.dict(), usuario_id=current_user.id)
+    await asyncio.to_thread(ruta_parcial(sesion.id).touch)
+    await db.subidas.insert_one(sesion.dict())
+    return sesion.dict()
 
-# Endpoints de Timeline
-@app.get("/api/timeline")
-async def get_timeline(current_user: User = Depends(get_current_user)):
-    """Obtener timeline de fotos familiares"""
-    # Obtener todas las fotos de la familia ordenadas por fecha
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "albumes",
-                "localField": "album_id",
-                "foreignField": "id",
-                "as": "album"
-            }
-        },
-        {
-            "$match": {
-                "album.familia_id": current_user.familia_id
-            }
-        },
+@app.get("/api/fotos/upload/sesiones/{sesion_id}")
+async def get_estado_subida(sesion_id: str, current_user: User = Depends(get_current_user)):
+    """Consultar el offset confirmado para reanudar una subida"""
+    return await get_sesion_subida(sesion_id, current_user)
+
+@app.put("/api/fotos/upload/sesiones/{sesion_id}")
+async def append_chunk_subida(
+    sesion_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: User = Depends(get_current_user)
+):
+    """Agregar una parte del archivo en el offset indicado"""
+    # Reclamar el offset antes de escribir: un reintento del cliente mientras la parte
+    # anterior sigue llegando no puede truncar ni mezclar bytes en el mismo .part
+    ahora = datetime.now(timezone.utc)
+    escritor = str(uuid.uuid4())
+    sesion = await db.subidas.find_one_and_update(
         {
-            "$sort": {
-                "fecha_captura": -1,
-                "fecha_subida": -1
-            }
+            "id": sesion_id,
+            "usuario_id": current_user.id,
+            "recibido": offset,
+            "$or": [{"escribiendo_hasta": None}, {"escribiendo_hasta": {"$lt": ahora}}]
         },
-        {
-            "$limit": 100
+        {"$set": {
+            "escritor": escritor,
+            "escribiendo_hasta": ahora + timedelta(seconds=SUBIDAS_ESCRITURA_LEASE_SEGUNDOS),
+            "fecha_actualizacion": ahora
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+    if sesion is None:
+        actual = await get_sesion_subida(sesion_id, current_user)
+        detalle = "Offset incorrecto" if actual["recibido"] != offset else "Otra petición está enviando esta parte"
+        return JSONResponse(status_code=409, content={"detail": detalle, "recibido": actual["recibido"]})
+    
+    part_path = ruta_parcial(sesion_id)
+    try:
+        # Descartar bytes de un intento anterior que no llegó a confirmarse
+        await asyncio.to_thread(os.truncate, part_path, offset)
+        await escribir_stream(
+            medir_stream(limitar_stream(request.stream(), sesion["tamano_total"] - offset), "recepcion"),
+            part_path,
+            offset
+        )
+    finally:
+        # Confirmar lo escrito aunque la conexión se haya cortado a mitad de la parte
+        recibido = min((await asyncio.to_thread(part_path.stat)).st_size, sesion["tamano_total"])
+        sesion = await db.subidas.find_one_and_update(
+            {"id": sesion_id, "escritor": escritor},
+            {"$set": {
+                "recibido": recibido,
+                "escritor": None,
+                "escribiendo_hasta": None,
+                "fecha_actualizacion": datetime.now(timezone.utc)
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    if sesion is None:
+        # Otra petición tomó la sesión al expirar esta: vale lo que ella haya guardado
+        sesion = await get_sesion_subida(sesion_id, current_user)
+    return {"id": sesion_id, "recibido": sesion["recibido"], "tamano_total": sesion["tamano_total"]}
+
+@app.post("/api/fotos/upload/sesiones/{sesion_id}/finalizar")
+async def finalizar_subida(sesion_id: str, current_user: User = Depends(get_current_user)):
+    """Completar una subida por partes y registrar la foto"""
+    # Repetir un finalizar que ya se completó (p. ej. se perdió la respuesta) devuelve la misma
+    # foto: su id es el de la sesión
+    foto = await db.fotos.find_one({"id": sesion_id, "subida_por": current_user.id}, PROYECCION_FOTO)
+    if foto:
+        await cerrar_sesion_subida(sesion_id)
+        return RespuestaJSON(foto)
+    
+    sesion = await get_sesion_subida(sesion_id, current_user)
+    if sesion["recibido"] != sesion["tamano_total"]:
+        raise HTTPException(status_code=409, detail="La subida está incompleta")
+    
+    # Reclamar la sesión para que un doble envío no registre la foto dos veces. La sesión y
+    # el .part se borran solo con la foto ya insertada: si algo falla, el cliente puede repetir
+    ahora = datetime.now(timezone.utc)
+    result = await db.subidas.update_one(
+        {"id": sesion_id, "$or": [{"finalizando_hasta": None}, {"finalizando_hasta": {"$lt": ahora}}]},
+        {"$set": {
+            "finalizando_hasta": ahora + timedelta(seconds=SUBIDAS_FINALIZACION_LEASE_SEGUNDOS),
+            "fecha_actualizacion": ahora
+        }}
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="La subida ya se está finalizando")
+    
+    async def liberar_sesion():
+        await db.subidas.update_one({"id": sesion_id}, {"$set": {"finalizando_hasta": None}})
+    
+    album = await db.albumes.find_one({"id": sesion["album_id"]}, {"_id": 0, "titulo": 1, "etiquetas": 1}) or {}
+    part_path = ruta_parcial(sesion_id)
+    # Enlace duro: almacenar_blob se lleva el enlace y el .part sigue intacto para un reintento
+    temp_path = PARCIALES_DIR / f"{uuid.uuid4()}.part"
+    try:
+        with medir_etapa("almacenamiento"):
+            sha256 = await asyncio.to_thread(hash_archivo, part_path)
+            await asyncio.to_thread(os.link, part_path, temp_path)
+            file_path = await almacenar_blob(temp_path, sha256, normalizar_extension(sesion["nombre_archivo"]))
+    except Exception as e:
+        logger.error(f"Error almacenando la subida {sesion_id}: {str(e)}")
+        await asyncio.to_thread(temp_path.unlink, True)
+        await liberar_sesion()
+        raise HTTPException(status_code=500, detail="Error guardando la foto")
+    
+    nueva_foto = registro_foto(
+        file_path,
+        sesion["nombre_archivo"],
+        sesion["album_id"],
+        current_user,
+        descripcion=sesion.get("descripcion"),
+        lugar_nombre=sesion.get("lugar_nombre"),
+        sha256=sha256,
+        texto_album=texto_busqueda_album(album)
+    )
+    # Los vídeos no tienen metadatos ni derivados que calcular
+    procesar = es_imagen(sesion["content_type"])
+    if not procesar:
+        nueva_foto.estado_procesamiento = "lista"
+    # El id de la sesión: un reintento encuentra la foto aunque la sesión ya no exista
+    nueva_foto.id = sesion_id
+    try:
+        with medir_etapa("insercion"):
+            await db.fotos.insert_one(nueva_foto.dict())
+    except DuplicateKeyError:
+        # Otro finalizar de la misma sesión la insertó entretanto
+        await liberar_blob(sha256)
+        await cerrar_sesion_subida(sesion_id)
+        return RespuestaJSON(await db.fotos.find_one({"id": sesion_id}, PROYECCION_FOTO))
+    except Exception as e:
+        logger.error(f"Error guardando foto {sesion['nombre_archivo']}: {str(e)}")
+        await liberar_blob(sha256)
+        await liberar_sesion()
+        raise HTTPException(status_code=500, detail="Error guardando la foto")
+    
+    await cerrar_sesion_subida(sesion_id)
+    logger.info(f"Foto subida exitosamente: {sesion['nombre_archivo']}")
+    respuesta = nueva_foto.dict()
+    if procesar:
+        trabajo = trabajo_procesar_foto(nueva_foto.id, current_user.familia_id)
+        with medir_etapa("encolado"):
+            await encolar_trabajos([trabajo])
+        respuesta["trabajo_id"] = trabajo["id"]
+    else:
+        await actualizar_resumen_timeline(current_user.familia_id, [respuesta])
+    publicar_fotos_subidas(current_user, sesion["album_id"], [respuesta])
+    return respuesta
+
+@app.delete("/api/fotos/upload/sesiones/{sesion_id}")
+async def cancelar_subida(sesion_id: str, current_user: User = Depends(get_current_user)):
+    """Cancelar una subida por partes"""
+    await get_sesion_subida(sesion_id, current_user)
+    await cerrar_sesion_subida(sesion_id)
+    return {"mensaje": "Subida cancelada"}
+
+# Servir archivos con caché HTTP
+def parse_range(rango: str, tamano: int) -> Optional[tuple]:
+    """Interpretar un único rango 'bytes=inicio-fin'; None si no se puede servir parcialmente"""
+    unidad, _, especificacion = rango.partition("=")
+    if unidad.strip() != "bytes" or "," in especificacion:
+        # Rangos múltiples: se responde con el archivo completo
+        return None
+    inicio, _, fin = especificacion.strip().partition("-")
+    try:
+        if inicio:
+            inicio, fin = int(inicio), min(int(fin) if fin else tamano - 1, tamano - 1)
+        else:
+            # Sufijo: los últimos N bytes
+            inicio, fin = max(tamano - int(fin), 0), tamano - 1
+    except ValueError:
+        return None
+    return inicio, fin
+
+def etag_coincide(cabecera: str, etag: str) -> bool:
+    return any(valor.strip() in (etag, f"W/{etag}", "*") for valor in cabecera.split(","))
+
+async def leer_rango(file_path: Path, inicio: int, longitud: int) -> AsyncIterator[bytes]:
+    f = await asyncio.to_thread(open, file_path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, inicio)
+        while longitud > 0:
+            chunk = await asyncio.to_thread(f.read, min(UPLOAD_CHUNK_SIZE, longitud))
+            if not chunk:
+                break
+            longitud -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+async def servir_archivo(request: Request, file_path: Path):
+    """Responder con un archivo inmutable: ETag, 304, rangos y X-Accel-Redirect/X-Sendfile"""
+    stat_result = await asyncio.to_thread(file_path.stat)
+    tamano = stat_result.st_size
+    # Los nombres son únicos (hash o uuid) y el contenido nunca cambia: el nombre es el ETag
+    etag = f'"{file_path.stem}"'
+    cabeceras = {
+        "Cache-Control": ARCHIVOS_CACHE_CONTROL,
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes"
+    }
+    
+    # Peticiones condicionales
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag_coincide(if_none_match, etag):
+            return Response(status_code=304, headers=cabeceras)
+    elif request.headers.get("if-modified-since"):
+        try:
+            desde = parsedate_to_datetime(request.headers["if-modified-since"])
+            if int(stat_result.st_mtime) <= desde.timestamp():
+                return Response(status_code=304, headers=cabeceras)
+        except (TypeError, ValueError):
+            pass
+    
+    # Delegar el envío de bytes al proxy frontal
+    if ARCHIVOS_MODO_ENVIO == "accel":
+        relativa = file_path.relative_to(UPLOAD_DIR.resolve()).as_posix()
+        cabeceras["X-Accel-Redirect"] = f"{ARCHIVOS_ACCEL_PREFIJO.rstrip('/')}/{relativa}"
+        return Response(headers=cabeceras, media_type=mimetypes.guess_type(file_path.name)[0])
+    if ARCHIVOS_MODO_ENVIO == "sendfile":
+        cabeceras["X-Sendfile"] = str(file_path)
+        return Response(headers=cabeceras, media_type=mimetypes.guess_type(file_path.name)[0])
+    
+    # Rango de bytes (If-Range: solo si el cliente tiene la misma versión)
+    rango = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if rango and (if_range is None or if_range.strip() == etag):
+        limites = parse_range(rango, tamano)
+        if limites is not None:
+            inicio, fin = limites
+            if inicio >= tamano or inicio > fin:
+                return Response(
+                    status_code=416,
+                    headers={**cabeceras, "Content-Range": f"bytes */{tamano}"}
+                )
+            longitud = fin - inicio + 1
+            cabeceras.update({
+                "Content-Range": f"bytes {inicio}-{fin}/{tamano}",
+                "Content-Length": str(longitud)
+            })
+            return StreamingResponse(
+                leer_rango(file_path, inicio, longitud),
+                status_code=206,
+                headers=cabeceras,
+                media_type=mimetypes.guess_type(file_path.name)[0]
+            )
+    
+    return FileResponse(path=str(file_path), headers=cabeceras, stat_result=stat_result)
+
+@app.get("/api/fotos/files/{filename:path}")
+async def get_foto_file(filename: str, request: Request):
+    """Servir archivo de foto"""
+    file_path = (UPLOAD_DIR / filename).resolve()
+    # Solo archivos dentro de uploads (y nunca subidas a medio completar)
+    if UPLOAD_DIR.resolve() not in file_path.parents or PARCIALES_DIR.resolve() in file_path.parents:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    
+    return await servir_archivo(request, file_path)
+
+@app.get("/api/fotos/duplicados")
+async def get_duplicados(
+    foto_id: Optional[str] = None,
+    umbral: int = Query(DUPLICADOS_UMBRAL, ge=0, le=DUPLICADOS_UMBRAL_MAX),
+    limite: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Fotos casi idénticas: las parecidas a una foto concreta o todos los grupos de la familia"""
+    indice = await get_indice_hashes(current_user.familia_id)
+    proyeccion = {**PROYECCION_FOTO_LIGERA, "album_id": 1}
+
+    if foto_id:
+        foto = await db.fotos.find_one({"id": foto_id, "familia_id": current_user.familia_id}, {"_id": 0, "dhash": 1})
+        if not foto:
+            raise HTTPException(status_code=404, detail="Foto no encontrada")
+        if foto.get("dhash") is None:
+            return RespuestaJSON({"duplicados": []})
+        distancias = {
+            id_parecida: distancia
+            for id_parecida, distancia in indice.buscar(foto["dhash"], umbral)
+            if id_parecida != foto_id
         }
-    ]
+        ids = list(distancias)[:limite]
+        encontradas = {f["id"]: f async for f in db.fotos.find({"id": {"$in": ids}}, proyeccion)}
+        return RespuestaJSON({"duplicados": [
+            {**encontradas[i], "distancia": distancias[i]} for i in ids if i in encontradas
+        ]})
+
+    grupos = await asyncio.to_thread(indice.grupos, umbral)
+    pagina = grupos[:limite]
+    ids = [i for grupo in pagina for i in grupo]
+    encontradas = {f["id"]: f async for f in db.fotos.find({"id": {"$in": ids}}, proyeccion)}
+    # El índice puede conservar fotos borradas hasta que caduca: se descartan aquí
+    pagina = [[encontradas[i] for i in grupo if i in encontradas] for grupo in pagina]
+    return RespuestaJSON({
+        "grupos": [grupo for grupo in pagina if len(grupo) > 1],
+        "total_grupos": len(grupos)
+    })
+
+@app.get("/api/fotos/{foto_id}")
+async def get_foto(foto: Dict[str, Any] = Depends(get_foto_autorizada)):
+    """Obtener información de una foto"""
+    return RespuestaJSON(foto)
+
+# Endpoints de Timeline
+@app.get("/api/timeline")
+async def get_timeline(
+    cursor: Optional[str] = None,
+    anio: Optional[int] = Query(None, ge=1, lt=9999),
+    limite: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Obtener timeline de fotos familiares (paginado por cursor), opcionalmente de un solo año"""
+    condiciones = [{"familia_id": current_user.familia_id}]
+    if anio:
+        # El mismo año que el resumen: el de captura o, sin ella, el de subida
+        inicio, fin = datetime(anio, 1, 1), datetime(anio + 1, 1, 1)
+        condiciones.append({"$or": [
+            {"fecha_captura": {"$gte": inicio, "$lt": fin}},
+            {"fecha_captura": None, "fecha_subida": {"$gte": inicio, "$lt": fin}}
+        ]})
+    if cursor:
+        condiciones.append(decodificar_cursor(cursor))
+    filtro = condiciones[0] if len(condiciones) == 1 else {"$and": condiciones}
+    
+    # Pedir una foto extra para saber si hay más páginas
+    fotos = await db.fotos.find(filtro, PROYECCION_FOTO).sort(TIMELINE_ORDEN).limit(limite + 1).to_list(None)
+    siguiente_cursor = codificar_cursor(fotos[limite - 1]) if len(fotos) > limite else None
+    
+    return RespuestaJSON({
+        "fotos": fotos[:limite],
+        "siguiente_cursor": siguiente_cursor
+    })
+
+# Resumen del timeline por año y mes (se actualiza al subir, sin recorrer fotos)
+def fecha_timeline(foto: Dict[str, Any]) -> datetime:
+    """Fecha con la que la foto entra en el resumen, en UTC sin zona como la guarda MongoDB"""
+    fecha = foto.get("fecha_captura") or foto["fecha_subida"]
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+def mes_timeline(foto: Dict[str, Any]) -> tuple:
+    fecha = fecha_timeline(foto)
+    return fecha.year, fecha.month
+
+def portada_timeline(foto: Dict[str, Any]) -> Dict[str, Any]:
+    # La portada de un mes es su foto más antigua, con desempate por id (igual al subir que al reconstruir)
+    return {"fecha": fecha_timeline(foto), "id": foto["id"], "miniatura_url": foto.get("miniatura_url")}
+
+def portada_posterior(portada: Dict[str, Any]) -> Dict[str, Any]:
+    """Filtro de los meses cuya portada actual es posterior a la indicada"""
+    return {"$or": [
+        {"portada.fecha": None},  # resúmenes anteriores a la regla
+        {"portada.fecha": {"$gt": portada["fecha"]}},
+        {"portada.fecha": portada["fecha"], "portada.id": {"$gt": portada["id"]}}
+    ]}
+
+async def actualizar_resumen_timeline(familia_id: str, fotos: List[Dict[str, Any]]):
+    """Sumar fotos recién subidas al resumen por año y mes de la familia"""
+    por_mes: Dict[tuple, List[Dict[str, Any]]] = {}
+    for foto in fotos:
+        por_mes.setdefault(mes_timeline(foto), []).append(foto)
     
-    fotos = await db.fotos.aggregate(pipeline).to_list(None)
-    return fotos
+    operaciones = []
+    for (anio, mes), fotos_mes in por_mes.items():
+        mes_filtro = {"familia_id": familia_id, "anio": anio, "mes": mes}
+        portada = min(map(portada_timeline, fotos_mes), key=lambda candidata: (candidata["fecha"], candidata["id"]))
+        operaciones += [
+            UpdateOne(mes_filtro, {"$inc": {"total": len(fotos_mes)}, "$setOnInsert": {"portada": portada}}, upsert=True),
+            # Condicional: entre subidas simultáneas del mismo mes gana siempre la foto más antigua
+            UpdateOne({**mes_filtro, **portada_posterior(portada)}, {"$set": {"portada": portada}})
+        ]
+    try:
+        try:
+            await db.resumen_timeline.bulk_write(operaciones, ordered=False)
+        except BulkWriteError as e:
+            # Dos subidas crearon el mismo mes a la vez: la que perdió se repite como actualización,
+            # seguida de su portada (que no encontró el mes si se aplicó antes)
+            reintentos = [
+                operacion
+                for error in e.details.get("writeErrors", []) if error.get("code") == 11000
+                for operacion in operaciones[error["index"]:error["index"] + 2]
+            ]
+            if not reintentos:
+                raise
+            await db.resumen_timeline.bulk_write(reintentos, ordered=True)
+    except Exception as e:
+        # Las fotos ya están guardadas: un resumen desfasado se corrige con reconstruir-resumen
+        logger.error(f"Error actualizando el resumen del timeline de {familia_id}: {str(e)}")
+
+@app.get("/api/timeline/resumen")
+async def get_resumen_timeline(current_user: User = Depends(get_current_user)):
+    """Totales de fotos por año y mes, con una foto de portada por mes"""
+    meses = await db.resumen_timeline.find(
+        {"familia_id": current_user.familia_id, "total": {"$gt": 0}},
+        {"_id": 0, "anio": 1, "mes": 1, "total": 1, "portada": 1}
+    ).sort([("anio", DESCENDING), ("mes", DESCENDING)]).to_list(None)
+    
+    anios: Dict[int, int] = {}
+    for mes in meses:
+        anios[mes["anio"]] = anios.get(mes["anio"], 0) + mes["total"]
+    
+    return RespuestaJSON({
+        "total": sum(anios.values()),
+        "anios": [{"anio": anio, "total": total} for anio, total in anios.items()],
+        "meses": meses
+    })
+
+@app.get("/api/timeline/en-este-dia")
+async def get_en_este_dia(
+    fecha: Optional[date] = None,
+    limite: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Fotos capturadas tal día como hoy (o como `fecha`) en años anteriores"""
+    dia = fecha or datetime.now(timezone.utc).date()
+    clave = dia.strftime("%m-%d")
+    fotos = await db.fotos.find(
+        {
+            "familia_id": current_user.familia_id,
+            "dia_captura": clave,
+            "fecha_captura": {"$lt": datetime(dia.year, 1, 1)}
+        },
+        PROYECCION_FOTO_LIGERA
+    ).sort("fecha_captura", DESCENDING).limit(limite).to_list(None)
+    return RespuestaJSON({"dia": clave, "fotos": fotos})
 
 # Endpoints de Mapa
 @app.get("/api/mapa/fotos")
 async def get_fotos_mapa(current_user: User = Depends(get_current_user)):
     """Obtener fotos con ubicación para el mapa"""
+    fotos = await db.fotos.find(
+        {"familia_id": current_user.familia_id, "ubicacion": {"$ne": None}},
+        PROYECCION_FOTO
+    ).to_list(None)
+    return RespuestaJSON(fotos)
+
+def parse_bbox(bbox: str) -> tuple:
+    """Convertir 'minLng,minLat,maxLng,maxLat' en una tupla de floats (minLng > maxLng cruza el antimeridiano)"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(valor) for valor in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox inválido")
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise HTTPException(status_code=400, detail="bbox inválido")
+    return min_lng, min_lat, max_lng, max_lat
+
+def rango_bbox(minimo: float, maximo: float, limite: float) -> Dict[str, float]:
+    # Bordes como los de las celdas de los clusters ($floor): el superior no se incluye,
+    # salvo en el límite del mapa, para que un punto no cuente en dos celdas vecinas
+    return {"$gte": minimo, "$lte" if maximo >= limite else "$lt": maximo}
+
+def filtro_bbox(familia_id: str, bbox: tuple) -> Dict[str, Any]:
+    """Rectángulo plano en lat/lng, el mismo que las celdas de los clusters (no geodésico)"""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    filtro = {"familia_id": familia_id, "ubicacion.lat": rango_bbox(min_lat, max_lat, 90)}
+    if min_lng <= max_lng:
+        filtro["ubicacion.lng"] = rango_bbox(min_lng, max_lng, 180)
+    else:
+        # Cruza el antimeridiano: dos rectángulos, de min_lng a 180 y de -180 a max_lng
+        filtro["$or"] = [
+            {"ubicacion.lng": rango_bbox(min_lng, 180, 180)},
+            {"ubicacion.lng": rango_bbox(-180, max_lng, 180)}
+        ]
+    return filtro
+
+@app.get("/api/mapa/clusters")
+async def get_clusters_mapa(
+    bbox: str,
+    zoom: int = Query(..., ge=0, le=22),
+    current_user: User = Depends(get_current_user)
+):
+    """Agrupar las fotos del área visible en celdas según el zoom"""
+    area = parse_bbox(bbox)
+    # Celdas cuadradas de tamaño fijo en pantalla: se dividen a la mitad en cada nivel de zoom
+    celda = 360 / (2 ** zoom) / MAPA_CELDAS_POR_TESELA
+    
     pipeline = [
+        {"$match": filtro_bbox(current_user.familia_id, area)},
+        # Ordenar solo los campos del grupo, no documentos enteros (límite de 100 MB del $sort)
+        {"$project": {
+            "_id": 0, "id": 1, "ubicacion": 1, "miniatura_url": 1, "archivo_url": 1,
+            "fecha_captura": 1, "fecha_subida": 1
+        }},
+        {"$sort": {"fecha_captura": -1, "fecha_subida": -1}},
         {
-            "$lookup": {
-                "from": "albumes",
-                "localField": "album_id",
-                "foreignField": "id",
-                "as": "album"
+            "$group": {
+                "_id": {
+                    # Los puntos justo en lng 180 o lat 90 van a la última celda, no a una de fuera
+                    "x": {"$min": [{"$floor": {"$divide": [{"$add": ["$ubicacion.lng", 180]}, celda]}}, 360 / celda - 1]},
+                    "y": {"$min": [{"$floor": {"$divide": [{"$add": ["$ubicacion.lat", 90]}, celda]}}, 180 / celda - 1]}
+                },
+                "total": {"$sum": 1},
+                "lat": {"$avg": "$ubicacion.lat"},
+                "lng": {"$avg": "$ubicacion.lng"},
+                "foto_id": {"$first": "$id"},
+                "miniatura_url": {"$first": "$miniatura_url"},
+                "archivo_url": {"$first": "$archivo_url"}
             }
         },
-        {
-            "$match": {
-                "album.familia_id": current_user.familia_id,
-                "ubicacion": {"$ne": None}
+        {"$sort": {"total": -1}},
+        {"$limit": MAPA_MAX_CLUSTERS}
+    ]
+    
+    grupos = await db.fotos.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    clusters = []
+    for grupo in grupos:
+        x, y = int(grupo["_id"]["x"]), int(grupo["_id"]["y"])
+        clusters.append({
+            "id": f"{zoom}:{x}:{y}",
+            "total": grupo["total"],
+            "lat": grupo["lat"],
+            "lng": grupo["lng"],
+            # Área de la celda para consultar sus puntos en /api/mapa/puntos
+            "bbox": [
+                x * celda - 180,
+                y * celda - 90,
+                min((x + 1) * celda - 180, 180),
+                min((y + 1) * celda - 90, 90)
+            ],
+            "portada": {
+                "foto_id": grupo["foto_id"],
+                "miniatura_url": grupo["miniatura_url"] or grupo["archivo_url"]
             }
+        })
+    
+    return RespuestaJSON({"zoom": zoom, "clusters": clusters})
+
+@app.get("/api/mapa/puntos")
+async def get_puntos_mapa(
+    bbox: str,
+    limite: int = Query(200, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
+    """Obtener las fotos individuales dentro de un área (p. ej. un cluster)"""
+    area = parse_bbox(bbox)
+    fotos = await db.fotos.find(
+        filtro_bbox(current_user.familia_id, area),
+        {
+            "_id": 0, "id": 1, "ubicacion": 1, "lugar_nombre": 1,
+            "miniatura_url": 1, "archivo_url": 1, "fecha_captura": 1, "fecha_subida": 1
         }
-    ]
+    ).sort(TIMELINE_ORDEN).limit(limite).to_list(None)
+    return RespuestaJSON(fotos)
+
+# Endpoints de Búsqueda
+@app.get("/api/buscar")
+async def buscar(
+    q: str = Query(..., min_length=1, max_length=200),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    pagina: int = Query(1, ge=1),
+    limite: int = Query(30, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
+):
+    """Buscar fotos y álbumes de la familia por texto, ordenados por relevancia"""
+    saltar = (pagina - 1) * limite
+    if saltar + limite > BUSQUEDA_MAX_RESULTADOS:
+        raise HTTPException(status_code=400, detail="Página fuera de rango: acota la búsqueda")
+    
+    texto = {"$search": q, "$language": BUSQUEDA_IDIOMA}
+    puntuacion = {"$meta": "textScore"}
+    filtro = {"familia_id": current_user.familia_id, "$text": texto}
+    if desde or hasta:
+        filtro["fecha_captura"] = {
+            operador: fecha for operador, fecha in (("$gte", desde), ("$lte", hasta)) if fecha
+        }
+    
+    # Pedir un resultado extra para saber si hay más páginas
+    fotos = await db.fotos.find(
+        filtro, {**PROYECCION_FOTO_LIGERA, "puntuacion": puntuacion}
+    ).sort([("puntuacion", puntuacion), ("id", DESCENDING)]).skip(saltar).limit(limite + 1).to_list(None)
     
-    fotos = await db.fotos.aggregate(pipeline).to_list(None)
-    return fotos
+    # Los álbumes que coinciden solo se devuelven con la primera página
+    albumes = []
+    if pagina == 1:
+        albumes = await db.albumes.find(
+            {"familia_id": current_user.familia_id, "$text": texto},
+            {"_id": 0, "puntuacion": puntuacion}
+        ).sort([("puntuacion", puntuacion)]).limit(BUSQUEDA_MAX_ALBUMES).to_list(None)
+    
+    return RespuestaJSON({
+        "fotos": fotos[:limite],
+        "albumes": albumes,
+        "pagina": pagina,
+        "siguiente_pagina": pagina + 1 if len(fotos) > limite else None
+    })
 
 # Endpoints de Comentarios y Reacciones
 @app.post("/api/fotos/{foto_id}/comentarios")
 async def add_comentario(
     foto_id: str,
     comentario_data: dict,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(verificar_acceso_foto)
 ):
     """Agregar comentario a una foto"""
-    # Verificar acceso a la foto
-    foto = await db.fotos.find_one({"id": foto_id})
-    if not foto:
-        raise HTTPException(status_code=404, detail="Foto no encontrada")
-    
-    album = await db.albumes.find_one({"id": foto["album_id"], "familia_id": current_user.familia_id})
-    if not album:
-        raise HTTPException(status_code=403, detail="Sin acceso")
-    
     nuevo_comentario = Comentario(
         foto_id=foto_id,
         usuario_id=current_user.id,
@@ -586,61 +2393,1179 @@ async def add_comentario(
     )
     
     await db.comentarios.insert_one(nuevo_comentario.dict())
+    await db.fotos.update_one({"id": foto_id}, {"$inc": {"total_comentarios": 1}})
+    canal_eventos.publicar(current_user.familia_id, "comentario", nuevo_comentario.dict())
     return nuevo_comentario.dict()
 
 @app.get("/api/fotos/{foto_id}/comentarios")
-async def get_comentarios(foto_id: str, current_user: User = Depends(get_current_user)):
+async def get_comentarios(foto_id: str, current_user: User = Depends(verificar_acceso_foto)):
     """Obtener comentarios de una foto"""
-    # Verificar acceso
-    foto = await db.fotos.find_one({"id": foto_id})
-    if not foto:
-        raise HTTPException(status_code=404, detail="Foto no encontrada")
-    
-    album = await db.albumes.find_one({"id": foto["album_id"], "familia_id": current_user.familia_id})
-    if not album:
-        raise HTTPException(status_code=403, detail="Sin acceso")
-    
-    comentarios = await db.comentarios.find({"foto_id": foto_id}).to_list(None)
-    return [Comentario(**c).dict() for c in comentarios]
+    comentarios = await db.comentarios.find({"foto_id": foto_id}, SIN_ID).sort("fecha_creacion", ASCENDING).to_list(None)
+    return RespuestaJSON(comentarios)
 
 @app.post("/api/fotos/{foto_id}/reacciones")
 async def add_reaccion(
     foto_id: str,
     reaccion_data: dict,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(verificar_acceso_foto)
 ):
     """Agregar/actualizar reacción a una foto"""
-    # Verificar acceso
-    foto = await db.fotos.find_one({"id": foto_id})
-    if not foto:
-        raise HTTPException(status_code=404, detail="Foto no encontrada")
+    tipo = reaccion_data.get("tipo")
+    if tipo not in TIPOS_REACCION:
+        raise HTTPException(status_code=400, detail="Tipo de reacción inválido")
     
-    album = await db.albumes.find_one({"id": foto["album_id"], "familia_id": current_user.familia_id})
-    if not album:
-        raise HTTPException(status_code=403, detail="Sin acceso")
+    # Crear o actualizar la reacción en una sola operación atómica
+    nueva_reaccion = Reaccion(foto_id=foto_id, usuario_id=current_user.id, tipo=tipo)
+    filtro = {"foto_id": foto_id, "usuario_id": current_user.id}
+    actualizacion = {
+        "$set": {"tipo": tipo},
+        "$setOnInsert": {"id": nueva_reaccion.id, "fecha_creacion": nueva_reaccion.fecha_creacion}
+    }
+    try:
+        anterior = await db.reacciones.find_one_and_update(
+            filtro, actualizacion, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Doble toque: la otra petición insertó primero, ahora es una actualización
+        anterior = await db.reacciones.find_one_and_update(
+            filtro, actualizacion, return_document=ReturnDocument.BEFORE
+        )
+    
+    # Mantener los contadores por tipo de la foto
+    evento = {"foto_id": foto_id, "usuario_id": current_user.id, "tipo": tipo, "anterior": None}
+    if anterior is None:
+        await db.fotos.update_one({"id": foto_id}, {"$inc": {f"reacciones.{tipo}": 1}})
+        canal_eventos.publicar(current_user.familia_id, "reaccion", evento)
+        return nueva_reaccion.dict()
+    
+    if anterior["tipo"] != tipo:
+        await db.fotos.update_one(
+            {"id": foto_id},
+            {"$inc": {f"reacciones.{tipo}": 1, f"reacciones.{anterior['tipo']}": -1}}
+        )
+        canal_eventos.publicar(current_user.familia_id, "reaccion", {**evento, "anterior": anterior["tipo"]})
+    return {"mensaje": "Reacción actualizada"}
+
+# Eventos de la familia en tiempo real (Server-Sent Events)
+class SuscripcionEventos:
+    def __init__(self):
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=EVENTOS_COLA_MAX)
+        self.desbordada = False
+
+class CanalEventos:
+    """Pub/sub en memoria por familia_id con historial para reanudar.
+
+    Solo reparte entre las conexiones de este proceso: con varios workers cada
+    cliente recibe los eventos publicados por el worker que lo atiende.
+    """
+    def __init__(self):
+        self.epoca = uuid.uuid4().hex[:8]  # distingue ids de otro proceso o de antes de reiniciar
+        self._secuencia = 0
+        self._historial: Dict[str, deque] = {}
+        self._descartado: Dict[str, int] = {}  # última secuencia que salió del historial
+        self._suscripciones: Dict[str, set] = {}
+    
+    @property
+    def ultima_secuencia(self) -> int:
+        return self._secuencia
+    
+    def id_evento(self, secuencia: int) -> str:
+        return f"{self.epoca}-{secuencia}"
     
-    # Verificar si ya existe reacción del usuario
-    existing_reaction = await db.reacciones.find_one({
-        "foto_id": foto_id,
-        "usuario_id": current_user.id
+    def publicar(self, familia_id: str, tipo: str, datos: Dict[str, Any]):
+        self._secuencia += 1
+        evento = (self._secuencia, tipo, serializar_json(datos))
+        historial = self._historial.get(familia_id)
+        if historial is None:
+            historial = self._historial[familia_id] = deque(maxlen=EVENTOS_HISTORIAL)
+        if len(historial) == historial.maxlen:
+            self._descartado[familia_id] = historial[0][0]
+        historial.append(evento)
+        
+        for suscripcion in self._suscripciones.get(familia_id, ()):
+            if suscripcion.desbordada:
+                continue
+            try:
+                suscripcion.cola.put_nowait(evento)
+            except asyncio.QueueFull:
+                # Cliente lento: se corta su conexión y al reconectar se pone al día con el historial
+                suscripcion.desbordada = True
+                clientes_eventos_lentos.inc()
+    
+    def suscribir(self, familia_id: str) -> SuscripcionEventos:
+        suscripcion = SuscripcionEventos()
+        self._suscripciones.setdefault(familia_id, set()).add(suscripcion)
+        return suscripcion
+    
+    def cancelar(self, familia_id: str, suscripcion: SuscripcionEventos):
+        suscripciones = self._suscripciones.get(familia_id)
+        if suscripciones is not None:
+            suscripciones.discard(suscripcion)
+            if not suscripciones:
+                del self._suscripciones[familia_id]
+    
+    def posteriores(self, familia_id: str, ultimo_id: str) -> Optional[List[tuple]]:
+        """Eventos publicados después de ultimo_id, o None si ya no se pueden reconstruir"""
+        try:
+            epoca, secuencia = ultimo_id.rsplit("-", 1)
+            secuencia = int(secuencia)
+        except ValueError:
+            return None
+        if epoca != self.epoca or secuencia < self._descartado.get(familia_id, 0):
+            return None
+        return [evento for evento in self._historial.get(familia_id, ()) if evento[0] > secuencia]
+
+canal_eventos = CanalEventos()
+
+def publicar_fotos_subidas(current_user: User, album_id: str, fotos: List[Dict[str, Any]]):
+    canal_eventos.publicar(current_user.familia_id, "fotos", {
+        "album_id": album_id,
+        "subida_por": current_user.id,
+        "fotos": [
+            {campo: foto.get(campo) for campo in ("id", "nombre_archivo", "miniatura_url", "derivados", "fecha_captura")}
+            for foto in fotos
+        ]
+    })
+
+def formatear_evento(secuencia: int, tipo: str, datos: bytes) -> bytes:
+    return f"id: {canal_eventos.id_evento(secuencia)}\nevent: {tipo}\ndata: ".encode() + datos + b"\n\n"
+
+async def stream_eventos(familia_id: str, ultimo_id: Optional[str]) -> AsyncIterator[bytes]:
+    # Suscribirse antes de leer el historial para no perder lo que se publique entretanto
+    suscripcion = canal_eventos.suscribir(familia_id)
+    try:
+        yield f"retry: {EVENTOS_REINTENTO_MS}\n\n".encode()
+        enviado = 0
+        if ultimo_id:
+            pendientes = canal_eventos.posteriores(familia_id, ultimo_id)
+            if pendientes is None:
+                # Se perdieron eventos (reinicio o desconexión larga): el cliente debe recargar
+                yield formatear_evento(canal_eventos.ultima_secuencia, "resincronizar", b"{}")
+            else:
+                for evento in pendientes:
+                    yield formatear_evento(*evento)
+                    enviado = evento[0]
+        
+        while not (suscripcion.desbordada and suscripcion.cola.empty()):
+            try:
+                evento = await asyncio.wait_for(suscripcion.cola.get(), EVENTOS_KEEPALIVE_SEGUNDOS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if evento[0] > enviado:
+                yield formatear_evento(*evento)
+                enviado = evento[0]
+    finally:
+        canal_eventos.cancelar(familia_id, suscripcion)
+
+@app.get("/api/eventos")
+async def get_eventos(
+    ultimo_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user_url("eventos"))
+):
+    """Eventos de la familia (comentarios, reacciones y fotos nuevas) como Server-Sent Events"""
+    return StreamingResponse(
+        stream_eventos(current_user.familia_id, last_event_id or ultimo_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Cola de trabajos en segundo plano (persistente en Mongo)
+# Un trabajo se reclama con un lease que su trabajador renueva mientras lo ejecuta; si el
+# proceso cae, el lease vence y otro lo retoma. Los manejadores deben ser idempotentes:
+# un trabajo puede ejecutarse más de una vez.
+PROYECCION_TRABAJO = {
+    "_id": 0, "id": 1, "tipo": 1, "estado": 1, "intentos": 1, "max_intentos": 1, "error": 1,
+    "resultado": 1, "disponible_desde": 1, "fecha_creacion": 1, "fecha_fin": 1
+}
+
+def nuevo_trabajo(tipo: str, datos: Dict[str, Any], clave: str, familia_id: Optional[str] = None) -> Dict[str, Any]:
+    ahora = datetime.now(timezone.utc)
+    return {
+        "id": str(uuid.uuid4()),
+        "tipo": tipo,
+        "datos": datos,
+        "clave": clave,  # única: encolar dos veces lo mismo no duplica el trabajo
+        "familia_id": familia_id,
+        "estado": "pendiente",  # pendiente, en_curso, completado, fallido
+        "intentos": 0,
+        "max_intentos": TRABAJOS_MAX_INTENTOS,
+        "disponible_desde": ahora,
+        "lease_hasta": None,
+        "trabajador": None,
+        "error": None,
+        "resultado": None,
+        "fecha_creacion": ahora,
+        "fecha_fin": None,
+    }
+
+def trabajo_procesar_foto(foto_id: str, familia_id: str) -> Dict[str, Any]:
+    return nuevo_trabajo("procesar_foto", {"foto_id": foto_id}, f"procesar_foto:{foto_id}", familia_id)
+
+async def encolar_trabajos(trabajos: List[Dict[str, Any]]):
+    operaciones = [UpdateOne({"clave": trabajo["clave"]}, {"$setOnInsert": trabajo}, upsert=True) for trabajo in trabajos]
+    try:
+        await db.trabajos.bulk_write(operaciones, ordered=False)
+    except BulkWriteError as e:
+        # Dos procesos encolaron la misma clave a la vez: el trabajo ya existe
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+    cola_trabajos.avisar()
+
+def espera_reintento(intentos: int) -> float:
+    espera = min(TRABAJOS_REINTENTO_BASE_SEGUNDOS * 2 ** (intentos - 1), TRABAJOS_REINTENTO_MAX_SEGUNDOS)
+    return espera * random.uniform(0.5, 1.5)  # jitter: los fallos simultáneos no se reintentan a la vez
+
+class ColaTrabajos:
+    """Trabajadores asyncio de este proceso que reclaman trabajos de la colección trabajos"""
+    def __init__(self, manejadores: Dict[str, Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]]):
+        self.manejadores = manejadores
+        self._tareas: List[asyncio.Task] = []
+        self._aviso: Optional[asyncio.Event] = None
+        self._en_curso_familia: Dict[str, int] = {}
+
+    def iniciar(self, workers: int):
+        self._aviso = asyncio.Event()
+        prefijo = f"{socket.gethostname()}:{os.getpid()}"
+        self._tareas = [asyncio.create_task(self._bucle(f"{prefijo}:{n}")) for n in range(workers)]
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+    async def esperar(self):
+        await asyncio.gather(*self._tareas)
+
+    def avisar(self):
+        """Despertar a los trabajadores de este proceso sin esperar al siguiente sondeo"""
+        if self._aviso is not None:
+            self._aviso.set()
+
+    async def _bucle(self, trabajador: str):
+        while True:
+            self._aviso.clear()
+            try:
+                trabajo = await self._reclamar(trabajador)
+                if trabajo is not None:
+                    familia_id = trabajo.get("familia_id")
+                    if familia_id:
+                        self._en_curso_familia[familia_id] = self._en_curso_familia.get(familia_id, 0) + 1
+                    try:
+                        await self._ejecutar(trabajo, trabajador)
+                    finally:
+                        if familia_id:
+                            saturada = self._en_curso_familia[familia_id] >= TRABAJOS_MAX_POR_FAMILIA
+                            self._en_curso_familia[familia_id] -= 1
+                            if not self._en_curso_familia[familia_id]:
+                                del self._en_curso_familia[familia_id]
+                            if saturada:
+                                self.avisar()  # quien saltaba sus trabajos ya puede tomarlos
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el trabajador {trabajador}: {str(e)}")
+            try:
+                await asyncio.wait_for(self._aviso.wait(), TRABAJOS_SONDEO_SEGUNDOS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _reclamar(self, trabajador: str) -> Optional[Dict[str, Any]]:
+        ahora = datetime.now(timezone.utc)
+        cambios = {
+            "$set": {"estado": "en_curso", "trabajador": trabajador, "lease_hasta": ahora + timedelta(seconds=TRABAJOS_LEASE_SEGUNDOS)},
+            "$inc": {"intentos": 1},
+        }
+        # Las familias que ya tienen TRABAJOS_MAX_POR_FAMILIA en curso aquí esperan: una subida
+        # masiva no retrasa el procesamiento de las demás (el límite es aproximado entre trabajadores)
+        saturadas = [f for f, total in self._en_curso_familia.items() if total >= TRABAJOS_MAX_POR_FAMILIA]
+        filtro = {"familia_id": {"$nin": saturadas}} if saturadas else {}
+        # Primero los abandonados por un trabajador caído, luego los pendientes por orden de llegada
+        trabajo = await db.trabajos.find_one_and_update(
+            {"estado": "en_curso", "lease_hasta": {"$lt": ahora}, **filtro}, cambios,
+            return_document=ReturnDocument.AFTER
+        )
+        if trabajo is None:
+            trabajo = await db.trabajos.find_one_and_update(
+                {"estado": "pendiente", "disponible_desde": {"$lte": ahora}, **filtro}, cambios,
+                sort=[("disponible_desde", ASCENDING)], return_document=ReturnDocument.AFTER
+            )
+        return trabajo
+
+    async def _renovar_lease(self, trabajo_id: str, trabajador: str):
+        while True:
+            await asyncio.sleep(TRABAJOS_LEASE_SEGUNDOS / 3)
+            await db.trabajos.update_one(
+                {"id": trabajo_id, "trabajador": trabajador, "estado": "en_curso"},
+                {"$set": {"lease_hasta": datetime.now(timezone.utc) + timedelta(seconds=TRABAJOS_LEASE_SEGUNDOS)}}
+            )
+
+    async def _terminar(self, trabajo: Dict[str, Any], trabajador: str, cambios: Dict[str, Any]):
+        # Si el lease venció y otro trabajador lo retomó, el resultado de este intento se descarta
+        await db.trabajos.update_one(
+            {"id": trabajo["id"], "trabajador": trabajador, "estado": "en_curso"},
+            {"$set": {"lease_hasta": None, **cambios}}
+        )
+
+    async def _ejecutar(self, trabajo: Dict[str, Any], trabajador: str):
+        tipo = trabajo["tipo"]
+        if trabajo["intentos"] > trabajo["max_intentos"]:
+            # Solo pasa si el proceso murió en cada intento (p. ej. una imagen que agota la memoria)
+            trabajos_terminados.inc(tipo, "fallido")
+            await self._terminar(trabajo, trabajador, {
+                "estado": "fallido", "error": "Lease vencido en todos los intentos", "fecha_fin": datetime.now(timezone.utc)
+            })
+            return
+
+        renovacion = asyncio.create_task(self._renovar_lease(trabajo["id"], trabajador))
+        inicio = time.perf_counter()
+        try:
+            manejador = self.manejadores.get(tipo)
+            if manejador is None:
+                raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+            resultado = await manejador(trabajo["datos"])
+        except asyncio.CancelledError:
+            # Apagado ordenado: se devuelve a la cola sin gastar el intento
+            await asyncio.shield(db.trabajos.update_one(
+                {"id": trabajo["id"], "trabajador": trabajador, "estado": "en_curso"},
+                {"$set": {"estado": "pendiente", "lease_hasta": None}, "$inc": {"intentos": -1}}
+            ))
+            raise
+        except Exception as e:
+            ahora = datetime.now(timezone.utc)
+            if trabajo["intentos"] < trabajo["max_intentos"]:
+                logger.warning(f"Trabajo {tipo} {trabajo['id']} falló (intento {trabajo['intentos']}): {str(e)}")
+                trabajos_terminados.inc(tipo, "reintento")
+                await self._terminar(trabajo, trabajador, {
+                    "estado": "pendiente",
+                    "error": str(e),
+                    "disponible_desde": ahora + timedelta(seconds=espera_reintento(trabajo["intentos"]))
+                })
+            else:
+                logger.error(f"Trabajo {tipo} {trabajo['id']} fallido tras {trabajo['intentos']} intentos: {str(e)}")
+                trabajos_terminados.inc(tipo, "fallido")
+                await self._terminar(trabajo, trabajador, {"estado": "fallido", "error": str(e), "fecha_fin": ahora})
+        else:
+            trabajos_terminados.inc(tipo, "completado")
+            await self._terminar(trabajo, trabajador, {
+                "estado": "completado", "resultado": resultado, "error": None, "fecha_fin": datetime.now(timezone.utc)
+            })
+        finally:
+            renovacion.cancel()
+            latencia_trabajos.observar(time.perf_counter() - inicio, tipo)
+
+async def procesar_foto_subida(datos: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Trabajo procesar_foto: metadatos, derivados, hash perceptual e índices de una foto subida"""
+    foto = await db.fotos.find_one({"id": datos["foto_id"]}, {"_id": 0})
+    if foto is None or foto.get("estado_procesamiento") != "pendiente":
+        return None  # borrada, o ya procesada por un intento anterior
+    ruta = ruta_foto_local(foto)
+    if ruta is None:
+        raise FileNotFoundError(f"Archivo de la foto {foto['id']} no encontrado")
+
+    campos = await procesar_archivo_foto(ruta, foto.get("texto_busqueda"))
+    procesada = Foto(**{**foto, **campos})
+    hashes_familia = await get_indice_hashes(foto["familia_id"])
+    avisos = posibles_duplicados(hashes_familia, [procesada])[0]
+
+    # Solo el intento que marca la foto como lista aplica los efectos que no son idempotentes
+    result = await db.fotos.update_one({"id": foto["id"], "estado_procesamiento": "pendiente"}, {"$set": campos})
+    if result.modified_count == 0:
+        return None
+    if procesada.dhash is not None:
+        hashes_familia.agregar(procesada.id, procesada.dhash)
+    await actualizar_resumen_timeline(foto["familia_id"], [procesada.dict()])
+    canal_eventos.publicar(foto["familia_id"], "foto_procesada", {
+        campo: getattr(procesada, campo) for campo in ("id", "album_id", "miniatura_url", "derivados", "fecha_captura")
     })
+    return {"foto_id": foto["id"], "posibles_duplicados": avisos}
+
+MANEJADORES_TRABAJOS = {
+    "procesar_foto": procesar_foto_subida,
+}
+
+cola_trabajos = ColaTrabajos(MANEJADORES_TRABAJOS)
+
+async def encolar_fotos_pendientes():
+    """Encolar las fotos pendientes sin trabajo (caída entre guardar la foto y encolarla)"""
+    trabajos = [
+        trabajo_procesar_foto(foto["id"], foto["familia_id"])
+        async for foto in db.fotos.find({"estado_procesamiento": "pendiente"}, {"_id": 0, "id": 1, "familia_id": 1})
+    ]
+    if trabajos:
+        await encolar_trabajos(trabajos)
+        logger.info(f"Fotos pendientes de procesar: {len(trabajos)} (trabajos existentes no se duplican)")
+
+async def ejecutar_trabajador():
+    """Procesar la cola sin servir la API (p. ej. con TRABAJOS_WORKERS=0 en los procesos web)"""
+    cola_trabajos.iniciar(max(TRABAJOS_WORKERS, 1))
+    await cola_trabajos.esperar()
+
+@app.get("/api/trabajos/{trabajo_id}")
+async def get_trabajo(trabajo_id: str, current_user: User = Depends(get_current_user)):
+    """Estado de un trabajo en segundo plano de la familia"""
+    trabajo = await db.trabajos.find_one({"id": trabajo_id, "familia_id": current_user.familia_id}, PROYECCION_TRABAJO)
+    if not trabajo:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return RespuestaJSON(trabajo)
+
+# Exportación en ZIP (en streaming, sin archivos temporales)
+EXTENSIONES_SIN_COMPRIMIR = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp4", ".mov", ".m4v"}
+CAMPOS_MANIFIESTO = [
+    "archivo", "id", "album", "nombre_archivo", "fecha_captura", "fecha_subida", "lat", "lng",
+    "lugar_nombre", "personas_etiquetadas", "descripcion", "anecdota", "camara"
+]
+PROYECCION_EXPORTACION = {
+    "_id": 0, "id": 1, "nombre_archivo": 1, "archivo_url": 1, "fecha_captura": 1, "fecha_subida": 1,
+    "ubicacion": 1, "lugar_nombre": 1, "personas_etiquetadas": 1, "descripcion": 1, "anecdota": 1,
+    "metadata.camera_make": 1, "metadata.camera_model": 1
+}
+
+class SalidaZip(io.RawIOBase):
+    """Destino no posicionable para zipfile: guarda lo escrito hasta que se envía.
+
+    Al no poder retroceder, zipfile escribe el CRC y los tamaños en un descriptor
+    tras los datos de cada entrada, así que nunca hace falta tener una entrada entera.
+    """
+    def __init__(self):
+        self._partes: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, datos) -> int:
+        self._partes.append(bytes(datos))
+        return len(datos)
+    
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes.clear()
+        return datos
+
+def nombre_seguro(texto: Optional[str], alternativo: str) -> str:
+    limpio = "".join("_" if c in '/\\:*?"<>|' or ord(c) < 32 else c for c in (texto or "")).strip(" .")
+    return limpio[:120] or alternativo
+
+def nombre_unico(nombre: str, usados: set) -> str:
+    base, extension = os.path.splitext(nombre)
+    candidato, n = nombre, 1
+    while candidato.lower() in usados:
+        n += 1
+        candidato = f"{base} ({n}){extension}"
+    usados.add(candidato.lower())
+    return candidato
+
+def fecha_zip(foto: Dict[str, Any]) -> tuple:
+    fecha = foto.get("fecha_captura") or foto["fecha_subida"]
+    # El formato ZIP no admite fechas anteriores a 1980
+    return max(fecha.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+def ruta_foto_local(foto: Dict[str, Any]) -> Optional[Path]:
+    relativa = foto["archivo_url"].split("/api/fotos/files/", 1)[-1]
+    ruta = UPLOAD_DIR / relativa
+    if UPLOAD_DIR.resolve() not in ruta.resolve().parents or not ruta.is_file():
+        return None
+    return ruta
+
+async def entradas_exportacion(albumes: List[Dict[str, Any]]) -> AsyncIterator[tuple]:
+    """(album, foto, ruta dentro del ZIP) en un orden estable, para poder recorrerlo varias veces"""
+    carpetas = set()
+    for album in albumes:
+        carpeta = nombre_unico(nombre_seguro(album.get("titulo"), "Álbum"), carpetas)
+        usados = set()
+        async for foto in db.fotos.find({"album_id": album["id"]}, PROYECCION_EXPORTACION).sort(TIMELINE_ORDEN):
+            nombre = nombre_unico(nombre_seguro(foto.get("nombre_archivo"), foto["id"]), usados)
+            yield album, foto, f"{carpeta}/{nombre}"
+
+def fila_manifiesto(album: Dict[str, Any], foto: Dict[str, Any], archivo: str) -> Dict[str, Any]:
+    ubicacion = foto.get("ubicacion") or {}
+    metadata = foto.get("metadata") or {}
+    fecha_captura = foto.get("fecha_captura")
+    return {
+        "archivo": archivo,
+        "id": foto["id"],
+        "album": album.get("titulo"),
+        "nombre_archivo": foto.get("nombre_archivo"),
+        "fecha_captura": fecha_captura.isoformat() if fecha_captura else None,
+        "fecha_subida": foto["fecha_subida"].isoformat(),
+        "lat": ubicacion.get("lat"),
+        "lng": ubicacion.get("lng"),
+        "lugar_nombre": foto.get("lugar_nombre"),
+        "personas_etiquetadas": "; ".join(foto.get("personas_etiquetadas") or []),
+        "descripcion": foto.get("descripcion"),
+        "anecdota": foto.get("anecdota"),
+        "camara": " ".join(filter(None, [metadata.get("camera_make"), metadata.get("camera_model")])) or None,
+    }
+
+async def stream_zip(albumes: List[Dict[str, Any]], manifiesto: str) -> AsyncIterator[bytes]:
+    """ZIP de las fotos de los álbumes más un manifiesto, con memoria constante"""
+    salida = SalidaZip()
+    with zipfile.ZipFile(salida, mode="w", allowZip64=True) as zip_salida:
+        async for _, foto, nombre in entradas_exportacion(albumes):
+            ruta = await asyncio.to_thread(ruta_foto_local, foto)
+            if ruta is None:
+                logger.warning(f"Exportación: falta el archivo de la foto {foto['id']}")
+                continue
+            tamano = (await asyncio.to_thread(ruta.stat)).st_size
+            info = zipfile.ZipInfo(nombre, date_time=fecha_zip(foto))
+            # JPEG, vídeos, etc. ya están comprimidos: se guardan tal cual
+            info.compress_type = (
+                zipfile.ZIP_STORED if ruta.suffix.lower() in EXTENSIONES_SIN_COMPRIMIR else zipfile.ZIP_DEFLATED
+            )
+            info.file_size = tamano  # zipfile decide con esto si la entrada necesita ZIP64
+            with zip_salida.open(info, "w") as entrada:
+                async for chunk in leer_rango(ruta, 0, tamano):
+                    entrada.write(chunk)
+                    yield salida.vaciar()
+            yield salida.vaciar()
+        
+        # Segunda pasada para el manifiesto: no se guardan filas en memoria
+        info = zipfile.ZipInfo(f"manifiesto.{manifiesto}", date_time=datetime.now(timezone.utc).timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zip_salida.open(info, "w") as entrada:
+            texto = io.TextIOWrapper(entrada, encoding="utf-8", newline="")
+            if manifiesto == "csv":
+                escritor = csv.DictWriter(texto, fieldnames=CAMPOS_MANIFIESTO)
+                escritor.writeheader()
+            else:
+                texto.write("[")
+            primera = True
+            async for album, foto, nombre in entradas_exportacion(albumes):
+                archivo = nombre if await asyncio.to_thread(ruta_foto_local, foto) else None
+                fila = fila_manifiesto(album, foto, archivo)
+                if manifiesto == "csv":
+                    escritor.writerow(fila)
+                else:
+                    texto.write(("" if primera else ",") + "\n" + json.dumps(fila, ensure_ascii=False))
+                primera = False
+                texto.flush()
+                yield salida.vaciar()
+            if manifiesto == "json":
+                texto.write("\n]\n")
+            texto.flush()
+            texto.detach()
+    yield salida.vaciar()
+
+def respuesta_zip(albumes: List[Dict[str, Any]], nombre: str, manifiesto: str) -> StreamingResponse:
+    nombre_zip = f"{nombre_seguro(nombre, 'memoria-viva')}.zip"
+    return StreamingResponse(
+        (chunk async for chunk in stream_zip(albumes, manifiesto) if chunk),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename=\"memoria-viva.zip\"; filename*=UTF-8''{quote(nombre_zip)}",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@app.get("/api/albumes/{album_id}/export")
+async def exportar_album(
+    album_id: str,
+    manifiesto: str = Query("csv", pattern="^(csv|json)$"),
+    current_user: User = Depends(get_current_user_url("export_album:{album_id}"))
+):
+    """Descargar un álbum completo como ZIP"""
+    album = await db.albumes.find_one({"id": album_id, "familia_id": current_user.familia_id}, SIN_ID)
+    if not album:
+        raise HTTPException(status_code=404, detail="Álbum no encontrado")
+    return respuesta_zip([album], album["titulo"], manifiesto)
+
+@app.get("/api/familia/export")
+async def exportar_familia(
+    manifiesto: str = Query("csv", pattern="^(csv|json)$"),
+    current_user: User = Depends(get_current_user_url("export_familia"))
+):
+    """Descargar todos los álbumes de la familia como un único ZIP"""
+    albumes = await db.albumes.find(
+        {"familia_id": current_user.familia_id}, {"_id": 0, "id": 1, "titulo": 1}
+    ).sort("fecha_creacion", ASCENDING).to_list(None)
+    familia = await get_familia_doc(current_user.familia_id)
+    return respuesta_zip(albumes, familia["nombre"] if familia else "familia", manifiesto)
+
+# Índices y migraciones
+INDICES = {
+    "usuarios": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("email", ASCENDING)], {"unique": True}),
+        ([("familia_id", ASCENDING)], {}),
+    ],
+    "familias": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("codigo_invitacion", ASCENDING)], {"unique": True}),
+    ],
+    "albumes": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("familia_id", ASCENDING)], {}),
+        (
+            [("familia_id", ASCENDING), ("titulo", TEXT), ("descripcion", TEXT), ("etiquetas", TEXT)],
+            {
+                "name": "busqueda_texto",
+                "default_language": BUSQUEDA_IDIOMA,
+                "language_override": "idioma_busqueda",
+                "weights": {"titulo": 5, "etiquetas": 3, "descripcion": 1},
+            }
+        ),
+    ],
+    "fotos": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("album_id", ASCENDING), ("fecha_captura", DESCENDING), ("fecha_subida", DESCENDING), ("id", DESCENDING)], {}),
+        ([("familia_id", ASCENDING), ("fecha_captura", DESCENDING), ("fecha_subida", DESCENDING), ("id", DESCENDING)], {}),
+        ([("familia_id", ASCENDING), ("ubicacion.lng", ASCENDING), ("ubicacion.lat", ASCENDING)], {}),
+        ([("familia_id", ASCENDING), ("dia_captura", ASCENDING), ("fecha_captura", DESCENDING)], {}),
+        ([("estado_procesamiento", ASCENDING)], {"partialFilterExpression": {"estado_procesamiento": "pendiente"}}),
+        # Índice de texto v3: insensible a tildes y mayúsculas, con prefijo de igualdad por familia
+        (
+            [
+                ("familia_id", ASCENDING),
+                ("descripcion", TEXT),
+                ("anecdota", TEXT),
+                ("lugar_nombre", TEXT),
+                ("personas_etiquetadas", TEXT),
+                ("texto_busqueda", TEXT),
+            ],
+            {
+                "name": "busqueda_texto",
+                "default_language": BUSQUEDA_IDIOMA,
+                "language_override": "idioma_busqueda",
+                "weights": {
+                    "descripcion": 5,
+                    "personas_etiquetadas": 4,
+                    "anecdota": 3,
+                    "lugar_nombre": 3,
+                    "texto_busqueda": 2,
+                },
+            }
+        ),
+    ],
+    "comentarios": [
+        ([("foto_id", ASCENDING), ("fecha_creacion", ASCENDING)], {}),
+    ],
+    "reacciones": [
+        ([("foto_id", ASCENDING), ("usuario_id", ASCENDING)], {"unique": True}),
+    ],
+    "resumen_timeline": [
+        ([("familia_id", ASCENDING), ("anio", DESCENDING), ("mes", DESCENDING)], {"unique": True}),
+    ],
+    "subidas": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("usuario_id", ASCENDING), ("fecha_actualizacion", ASCENDING)], {}),
+        ([("fecha_actualizacion", ASCENDING)], {}),
+    ],
+    "migraciones": [
+        ([("id", ASCENDING)], {"unique": True}),
+    ],
+    "blobs": [
+        ([("sha256", ASCENDING)], {"unique": True}),
+    ],
+    "trabajos": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("clave", ASCENDING)], {"unique": True}),
+        ([("estado", ASCENDING), ("disponible_desde", ASCENDING)], {}),
+        ([("estado", ASCENDING), ("lease_hasta", ASCENDING)], {}),
+        ([("fecha_fin", ASCENDING)], {"expireAfterSeconds": TRABAJOS_RETENCION_SEGUNDOS}),
+    ],
+}
+
+async def crear_indices(colecciones: Optional[List[str]] = None):
+    for coleccion in colecciones or INDICES:
+        for claves, opciones in INDICES[coleccion]:
+            try:
+                await db[coleccion].create_index(claves, **opciones)
+            except Exception as e:
+                # Un índice fallido (p. ej. duplicados heredados) no debe impedir el arranque
+                logger.error(f"Error creando índice {claves} en {coleccion}: {str(e)}")
+
+async def ejecutar_migracion(nombre: str, migracion: Callable[[], Awaitable[None]]):
+    """Ejecutar una migración de datos una sola vez entre todos los procesos y arranques"""
+    ahora = datetime.now(timezone.utc)
+    try:
+        # Sin coincidencia (terminada, o en curso en otro proceso) el upsert choca con el id único
+        await db.migraciones.update_one(
+            {"id": nombre, "estado": {"$ne": "terminada"}, "lease_hasta": {"$lt": ahora}},
+            {"$set": {
+                "estado": "en_curso",
+                "lease_hasta": ahora + timedelta(seconds=MIGRACIONES_LEASE_SEGUNDOS),
+                "fecha_inicio": ahora
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return
+    
+    try:
+        await migracion()
+    except Exception as e:
+        # El siguiente arranque la reintenta
+        logger.error(f"Error en la migración {nombre}: {str(e)}")
+        await db.migraciones.update_one({"id": nombre}, {"$set": {"estado": "fallida", "lease_hasta": ahora}})
+        return
+    await db.migraciones.update_one(
+        {"id": nombre},
+        {"$set": {"estado": "terminada", "lease_hasta": None, "fecha_fin": datetime.now(timezone.utc)}}
+    )
+
+async def migrar_familia_id_fotos():
+    """Completar familia_id en fotos creadas antes de desnormalizarlo"""
+    album_ids = await db.fotos.distinct("album_id", {"familia_id": None})
+    if not album_ids:
+        return
     
-    if existing_reaction:
-        # Actualizar reacción existente
-        await db.reacciones.update_one(
-            {"id": existing_reaction["id"]},
-            {"$set": {"tipo": reaccion_data["tipo"]}}
+    operaciones = [
+        UpdateMany(
+            {"album_id": album["id"], "familia_id": None},
+            {"$set": {"familia_id": album["familia_id"]}}
         )
-        return {"mensaje": "Reacción actualizada"}
-    else:
-        # Crear nueva reacción
-        nueva_reaccion = Reaccion(
-            foto_id=foto_id,
-            usuario_id=current_user.id,
-            tipo=reaccion_data["tipo"]
+        async for album in db.albumes.find({"id": {"$in": album_ids}}, {"id": 1, "familia_id": 1})
+    ]
+    if operaciones:
+        result = await db.fotos.bulk_write(operaciones, ordered=False)
+        logger.info(f"Migración familia_id: {result.modified_count} fotos actualizadas")
+
+async def migrar_texto_busqueda_fotos():
+    """Completar texto_busqueda en fotos subidas antes de la búsqueda de texto"""
+    album_ids = await db.fotos.distinct("album_id", {"texto_busqueda": None})
+    if not album_ids:
+        return
+    
+    anio_captura = {"$ifNull": [{"$toString": {"$year": "$fecha_captura"}}, ""]}
+    operaciones = [
+        UpdateMany(
+            {"album_id": album["id"], "texto_busqueda": None},
+            [{"$set": {"texto_busqueda": {"$trim": {"input": {"$concat": [
+                {"$literal": texto_busqueda_album(album)}, " ", anio_captura
+            ]}}}}}]
         )
-        await db.reacciones.insert_one(nueva_reaccion.dict())
-        return nueva_reaccion.dict()
+        async for album in db.albumes.find({"id": {"$in": album_ids}}, {"id": 1, "titulo": 1, "etiquetas": 1})
+    ]
+    if operaciones:
+        result = await db.fotos.bulk_write(operaciones, ordered=False)
+        logger.info(f"Migración texto_busqueda: {result.modified_count} fotos actualizadas")
+
+async def migrar_dia_captura_fotos():
+    """Completar dia_captura en las fotos con fecha de captura anteriores a «en este día»"""
+    result = await db.fotos.update_many(
+        {"fecha_captura": {"$ne": None}, "dia_captura": None},
+        [{"$set": {"dia_captura": {"$dateToString": {"format": "%m-%d", "date": "$fecha_captura"}}}}]
+    )
+    if result.modified_count:
+        logger.info(f"Migración dia_captura: {result.modified_count} fotos actualizadas")
+
+async def reconstruir_resumen_timeline(familia_id: Optional[str] = None):
+    """Recalcular desde las fotos el resumen por año y mes (de una familia o de todas)"""
+    filtro = {"familia_id": familia_id} if familia_id else {"familia_id": {"$ne": None}}
+    grupos = db.fotos.aggregate([
+        {"$match": filtro},
+        {"$project": {
+            "familia_id": 1, "id": 1, "miniatura_url": 1,
+            "fecha": {"$ifNull": ["$fecha_captura", "$fecha_subida"]}
+        }},
+        # La misma regla que actualizar_resumen_timeline: la más antigua, con desempate por id
+        {"$sort": {"fecha": ASCENDING, "id": ASCENDING}},
+        {"$group": {
+            "_id": {"familia_id": "$familia_id", "anio": {"$year": "$fecha"}, "mes": {"$month": "$fecha"}},
+            "total": {"$sum": 1},
+            "portada": {"$first": {"fecha": "$fecha", "id": "$id", "miniatura_url": "$miniatura_url"}}
+        }}
+    ], allowDiskUse=True)
+    operaciones = [
+        UpdateOne(
+            grupo["_id"],
+            {"$set": {"total": grupo["total"], "portada": grupo["portada"]}},
+            upsert=True
+        )
+        async for grupo in grupos
+    ]
+    await db.resumen_timeline.delete_many({"familia_id": familia_id} if familia_id else {})
+    if operaciones:
+        await db.resumen_timeline.bulk_write(operaciones, ordered=False)
+    logger.info(f"Resumen del timeline reconstruido: {len(operaciones)} meses")
+
+async def migrar_resumen_timeline():
+    """Crear el resumen del timeline la primera vez que arranca con fotos existentes"""
+    if await db.resumen_timeline.find_one({}, {"_id": 1}) is None and await db.fotos.find_one({}, {"_id": 1}):
+        await reconstruir_resumen_timeline()
+
+async def migrar_portadas_timeline():
+    """Recalcular los resúmenes con portadas anteriores a la regla de la foto más antigua"""
+    for familia_id in await db.resumen_timeline.distinct("familia_id", {"portada.fecha": None}):
+        await reconstruir_resumen_timeline(familia_id)
+
+async def migrar_almacenamiento_plano():
+    """Mover las fotos del directorio plano de uploads al almacén por contenido"""
+    migradas = 0
+    async for foto in db.fotos.find({"sha256": None}, {"_id": 0, "id": 1, "archivo_url": 1}):
+        original = UPLOAD_DIR / foto["archivo_url"].rsplit("/", 1)[-1]
+        if not original.is_file():
+            logger.warning(f"Archivo de la foto {foto['id']} no encontrado: {original}")
+            continue
+        
+        sha256 = await asyncio.to_thread(hash_archivo, original)
+        # Enlace duro: el original sigue en su sitio hasta que la foto apunta al blob,
+        # así una interrupción a mitad de la migración no pierde archivos
+        temp_path = PARCIALES_DIR / f"{uuid.uuid4()}.part"
+        await asyncio.to_thread(os.link, original, temp_path)
+        ruta = await almacenar_blob(temp_path, sha256, normalizar_extension(original.name))
+        derivados = await crear_derivados(ruta)
+        
+        await db.fotos.update_one({"id": foto["id"]}, {"$set": {
+            "sha256": sha256,
+            "archivo_url": url_archivo(ruta),
+            "derivados": derivados,
+            "miniatura_url": derivados.get(str(min(DERIVADOS_TAMANOS)))
+        }})
+        original.unlink()
+        eliminar_derivados(original)
+        migradas += 1
+    
+    logger.info(f"Migración de almacenamiento: {migradas} fotos movidas al almacén por contenido")
+
+async def calcular_hashes_fotos(lote: int = 200):
+    """Calcular el hash perceptual de las fotos subidas antes de detectar duplicados"""
+    loop = asyncio.get_running_loop()
+    actualizadas = 0
+    pendientes = []
+    
+    async def procesar_lote():
+        nonlocal actualizadas
+        rutas = [ruta_foto_local(foto) for foto in pendientes]
+        hashes = await asyncio.gather(*(
+            loop.run_in_executor(get_process_pool(), calcular_dhash, str(ruta))
+            for ruta in rutas if ruta is not None
+        ), return_exceptions=True)
+        hashes = iter(hashes)
+        operaciones = []
+        for foto, ruta in zip(pendientes, rutas):
+            dhash = next(hashes) if ruta is not None else None
+            if isinstance(dhash, int):
+                operaciones.append(UpdateOne({"id": foto["id"]}, {"$set": {"dhash": dhash}}))
+            else:
+                logger.warning(f"No se pudo calcular el hash perceptual de la foto {foto['id']}")
+        if operaciones:
+            result = await db.fotos.bulk_write(operaciones, ordered=False)
+            actualizadas += result.modified_count
+        pendientes.clear()
+    
+    async for foto in db.fotos.find({"dhash": None}, {"_id": 0, "id": 1, "archivo_url": 1}):
+        pendientes.append(foto)
+        if len(pendientes) >= lote:
+            await procesar_lote()
+    if pendientes:
+        await procesar_lote()
+    logger.info(f"Hashes perceptuales: {actualizadas} fotos actualizadas")
+
+async def deduplicar_reacciones():
+    """Dejar una sola reacción por usuario y foto (requisito del índice único)"""
+    duplicadas = db.reacciones.aggregate([
+        {"$sort": {"fecha_creacion": -1}},
+        {"$group": {"_id": {"foto_id": "$foto_id", "usuario_id": "$usuario_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ])
+    sobrantes = []
+    async for grupo in duplicadas:
+        # Se conserva la más reciente
+        sobrantes.extend(grupo["ids"][1:])
+    if sobrantes:
+        await db.reacciones.delete_many({"_id": {"$in": sobrantes}})
+        logger.info(f"Eliminadas {len(sobrantes)} reacciones duplicadas")
+
+async def migrar_contadores_fotos():
+    """Calcular total_comentarios y reacciones en fotos creadas antes de los contadores"""
+    pendientes = await db.fotos.distinct("id", {"total_comentarios": None})
+    if not pendientes:
+        return
+    
+    comentarios = {
+        grupo["_id"]: grupo["total"]
+        async for grupo in db.comentarios.aggregate([
+            {"$match": {"foto_id": {"$in": pendientes}}},
+            {"$group": {"_id": "$foto_id", "total": {"$sum": 1}}}
+        ])
+    }
+    reacciones = {}
+    async for grupo in db.reacciones.aggregate([
+        {"$match": {"foto_id": {"$in": pendientes}}},
+        {"$group": {"_id": {"foto_id": "$foto_id", "tipo": "$tipo"}, "total": {"$sum": 1}}}
+    ]):
+        reacciones.setdefault(grupo["_id"]["foto_id"], {})[grupo["_id"]["tipo"]] = grupo["total"]
+    
+    operaciones = [
+        UpdateOne(
+            {"id": foto_id, "total_comentarios": None},
+            {"$set": {"total_comentarios": comentarios.get(foto_id, 0), "reacciones": reacciones.get(foto_id, {})}}
+        )
+        for foto_id in pendientes
+    ]
+    result = await db.fotos.bulk_write(operaciones, ordered=False)
+    logger.info(f"Migración de contadores: {result.modified_count} fotos actualizadas")
+
+# Importación masiva de un directorio o ZIP de fotos
+class OrigenImportacion:
+    """Directorio o ZIP a importar; las rutas son relativas y con "/" en ambos casos"""
+    def __init__(self, ruta: Path):
+        self.ruta = ruta
+        self.nombre = ruta.stem if ruta.is_file() else ruta.name
+        self._zip = zipfile.ZipFile(ruta) if ruta.is_file() else None
+
+    def listar(self) -> List[str]:
+        if self._zip is not None:
+            rutas = [info.filename for info in self._zip.infolist() if not info.is_dir()]
+        else:
+            rutas = [
+                (Path(carpeta) / nombre).relative_to(self.ruta).as_posix()
+                for carpeta, _, nombres in os.walk(self.ruta)
+                for nombre in nombres
+            ]
+        # Solo imágenes, sin archivos ocultos ni metadatos de macOS (__MACOSX/, ._foto.jpg)
+        return sorted(
+            relativa for relativa in rutas
+            if es_imagen(mimetypes.guess_type(relativa)[0])
+            and not any(parte.startswith((".", "__MACOSX")) for parte in relativa.split("/"))
+        )
+
+    def copiar(self, relativa: str, destino: Path) -> str:
+        """Copiar un archivo del origen calculando su sha256 (se ejecuta en un hilo)"""
+        hasher = hashlib.sha256()
+        abrir = (lambda: self._zip.open(relativa)) if self._zip is not None else (lambda: open(self.ruta / relativa, "rb"))
+        with abrir() as entrada, open(destino, "wb") as salida:
+            while chunk := entrada.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                salida.write(chunk)
+        return hasher.hexdigest()
+
+    def cerrar(self):
+        if self._zip is not None:
+            self._zip.close()
+
+def titulo_album_importado(origen: OrigenImportacion, relativa: str) -> str:
+    """Cada subcarpeta es un álbum ("Viajes/1985" -> "Viajes / 1985"); la raíz usa el nombre del origen"""
+    carpeta = relativa.rpartition("/")[0]
+    return carpeta.replace("/", " / ") if carpeta else origen.nombre
+
+async def album_importacion(titulo: str, usuario: User) -> Dict[str, Any]:
+    """Álbum de la familia con ese título, creado si no existe (al reanudar se reutiliza)"""
+    album = await db.albumes.find_one({"familia_id": usuario.familia_id, "titulo": titulo}, {"_id": 0})
+    if album is None:
+        album = Album(titulo=titulo, familia_id=usuario.familia_id, creador_id=usuario.id).dict()
+        await db.albumes.insert_one(album)
+        album.pop("_id", None)
+        logger.info(f"Álbum creado: {titulo}")
+    return album
+
+def leer_checkpoint(ruta: Path) -> set:
+    if not ruta.exists():
+        return set()
+    with open(ruta, encoding="utf-8") as archivo:
+        return {json.loads(linea) for linea in archivo if linea.strip()}
+
+async def importar_archivo(ruta_origen: Path, email: str, checkpoint: Optional[Path] = None, lote: int = IMPORTACION_LOTE):
+    """Importar un directorio o ZIP de fotos a la familia de un usuario, de forma reanudable
+
+    El checkpoint (JSON lines) guarda las rutas ya insertadas. Además, el id de cada foto
+    se deriva de su ruta: si el proceso cae entre el insert_many y el checkpoint, al
+    reanudar esas fotos dan clave duplicada y se cuentan como ya importadas.
+    """
+    user_doc = await db.usuarios.find_one({"email": email})
+    if user_doc is None:
+        logger.error(f"Usuario no encontrado: {email}")
+        return
+    if not ruta_origen.exists():
+        logger.error(f"No existe el origen a importar: {ruta_origen}")
+        return
+    usuario = User(**user_doc)
+    origen = OrigenImportacion(ruta_origen)
+    checkpoint = checkpoint or Path(f"importacion-{origen.nombre}.checkpoint.jsonl")
+    hechas = leer_checkpoint(checkpoint)
+    pendientes = [relativa for relativa in origen.listar() if relativa not in hechas]
+    logger.info(f"Importando {len(pendientes)} fotos de {ruta_origen} ({len(hechas)} ya importadas según {checkpoint})")
+
+    # Los álbumes se crean antes de repartir las fotos: si lo hiciera cada trabajador, varios
+    # verían a la vez que el álbum de su carpeta no existe y lo crearían dos veces
+    albumes: Dict[str, Dict[str, Any]] = {}
+    for relativa in pendientes:
+        titulo = titulo_album_importado(origen, relativa)
+        if titulo not in albumes:
+            albumes[titulo] = await album_importacion(titulo, usuario)
+    preparadas: List[tuple] = []  # [(relativa, Foto)] a la espera del siguiente insert_many
+    totales = {"importadas": 0, "repetidas": 0, "fallidas": 0}
+    inicio = time.perf_counter()
+
+    async def preparar(relativa: str) -> tuple:
+        album = albumes[titulo_album_importado(origen, relativa)]
+        temp_path = PARCIALES_DIR / f"{uuid.uuid4()}.part"
+        try:
+            sha256 = await asyncio.to_thread(origen.copiar, relativa, temp_path)
+            file_path = await almacenar_blob(temp_path, sha256, normalizar_extension(relativa))
+        finally:
+            temp_path.unlink(missing_ok=True)
+        try:
+            texto_album = texto_busqueda_album(album)
+            foto = registro_foto(file_path, relativa.rpartition("/")[2], album["id"], usuario, sha256=sha256, texto_album=texto_album)
+            campos = await procesar_archivo_foto(file_path, texto_album)
+        except Exception:
+            await liberar_blob(sha256)
+            raise
+        foto_id = str(uuid.uuid5(IMPORTACION_NAMESPACE, f"{usuario.familia_id}:{origen.nombre}:{relativa}"))
+        return relativa, Foto(**{**foto.dict(), **campos, "id": foto_id})
+
+    async def volcar():
+        lote_actual = preparadas[:]
+        preparadas.clear()
+        fallidas = {}
+        try:
+            await db.fotos.insert_many([foto.dict() for _, foto in lote_actual], ordered=False)
+        except BulkWriteError as e:
+            fallidas = {error["index"]: error.get("code") for error in e.details.get("writeErrors", [])}
+
+        insertadas, terminadas = [], []
+        for posicion, (relativa, foto) in enumerate(lote_actual):
+            codigo = fallidas.get(posicion, 0)
+            if codigo and codigo != 11000:
+                logger.error(f"Error guardando {relativa} (código {codigo})")
+                totales["fallidas"] += 1
+                await liberar_blob(foto.sha256)
+                continue
+            if codigo == 11000:
+                # Ya insertada en una ejecución anterior que no llegó a escribir el checkpoint
+                totales["repetidas"] += 1
+                await liberar_blob(foto.sha256)
+            else:
+                totales["importadas"] += 1
+                insertadas.append(foto.dict())
+            terminadas.append(relativa)
+
+        if insertadas:
+            await actualizar_resumen_timeline(usuario.familia_id, insertadas)
+        with open(checkpoint, "a", encoding="utf-8") as archivo:
+            archivo.writelines(json.dumps(relativa) + "\n" for relativa in terminadas)
+        procesadas = totales["importadas"] + totales["repetidas"] + totales["fallidas"]
+        transcurrido = time.perf_counter() - inicio
+        logger.info(
+            f"Importadas {procesadas}/{len(pendientes)} fotos "
+            f"({procesadas / transcurrido:.1f} fotos/s, {totales['fallidas']} con error)"
+        )
+
+    async def trabajador(entradas):
+        for relativa in entradas:
+            try:
+                preparadas.append(await preparar(relativa))
+            except Exception as e:
+                logger.error(f"Error importando {relativa}: {str(e)}")
+                totales["fallidas"] += 1
+                continue
+            if len(preparadas) >= lote:
+                await volcar()
+
+    # Los trabajadores comparten el iterador: cada ruta la toma uno solo
+    entradas = iter(pendientes)
+    try:
+        await asyncio.gather(*(trabajador(entradas) for _ in range(IMPORTACION_CONCURRENCIA)))
+        if preparadas:
+            await volcar()
+    finally:
+        origen.cerrar()
+
+    transcurrido = time.perf_counter() - inicio
+    procesadas = totales["importadas"] + totales["repetidas"]
+    logger.info(
+        f"Importación terminada en {transcurrido:.1f} s: {totales['importadas']} fotos nuevas, "
+        f"{totales['repetidas']} ya estaban, {totales['fallidas']} con error "
+        f"({procesadas / transcurrido if transcurrido else 0:.1f} fotos/s)"
+    )
+
+@app.on_event("startup")
+async def startup_db():
+    # Las migraciones de datos recorren colecciones enteras: cada una se ejecuta una sola vez
+    await crear_indices(["migraciones"])
+    await ejecutar_migracion("deduplicar_reacciones", deduplicar_reacciones)  # antes del índice único
+    await crear_indices()
+    await ejecutar_migracion("familia_id_fotos", migrar_familia_id_fotos)
+    await ejecutar_migracion("contadores_fotos", migrar_contadores_fotos)
+    await ejecutar_migracion("texto_busqueda_fotos", migrar_texto_busqueda_fotos)
+    await ejecutar_migracion("dia_captura_fotos", migrar_dia_captura_fotos)
+    await migrar_resumen_timeline()
+    await ejecutar_migracion("portadas_timeline", migrar_portadas_timeline)
+    await encolar_fotos_pendientes()
+    if TRABAJOS_WORKERS > 0:
+        cola_trabajos.iniciar(TRABAJOS_WORKERS)
+    global _tarea_limpieza_subidas
+    _tarea_limpieza_subidas = asyncio.create_task(bucle_limpieza_subidas())
+
+# Endpoints de lectura por lotes
+async def ids_fotos_accesibles(ids: List[str], current_user: User) -> List[str]:
+    """Filtrar, con una sola consulta, las fotos del lote que son de la familia del usuario"""
+    fotos = await db.fotos.find(
+        {"id": {"$in": list(dict.fromkeys(ids))}, "familia_id": current_user.familia_id},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    return [foto["id"] for foto in fotos]
+
+@app.post("/api/fotos/batch")
+async def get_fotos_batch(lote: IdsBatch, current_user: User = Depends(get_current_user)):
+    """Obtener el detalle de varias fotos"""
+    fotos = await db.fotos.find(
+        {"id": {"$in": list(dict.fromkeys(lote.ids))}, "familia_id": current_user.familia_id},
+        PROYECCION_FOTO
+    ).to_list(None)
+    encontradas = {foto["id"] for foto in fotos}
+    return RespuestaJSON({
+        "fotos": fotos,
+        "no_encontradas": [foto_id for foto_id in dict.fromkeys(lote.ids) if foto_id not in encontradas]
+    })
+
+@app.post("/api/trabajos/batch")
+async def get_trabajos_batch(lote: IdsBatch, current_user: User = Depends(get_current_user)):
+    """Obtener el estado de varios trabajos en segundo plano (p. ej. los de una subida)"""
+    trabajos = await db.trabajos.find(
+        {"id": {"$in": list(dict.fromkeys(lote.ids))}, "familia_id": current_user.familia_id},
+        PROYECCION_TRABAJO
+    ).to_list(None)
+    return RespuestaJSON({"trabajos": trabajos})
+
+@app.post("/api/comentarios/batch")
+async def get_comentarios_batch(lote: IdsBatch, current_user: User = Depends(get_current_user)):
+    """Obtener los comentarios de varias fotos, agrupados por foto"""
+    ids = await ids_fotos_accesibles(lote.ids, current_user)
+    comentarios = {foto_id: [] for foto_id in ids}
+    async for comentario in db.comentarios.find({"foto_id": {"$in": ids}}, SIN_ID).sort("fecha_creacion", ASCENDING):
+        comentarios[comentario["foto_id"]].append(comentario)
+    return RespuestaJSON({"comentarios": comentarios})
+
+@app.post("/api/reacciones/summary")
+async def get_reacciones_summary(lote: IdsBatch, current_user: User = Depends(get_current_user)):
+    """Obtener los totales de reacciones de varias fotos y la reacción del usuario"""
+    fotos = await db.fotos.find(
+        {"id": {"$in": list(dict.fromkeys(lote.ids))}, "familia_id": current_user.familia_id},
+        {"_id": 0, "id": 1, "reacciones": 1, "total_comentarios": 1}
+    ).to_list(None)
+    propias = await db.reacciones.find(
+        {"foto_id": {"$in": [foto["id"] for foto in fotos]}, "usuario_id": current_user.id},
+        {"_id": 0, "foto_id": 1, "tipo": 1}
+    ).to_list(None)
+    mis_reacciones = {reaccion["foto_id"]: reaccion["tipo"] for reaccion in propias}
+    
+    return RespuestaJSON({"reacciones": {
+        foto["id"]: {
+            "totales": foto.get("reacciones", {}),
+            "total_comentarios": foto.get("total_comentarios", 0),
+            "mi_reaccion": mis_reacciones.get(foto["id"])
+        }
+        for foto in fotos
+    }})
+
+# Métricas
+@app.get("/api/metrics")
+async def get_metricas():
+    """Métricas en formato de texto de Prometheus"""
+    trabajos_pendientes.set(await db.trabajos.count_documents({"estado": "pendiente"}))
+    with _bcrypt_stats_lock:
+        bcrypt_en_cola.set(bcrypt_stats["en_cola"])
+        bcrypt_en_curso.set(bcrypt_stats["en_curso"])
+    lineas = []
+    for metrica in METRICAS:
+        lineas.extend(metrica.exponer())
+    return Response("\n".join(lineas) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Health check
 @app.get("/api/health")
@@ -648,13 +3573,54 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "service": "Memoria Viva API"
+        "service": "Memoria Viva API",
+        "cache": {
+            "usuarios": usuarios_cache.stats(),
+            "familias": familias_cache.stats(),
+            "fotos_familia": fotos_familia_cache.stats(),
+            "hashes_familia": indices_hashes.stats()
+        },
+        "bcrypt": {**bcrypt_stats, "workers": BCRYPT_WORKERS}
     }
 
+@app.on_event("shutdown")
+async def shutdown_cola_trabajos():
+    # Antes de cerrar Mongo: los trabajos en curso vuelven a la cola
+    await cola_trabajos.detener()
+    if _tarea_limpieza_subidas is not None:
+        _tarea_limpieza_subidas.cancel()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
 
+@app.on_event("shutdown")
+async def shutdown_process_pool():
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+    _bcrypt_executor.shutdown(wait=False, cancel_futures=True)
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    import sys
+    if sys.argv[1:] == ["migrar-almacenamiento"]:
+        asyncio.run(migrar_almacenamiento_plano())
+    elif sys.argv[1:] == ["reconstruir-resumen"]:
+        asyncio.run(reconstruir_resumen_timeline())
+    elif sys.argv[1:] == ["calcular-hashes"]:
+        asyncio.run(calcular_hashes_fotos())
+    elif sys.argv[1:] == ["trabajador"]:
+        asyncio.run(ejecutar_trabajador())
+    elif sys.argv[1:2] == ["importar"]:
+        import argparse
+        parser = argparse.ArgumentParser(
+            prog="server.py importar", description="Importar un directorio o ZIP de fotos a la familia de un usuario"
+        )
+        parser.add_argument("origen", type=Path, help="directorio o archivo .zip; cada subcarpeta será un álbum")
+        parser.add_argument("--usuario", required=True, help="email del usuario que figura como autor de la subida")
+        parser.add_argument("--checkpoint", type=Path, help="archivo para reanudar (por defecto, en el directorio actual)")
+        parser.add_argument("--lote", type=int, default=IMPORTACION_LOTE, help="fotos por inserción en Mongo")
+        args = parser.parse_args(sys.argv[2:])
+        asyncio.run(importar_archivo(args.origen, args.usuario, args.checkpoint, args.lote))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
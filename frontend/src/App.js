@@ -111,8 +111,15 @@ function App() {
     );
   }
 
+  // Descargas directas del navegador: la URL lleva un token de un minuto solo para
+  // ese recurso, nunca el de la sesión (las URLs acaban en logs e historial)
+  const descargar = async (ruta, alcance) => {
+    const response = await api.post('/auth/token-url', { alcance });
+    window.location.assign(`${API_BASE_URL}/api${ruta}?token=${encodeURIComponent(response.data.token)}`);
+  };
+
   return (
-    <AuthContext.Provider value={{ user, logout, api }}>
+    <AuthContext.Provider value={{ user, logout, api, descargar }}>
       <div className="min-h-screen bg-gradient-to-br from-amber-50 via-orange-50 to-rose-50">
         <Router>
           <MainApp currentView={currentView} setCurrentView={setCurrentView} />
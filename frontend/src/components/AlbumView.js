@@ -14,16 +14,27 @@ import PhotoUpload from './PhotoUpload';
 const AlbumView = () => {
   const { albumId } = useParams();
   const navigate = useNavigate();
-  const { api } = useContext(AuthContext);
+  const { api, descargar } = useContext(AuthContext);
   const [album, setAlbum] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [error, setError] = useState('');
+  const [avisoDuplicados, setAvisoDuplicados] = useState('');
   const [selectedPhoto, setSelectedPhoto] = useState(null);
 
   useEffect(() => {
     loadAlbum();
   }, [albumId]);
 
+  const handleExport = async () => {
+    try {
+      await descargar(`/albumes/${albumId}/export`, `export_album:${albumId}`);
+    } catch (error) {
+      console.error('Error iniciando la descarga:', error);
+      setError('No se pudo iniciar la descarga del álbum');
+    }
+  };
+
   const loadAlbum = async () => {
     try {
       setLoading(true);
@@ -37,10 +48,63 @@ const AlbumView = () => {
     }
   };
 
-  const handleUploadComplete = (result) => {
+  const loadMore = async () => {
+    if (!album?.siguiente_cursor || loadingMore) return;
+    try {
+      setLoadingMore(true);
+      const response = await api.get(`/albumes/${albumId}/fotos`, {
+        params: { cursor: album.siguiente_cursor }
+      });
+      setAlbum(prev => ({
+        ...prev,
+        fotos: [...prev.fotos, ...response.data.fotos],
+        siguiente_cursor: response.data.siguiente_cursor
+      }));
+    } catch (error) {
+      console.error('Error cargando más fotos:', error);
+      setError('Error al cargar más fotos');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const esperarProcesamiento = async (trabajoIds) => {
+    // Miniaturas, metadatos y duplicados se calculan en segundo plano tras la subida
+    for (let intento = 0; intento < 40; intento++) {
+      await new Promise(resolve => setTimeout(resolve, 1500));
+      const response = await api.post('/trabajos/batch', { ids: trabajoIds });
+      const trabajos = response.data.trabajos;
+      if (trabajos.every(t => t.estado === 'completado' || t.estado === 'fallido')) {
+        return trabajos;
+      }
+    }
+    return null;
+  };
+
+  const handleUploadComplete = async (result) => {
     // Recargar el álbum después de subir fotos
     loadAlbum();
     setError(''); // Limpiar cualquier error previo
+    setAvisoDuplicados('');
+
+    const resultados = result?.resultados || [];
+    const trabajoIds = resultados.map(r => r.trabajo_id).filter(Boolean);
+    if (trabajoIds.length === 0) return;
+    try {
+      const trabajos = await esperarProcesamiento(trabajoIds);
+      if (!trabajos) return;
+      loadAlbum();
+      // Avisar de fotos que parecen ya subidas (mismo original a otro tamaño o calidad)
+      const nombres = Object.fromEntries(resultados.map(r => [r.foto_id, r.nombre_archivo]));
+      const repetidas = trabajos
+        .filter(t => t.resultado?.posibles_duplicados?.length)
+        .map(t => nombres[t.resultado.foto_id]);
+      if (repetidas.length) {
+        setAvisoDuplicados(`Parece que ya teníais ${repetidas.length === 1 ? 'esta foto' : 'estas fotos'}: ${repetidas.join(', ')}`);
+      }
+    } catch (error) {
+      console.error('Error consultando el procesamiento de las fotos:', error);
+    }
   };
 
   const formatDate = (dateString) => {
@@ -54,8 +118,15 @@ const AlbumView = () => {
     });
   };
 
-  const openPhotoModal = (foto) => {
+  const openPhotoModal = async (foto) => {
+    // El listado solo trae campos básicos: mostrar ya la foto y completar el detalle
     setSelectedPhoto(foto);
+    try {
+      const response = await api.get(`/fotos/${foto.id}`);
+      setSelectedPhoto(current => (current?.id === foto.id ? response.data : current));
+    } catch (error) {
+      console.error('Error cargando detalle de la foto:', error);
+    }
   };
 
   const closePhotoModal = () => {
@@ -114,8 +185,8 @@ const AlbumView = () => {
             
             <div className="flex items-center space-x-4 text-sm text-amber-600">
               <span>📅 Creado el {formatDate(album.fecha_creacion)}</span>
-              {album.fotos && (
-                <span>📷 {album.fotos.length} foto{album.fotos.length !== 1 ? 's' : ''}</span>
+              {album.total_fotos !== undefined && (
+                <span>📷 {album.total_fotos} foto{album.total_fotos !== 1 ? 's' : ''}</span>
               )}
               <Badge variant="secondary" className="bg-amber-100 text-amber-800">
                 {album.privacidad === 'familia' ? '👨‍👩‍👧‍👦 Familiar' : '🔒 Privado'}
@@ -123,17 +194,30 @@ const AlbumView = () => {
             </div>
           </div>
 
-          <PhotoUpload 
-            albumId={albumId}
-            onUploadComplete={handleUploadComplete}
-            triggerButton={
-              <Button className="btn-primary" data-testid="upload-photos-button">
-                📤 Subir Fotos
+          <div className="flex items-center space-x-3">
+            {album.total_fotos > 0 && (
+              <Button variant="outline" className="btn-secondary" onClick={handleExport} data-testid="export-album-button">
+                📦 Descargar ZIP
               </Button>
-            }
-          />
+            )}
+            <PhotoUpload 
+              albumId={albumId}
+              onUploadComplete={handleUploadComplete}
+              triggerButton={
+                <Button className="btn-primary" data-testid="upload-photos-button">
+                  📤 Subir Fotos
+                </Button>
+              }
+            />
+          </div>
         </div>
 
+        {avisoDuplicados && (
+          <Alert className="mb-6 border-amber-200 bg-amber-50" data-testid="duplicates-warning">
+            <AlertDescription className="text-amber-800">🔁 {avisoDuplicados}</AlertDescription>
+          </Alert>
+        )}
+
         {/* Photos Grid */}
         {!album.fotos || album.fotos.length === 0 ? (
           <div className="text-center py-16" data-testid="no-photos-message">
@@ -168,7 +252,7 @@ const AlbumView = () => {
                 data-testid={`photo-card-${foto.id}`}
               >
                 <img
-                  src={`${process.env.REACT_APP_BACKEND_URL}${foto.archivo_url}`}
+                  src={`${process.env.REACT_APP_BACKEND_URL}${foto.derivados?.['1024'] || foto.archivo_url}`}
                   alt={foto.nombre_archivo}
                   className="w-full h-full object-cover"
                   loading="lazy"
@@ -198,13 +282,27 @@ const AlbumView = () => {
           </div>
         )}
 
+        {/* Paginación */}
+        {album.siguiente_cursor && (
+          <div className="flex justify-center mt-8">
+            <Button
+              onClick={loadMore}
+              disabled={loadingMore}
+              className="btn-secondary"
+              data-testid="load-more-photos-button"
+            >
+              {loadingMore ? 'Cargando...' : 'Cargar más fotos'}
+            </Button>
+          </div>
+        )}
+
         {/* Photo Modal */}
         {selectedPhoto && (
           <Dialog open={!!selectedPhoto} onOpenChange={(open) => !open && closePhotoModal()}>
             <DialogContent className="max-w-4xl max-h-[90vh] overflow-hidden p-0">
               <div className="relative">
                 <img
-                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.archivo_url}`}
+                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.derivados?.['2048'] || selectedPhoto.archivo_url}`}
                   alt={selectedPhoto.nombre_archivo}
                   className="w-full h-auto max-h-[70vh] object-contain bg-black"
                 />
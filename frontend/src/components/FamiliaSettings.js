@@ -9,7 +9,7 @@ import { Badge } from './ui/badge';
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, DialogTrigger } from './ui/dialog';
 
 const FamiliaSettings = () => {
-  const { api, user } = useContext(AuthContext);
+  const { api, user, descargar } = useContext(AuthContext);
   const [familia, setFamilia] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
@@ -47,6 +47,15 @@ const FamiliaSettings = () => {
     }
   };
 
+  const handleExport = async () => {
+    try {
+      await descargar('/familia/export', 'export_familia');
+    } catch (error) {
+      console.error('Error iniciando la descarga:', error);
+      setError('No se pudo iniciar la descarga de los recuerdos');
+    }
+  };
+
   const copyToClipboard = async () => {
     try {
       await navigator.clipboard.writeText(codigoInvitacion);
@@ -330,6 +339,10 @@ const FamiliaSettings = () => {
               🔄 Actualizar Información
             </Button>
             
+            <Button variant="outline" className="btn-secondary" onClick={handleExport} data-testid="export-family-button">
+              📦 Descargar todos los recuerdos
+            </Button>
+            
             {user?.rol === 'admin' && (
               <Dialog open={showInviteDialog} onOpenChange={setShowInviteDialog}>
                 <DialogTrigger asChild>
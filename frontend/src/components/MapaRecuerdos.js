@@ -223,7 +223,7 @@ const MapaRecuerdos = () => {
                               onClick={() => openPhotoModal(foto)}
                             >
                               <img
-                                src={`${process.env.REACT_APP_BACKEND_URL}${foto.archivo_url}`}
+                                src={`${process.env.REACT_APP_BACKEND_URL}${foto.miniatura_url || foto.archivo_url}`}
                                 alt={foto.nombre_archivo}
                                 className="w-full h-full object-cover"
                                 loading="lazy"
@@ -258,7 +258,7 @@ const MapaRecuerdos = () => {
             <DialogContent className="max-w-4xl max-h-[90vh] overflow-hidden p-0">
               <div className="relative">
                 <img
-                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.archivo_url}`}
+                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.derivados?.['2048'] || selectedPhoto.archivo_url}`}
                   alt={selectedPhoto.nombre_archivo}
                   className="w-full h-auto max-h-[70vh] object-contain bg-black"
                 />
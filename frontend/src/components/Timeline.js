@@ -11,6 +11,8 @@ const Timeline = () => {
   const { api } = useContext(AuthContext);
   const [fotos, setFotos] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [siguienteCursor, setSiguienteCursor] = useState(null);
   const [error, setError] = useState('');
   const [selectedPhoto, setSelectedPhoto] = useState(null);
   const [filtros, setFiltros] = useState({
@@ -18,28 +20,33 @@ const Timeline = () => {
     mes: '',
     busqueda: ''
   });
-  const [años, setAños] = useState([]);
+  const [resumen, setResumen] = useState({ total: 0, anios: [], meses: [] });
+  const [enEsteDia, setEnEsteDia] = useState([]);
 
   useEffect(() => {
     loadTimeline();
   }, []);
 
+  // El año se filtra en el servidor: el cursor recorre solo las fotos de ese año
   useEffect(() => {
-    // Extraer años únicos de las fotos
-    const añosUnicos = [...new Set(
-      fotos.map(foto => {
-        const fecha = foto.fecha_captura || foto.fecha_subida;
-        return fecha ? new Date(fecha).getFullYear() : null;
-      }).filter(año => año !== null)
-    )].sort((a, b) => b - a);
-    setAños(añosUnicos);
-  }, [fotos]);
+    if (!loading) loadFotosAño();
+  }, [filtros.año]);
+
+  // Los años salen del resumen de la familia, no solo de las fotos cargadas
+  const años = resumen.anios.map(({ anio }) => anio);
 
   const loadTimeline = async () => {
     try {
       setLoading(true);
-      const response = await api.get('/timeline');
-      setFotos(response.data);
+      const [timelineResponse, resumenResponse, enEsteDiaResponse] = await Promise.all([
+        api.get('/timeline'),
+        api.get('/timeline/resumen'),
+        api.get('/timeline/en-este-dia')
+      ]);
+      setFotos(timelineResponse.data.fotos);
+      setSiguienteCursor(timelineResponse.data.siguiente_cursor);
+      setResumen(resumenResponse.data);
+      setEnEsteDia(enEsteDiaResponse.data.fotos);
     } catch (error) {
       console.error('Error cargando timeline:', error);
       setError('Error al cargar la línea de tiempo');
@@ -48,6 +55,37 @@ const Timeline = () => {
     }
   };
 
+  const loadFotosAño = async () => {
+    try {
+      setLoadingMore(true);
+      const response = await api.get('/timeline', { params: { anio: filtros.año || undefined } });
+      setFotos(response.data.fotos);
+      setSiguienteCursor(response.data.siguiente_cursor);
+    } catch (error) {
+      console.error('Error cargando fotos del año:', error);
+      setError('Error al cargar la línea de tiempo');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const loadMore = async () => {
+    if (!siguienteCursor || loadingMore) return;
+    try {
+      setLoadingMore(true);
+      const response = await api.get('/timeline', {
+        params: { cursor: siguienteCursor, anio: filtros.año || undefined }
+      });
+      setFotos(prev => [...prev, ...response.data.fotos]);
+      setSiguienteCursor(response.data.siguiente_cursor);
+    } catch (error) {
+      console.error('Error cargando más fotos:', error);
+      setError('Error al cargar más recuerdos');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const formatFecha = (fechaString) => {
     if (!fechaString) return 'Fecha desconocida';
     return new Date(fechaString).toLocaleDateString('es-ES', {
@@ -83,14 +121,7 @@ const Timeline = () => {
       const fecha = foto.fecha_captura || foto.fecha_subida;
       const fechaObj = fecha ? new Date(fecha) : null;
       
-      // Filtro por año
-      if (filtros.año && fechaObj) {
-        if (fechaObj.getFullYear() !== parseInt(filtros.año)) {
-          return false;
-        }
-      }
-      
-      // Filtro por mes
+      // Filtro por mes (el año ya viene filtrado del servidor)
       if (filtros.mes && fechaObj) {
         if (fechaObj.getMonth() !== parseInt(filtros.mes) - 1) {
           return false;
@@ -237,6 +268,9 @@ const Timeline = () => {
             
             <div className="mt-4 flex items-center space-x-4 text-sm text-amber-600">
               <span>📷 {fotosFiltradas.length} foto{fotosFiltradas.length !== 1 ? 's' : ''} encontrada{fotosFiltradas.length !== 1 ? 's' : ''}</span>
+              {resumen.total > 0 && (
+                <span>🗂️ {resumen.total} en total en {resumen.anios.length} año{resumen.anios.length !== 1 ? 's' : ''}</span>
+              )}
               {Object.keys(gruposFotos).length > 0 && (
                 <span>📅 {Object.keys(gruposFotos).length} período{Object.keys(gruposFotos).length !== 1 ? 's' : ''}</span>
               )}
@@ -244,6 +278,33 @@ const Timeline = () => {
           </div>
         </div>
 
+        {/* En este día */}
+        {enEsteDia.length > 0 && (
+          <div className="glass-warm rounded-xl p-6 mb-8" data-testid="on-this-day">
+            <h3 className="text-lg font-semibold text-amber-800 mb-4 font-heading">🎂 Tal día como hoy</h3>
+            <div className="flex space-x-4 overflow-x-auto pb-2">
+              {enEsteDia.map(foto => (
+                <button
+                  key={foto.id}
+                  onClick={() => openPhotoModal(foto)}
+                  className="flex-shrink-0 text-left"
+                  data-testid={`on-this-day-photo-${foto.id}`}
+                >
+                  <img
+                    src={`${process.env.REACT_APP_BACKEND_URL}${foto.miniatura_url || foto.archivo_url}`}
+                    alt={foto.nombre_archivo}
+                    className="w-32 h-32 object-cover rounded-lg shadow"
+                    loading="lazy"
+                  />
+                  <p className="text-xs text-amber-700 mt-1 text-center">
+                    {new Date(foto.fecha_captura).getFullYear()}
+                  </p>
+                </button>
+              ))}
+            </div>
+          </div>
+        )}
+
         {/* Timeline */}
         {fotosFiltradas.length === 0 ? (
           <div className="text-center py-16" data-testid="no-photos-message">
@@ -289,7 +350,7 @@ const Timeline = () => {
                     >
                       <div className="aspect-[4/3] relative overflow-hidden">
                         <img
-                          src={`${process.env.REACT_APP_BACKEND_URL}${foto.archivo_url}`}
+                          src={`${process.env.REACT_APP_BACKEND_URL}${foto.derivados?.['1024'] || foto.archivo_url}`}
                           alt={foto.nombre_archivo}
                           className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-300"
                           loading="lazy"
@@ -341,13 +402,27 @@ const Timeline = () => {
           </div>
         )}
 
+        {/* Paginación */}
+        {siguienteCursor && (
+          <div className="flex justify-center mt-8">
+            <Button
+              onClick={loadMore}
+              disabled={loadingMore}
+              className="btn-secondary"
+              data-testid="load-more-button"
+            >
+              {loadingMore ? 'Cargando...' : 'Cargar más recuerdos'}
+            </Button>
+          </div>
+        )}
+
         {/* Photo Modal */}
         {selectedPhoto && (
           <Dialog open={!!selectedPhoto} onOpenChange={(open) => !open && closePhotoModal()}>
             <DialogContent className="max-w-4xl max-h-[90vh] overflow-hidden p-0">
               <div className="relative">
                 <img
-                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.archivo_url}`}
+                  src={`${process.env.REACT_APP_BACKEND_URL}${selectedPhoto.derivados?.['2048'] || selectedPhoto.archivo_url}`}
                   alt={selectedPhoto.nombre_archivo}
                   className="w-full h-auto max-h-[70vh] object-contain bg-black"
                 />
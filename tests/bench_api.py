@@ -0,0 +1,422 @@
+"""Benchmark y prueba de carga de la API.
+
+Siembra una base de datos con familias, álbumes y fotos sintéticas a la escala
+pedida y lanza peticiones concurrentes contra los endpoints más usados. El
+resultado (p50/p95/p99 y peticiones por segundo por escenario) se escribe en
+JSON para poder compararlo entre commits.
+
+Por defecto usa un MongoDB en memoria (mongomock-motor) y llama a la app en el
+mismo proceso; con --mongo-url se siembra un mongod real (recomendado para
+100k y 1M fotos) y con --url las peticiones van a un servidor ya arrancado
+contra esa misma base de datos.
+
+Uso:
+    python tests/bench_api.py --escalas 10000 --salida bench.json
+    python tests/bench_api.py --mongo-url mongodb://localhost:27017 --escalas 10000,100000,1000000
+    python tests/bench_api.py --comparar base.json --salida nuevo.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+LOTE_SIEMBRA = 5000
+PASSWORD_BENCH = "bench-password"
+LUGARES = [("Bogotá", 4.61, -74.08), ("Medellín", 6.24, -75.58), ("Madrid", 40.42, -3.70), ("Lima", -12.05, -77.04)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark y prueba de carga de la API")
+    parser.add_argument("--escalas", default="10000", help="número total de fotos por escala, separado por comas")
+    parser.add_argument("--familias", type=int, default=10)
+    parser.add_argument("--albumes-por-familia", type=int, default=20)
+    parser.add_argument("--fraccion-ubicadas", type=float, default=0.3, help="fracción de fotos con GPS")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--peticiones", type=int, default=500, help="peticiones por escenario de lectura")
+    parser.add_argument("--peticiones-lentas", type=int, default=50, help="peticiones para login, subida y metadatos")
+    parser.add_argument("--calentamiento", type=int, default=5, help="peticiones descartadas antes de medir")
+    parser.add_argument("--escenarios", default=None, help="subconjunto de escenarios separado por comas")
+    parser.add_argument("--mongo-url", default=None, help="mongod real; sin él se usa mongomock en memoria")
+    parser.add_argument("--db-nombre", default="memoria_viva_bench", help="base de datos que se borra y se siembra")
+    parser.add_argument("--url", default=None, help="servidor ya arrancado (requiere --mongo-url)")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--salida", default=None, help="fichero JSON de resultados (por defecto stdout)")
+    parser.add_argument("--comparar", default=None, help="JSON de una ejecución anterior para mostrar diferencias")
+    args = parser.parse_args()
+    if args.url and not args.mongo_url:
+        parser.error("--url necesita --mongo-url para sembrar la misma base de datos que usa el servidor")
+    return args
+
+
+def importar_server(args):
+    """Importa server.py apuntando a la base de datos del benchmark"""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_nombre
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    if not args.mongo_url:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("Sin --mongo-url hace falta mongomock-motor (pip install mongomock-motor)")
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[args.db_nombre]
+    return server
+
+
+def jpeg_sintetico(rng: random.Random, ancho: int = 1600, alto: int = 1200, exif: bool = False) -> bytes:
+    """JPEG con contenido distinto en cada llamada (el almacén deduplica por hash)"""
+    imagen = Image.new("RGB", (ancho, alto), tuple(rng.randrange(256) for _ in range(3)))
+    imagen.putpixel((rng.randrange(ancho), rng.randrange(alto)), (rng.randrange(256), 0, 0))
+    salida = io.BytesIO()
+    if exif:
+        datos_exif = Image.Exif()
+        datos_exif[0x010F] = "Canon"  # Make
+        datos_exif[0x0110] = "EOS 5D"  # Model
+        datos_exif[0x9003] = "2004:06:12 10:30:00"  # DateTimeOriginal
+        datos_exif[0x8825] = {1: "N", 2: (4.0, 36.0, 0.0), 3: "W", 4: (74.0, 4.0, 0.0)}  # GPSInfo
+        imagen.save(salida, "JPEG", quality=85, exif=datos_exif)
+    else:
+        imagen.save(salida, "JPEG", quality=85)
+    return salida.getvalue()
+
+
+# Siembra de datos sintéticos
+async def sembrar(server, args, total_fotos: int, rng: random.Random) -> dict:
+    """Borra la base de datos del benchmark y la llena con la escala pedida"""
+    await server.client.drop_database(args.db_nombre)
+    db = server.client[args.db_nombre]
+    server.db = db
+    for cache in (server.usuarios_cache, server.familias_cache, server.fotos_familia_cache):
+        cache.clear()
+
+    # Un único hash para todos: bcrypt es deliberadamente lento
+    password_hash = server.hash_password(PASSWORD_BENCH)
+    ahora = datetime.now(timezone.utc)
+    familias, usuarios, albumes = [], [], []
+    for f in range(args.familias):
+        familia = server.Familia(nombre=f"Familia Bench {f}", admin_id="")
+        miembros = []
+        for m in range(4):
+            usuario = server.User(
+                email=f"bench{f}-{m}@example.com",
+                nombre=f"Miembro {m}",
+                apellido=f"Bench {f}",
+                familia_id=familia.id,
+                rol="admin" if m == 0 else "miembro"
+            )
+            miembros.append(usuario)
+        familia.admin_id = miembros[0].id
+        familias.append(familia.dict())
+        usuarios.extend({**usuario.dict(), "password": password_hash} for usuario in miembros)
+        for a in range(args.albumes_por_familia):
+            albumes.append(server.Album(
+                titulo=f"Álbum {a}",
+                familia_id=familia.id,
+                creador_id=miembros[a % len(miembros)].id
+            ).dict())
+
+    await db.familias.insert_many(familias)
+    await db.usuarios.insert_many(usuarios)
+    await db.albumes.insert_many(albumes)
+    await server.crear_indices()
+
+    inicio = time.perf_counter()
+    lote = []
+    for i in range(total_fotos):
+        album = albumes[rng.randrange(len(albumes))]
+        sha = uuid.UUID(int=rng.getrandbits(128)).hex * 2
+        url = f"/api/fotos/files/blobs/{sha[:2]}/{sha[2:4]}/{sha}"
+        foto = {
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "nombre_archivo": f"IMG_{i:07d}.jpg",
+            "archivo_url": f"{url}.jpg",
+            "miniatura_url": f"{url}_{server.DERIVADOS_TAMANOS[0]}.webp",
+            "derivados": {str(t): f"{url}_{t}.webp" for t in server.DERIVADOS_TAMANOS},
+            "album_id": album["id"],
+            "familia_id": album["familia_id"],
+            "subida_por": album["creador_id"],
+            "fecha_subida": ahora - timedelta(seconds=rng.randrange(5 * 365 * 86400)),
+            "fecha_captura": ahora - timedelta(days=rng.randrange(60 * 365)) if rng.random() < 0.8 else None,
+            "ubicacion": None,
+            "lugar_nombre": None,
+            "personas_etiquetadas": [],
+            "descripcion": f"Recuerdo {i}",
+            "anecdota": None,
+            "metadata": {"ancho": 4000, "alto": 3000, "formato": "JPEG"},
+            "sha256": sha,
+            "total_comentarios": rng.randrange(5),
+            "reacciones": {"like": rng.randrange(10)},
+        }
+        if rng.random() < args.fraccion_ubicadas:
+            lugar, lat, lng = LUGARES[rng.randrange(len(LUGARES))]
+            foto["ubicacion"] = {"lat": lat + rng.uniform(-0.5, 0.5), "lng": lng + rng.uniform(-0.5, 0.5)}
+            foto["lugar_nombre"] = lugar
+        lote.append(foto)
+        if len(lote) >= LOTE_SIEMBRA:
+            await db.fotos.insert_many(lote, ordered=False)
+            lote = []
+    if lote:
+        await db.fotos.insert_many(lote, ordered=False)
+
+    return {
+        "familias": familias,
+        "usuarios": usuarios,
+        "albumes": albumes,
+        "tokens": {u["familia_id"]: server.create_access_token({"sub": u["id"]}) for u in usuarios},
+        "siembra_s": round(time.perf_counter() - inicio, 2),
+    }
+
+
+# Escenarios de carga
+def crear_escenarios(server, cliente: httpx.AsyncClient, datos: dict, args, rng: random.Random) -> dict:
+    """Cada escenario es (número de peticiones, corrutina(i) -> bool)"""
+    familias_ids = list(datos["tokens"])
+    albumes = datos["albumes"]
+
+    def cabeceras(familia_id: str) -> dict:
+        return {"Authorization": f"Bearer {datos['tokens'][familia_id]}"}
+
+    def familia_al_azar() -> str:
+        return familias_ids[rng.randrange(len(familias_ids))]
+
+    async def login(i: int) -> bool:
+        usuario = datos["usuarios"][i % len(datos["usuarios"])]
+        r = await cliente.post("/api/auth/login", json={"email": usuario["email"], "password": PASSWORD_BENCH})
+        return r.status_code == 200
+
+    async def timeline(i: int) -> bool:
+        r = await cliente.get("/api/timeline", params={"limite": 50}, headers=cabeceras(familia_al_azar()))
+        return r.status_code == 200
+
+    async def timeline_pagina_2(i: int) -> bool:
+        familia_id = familia_al_azar()
+        r = await cliente.get("/api/timeline", params={"limite": 50}, headers=cabeceras(familia_id))
+        cursor = r.json().get("siguiente_cursor") if r.status_code == 200 else None
+        if not cursor:
+            return r.status_code == 200
+        r = await cliente.get("/api/timeline", params={"limite": 50, "cursor": cursor}, headers=cabeceras(familia_id))
+        return r.status_code == 200
+
+    async def mapa_fotos(i: int) -> bool:
+        r = await cliente.get("/api/mapa/fotos", headers=cabeceras(familia_al_azar()))
+        return r.status_code == 200
+
+    async def album(i: int) -> bool:
+        elegido = albumes[rng.randrange(len(albumes))]
+        r = await cliente.get(f"/api/albumes/{elegido['id']}", headers=cabeceras(elegido["familia_id"]))
+        return r.status_code == 200
+
+    imagenes_subida = [jpeg_sintetico(rng) for _ in range(args.peticiones_lentas + args.calentamiento)]
+
+    async def subida(i: int) -> bool:
+        elegido = albumes[rng.randrange(len(albumes))]
+        r = await cliente.post(
+            "/api/fotos/upload",
+            data={"album_id": elegido["id"]},
+            files=[("files", (f"bench_{i}.jpg", imagenes_subida[i % len(imagenes_subida)], "image/jpeg"))],
+            headers=cabeceras(elegido["familia_id"])
+        )
+        return r.status_code == 200 and r.json()["resultados"][0]["ok"]
+
+    # PhotoMetadataExtractor se mide tal como lo usa la subida: en el pool de procesos
+    directorio_exif = Path.cwd() / "exif"
+    directorio_exif.mkdir(exist_ok=True)
+    rutas_exif = []
+    for n in range(8):
+        ruta = directorio_exif / f"exif_{n}.jpg"
+        ruta.write_bytes(jpeg_sintetico(rng, exif=True))
+        rutas_exif.append(ruta)
+
+    async def metadatos(i: int) -> bool:
+        return bool(await server.leer_metadatos(rutas_exif[i % len(rutas_exif)]))
+
+    lentas = args.peticiones_lentas
+    return {
+        "login": (lentas, login),
+        "timeline": (args.peticiones, timeline),
+        "timeline_pagina_2": (args.peticiones, timeline_pagina_2),
+        "mapa_fotos": (args.peticiones, mapa_fotos),
+        "album": (args.peticiones, album),
+        "upload": (lentas, subida),
+        "metadatos": (lentas, metadatos),
+    }
+
+
+def percentil(ordenadas: list, p: float) -> float:
+    """Percentil por interpolación lineal sobre una lista ordenada"""
+    if len(ordenadas) == 1:
+        return ordenadas[0]
+    posicion = (len(ordenadas) - 1) * p / 100
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenadas) - 1)
+    return ordenadas[inferior] + (ordenadas[superior] - ordenadas[inferior]) * (posicion - inferior)
+
+
+async def ejecutar_escenario(peticion, total: int, concurrencia: int, calentamiento: int) -> dict:
+    """Lanza `total` peticiones con `concurrencia` trabajadores y resume las latencias"""
+    for i in range(calentamiento):
+        await peticion(total + i)
+
+    latencias = []
+    errores = 0
+    pendientes = iter(range(total))
+
+    async def trabajador():
+        nonlocal errores
+        for i in pendientes:
+            inicio = time.perf_counter()
+            try:
+                ok = await peticion(i)
+            except Exception:
+                ok = False
+            latencias.append(time.perf_counter() - inicio)
+            if not ok:
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(min(concurrencia, total))))
+    duracion = time.perf_counter() - inicio
+
+    ordenadas = sorted(latencias)
+    return {
+        "peticiones": total,
+        "errores": errores,
+        "concurrencia": min(concurrencia, total),
+        "duracion_s": round(duracion, 3),
+        "rps": round(total / duracion, 1),
+        "p50_ms": round(percentil(ordenadas, 50) * 1000, 2),
+        "p95_ms": round(percentil(ordenadas, 95) * 1000, 2),
+        "p99_ms": round(percentil(ordenadas, 99) * 1000, 2),
+        "media_ms": round(statistics.fmean(ordenadas) * 1000, 2),
+        "max_ms": round(ordenadas[-1] * 1000, 2),
+    }
+
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def mostrar(resultado: dict, base: dict = None):
+    """Tabla legible en stderr; con `base` añade la variación de p95 y RPS"""
+    anteriores = {}
+    for escala in (base or {}).get("escalas", []):
+        for nombre, datos in escala["escenarios"].items():
+            anteriores[(escala["fotos"], nombre)] = datos
+
+    for escala in resultado["escalas"]:
+        print(f"\n{escala['fotos']} fotos (siembra {escala['siembra_s']} s)", file=sys.stderr)
+        print(f"  {'escenario':<18} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errores':>8}", file=sys.stderr)
+        for nombre, datos in escala["escenarios"].items():
+            linea = (
+                f"  {nombre:<18} {datos['rps']:>8} {datos['p50_ms']:>9} {datos['p95_ms']:>9} "
+                f"{datos['p99_ms']:>9} {datos['errores']:>8}"
+            )
+            anterior = anteriores.get((escala["fotos"], nombre))
+            if anterior:
+                linea += (
+                    f"   p95 {(datos['p95_ms'] / anterior['p95_ms'] - 1) * 100:+.1f}%"
+                    f"  rps {(datos['rps'] / anterior['rps'] - 1) * 100:+.1f}%"
+                )
+            print(linea, file=sys.stderr)
+
+
+async def main(args):
+    # server.py crea uploads/ en el directorio actual: se aísla en un directorio temporal
+    directorio_trabajo = Path(tempfile.mkdtemp(prefix="bench_api_"))
+    os.chdir(directorio_trabajo)
+    server = importar_server(args)
+
+    if args.url:
+        transporte = None
+        base_url = args.url
+    else:
+        transporte = httpx.ASGITransport(app=server.app)
+        base_url = "http://bench"
+
+    nombres = args.escenarios.split(",") if args.escenarios else None
+    resultado = {
+        "commit": commit_actual(),
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "entorno": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "mongo": "mongod" if args.mongo_url else "mongomock",
+            "servidor": args.url or "en proceso (ASGI)",
+            "encoder_json": "orjson" if server.orjson else "json",
+            "bcrypt_rounds": server.BCRYPT_ROUNDS,
+        },
+        "parametros": {
+            "familias": args.familias,
+            "albumes_por_familia": args.albumes_por_familia,
+            "concurrencia": args.concurrencia,
+            "semilla": args.semilla,
+        },
+        "escalas": [],
+    }
+
+    try:
+        for total_fotos in (int(e) for e in args.escalas.split(",")):
+            rng = random.Random(args.semilla)
+            print(f"Sembrando {total_fotos} fotos...", file=sys.stderr)
+            datos = await sembrar(server, args, total_fotos, rng)
+            escenarios_escala = {}
+            async with httpx.AsyncClient(transport=transporte, base_url=base_url, timeout=300) as cliente:
+                escenarios = crear_escenarios(server, cliente, datos, args, rng)
+                for nombre, (total, peticion) in escenarios.items():
+                    if nombres and nombre not in nombres:
+                        continue
+                    print(f"  {nombre}...", file=sys.stderr)
+                    escenarios_escala[nombre] = await ejecutar_escenario(
+                        peticion, total, args.concurrencia, args.calentamiento
+                    )
+            resultado["escalas"].append({
+                "fotos": total_fotos,
+                "siembra_s": datos["siembra_s"],
+                "escenarios": escenarios_escala,
+            })
+    finally:
+        await server.shutdown_process_pool()
+        if args.mongo_url:
+            await server.client.drop_database(args.db_nombre)
+        shutil.rmtree(directorio_trabajo, ignore_errors=True)
+
+    base = json.loads(Path(args.comparar).read_text()) if args.comparar else None
+    mostrar(resultado, base)
+
+    salida = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        Path(args.salida).write_text(salida)
+    else:
+        print(salida)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.salida:
+        args.salida = str(Path(args.salida).resolve())
+    if args.comparar:
+        args.comparar = str(Path(args.comparar).resolve())
+    asyncio.run(main(args))
@@ -0,0 +1,105 @@
+"""Micro-benchmark de serialización de listados de fotos.
+
+Compara el camino anterior (modelo Pydantic por documento + jsonable_encoder +
+JSONResponse) con RespuestaJSON sobre documentos ya proyectados desde Mongo.
+
+Uso: python tests/bench_serializacion.py [--tamanos 1000,10000,50000] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import server  # noqa: E402
+
+
+def generar_fotos(cantidad: int) -> list:
+    """Documentos con la forma que devuelve db.fotos.find(..., PROYECCION_FOTO)"""
+    base = datetime(2000, 1, 1)
+    album_id, familia_id, usuario_id = (str(uuid.uuid4()) for _ in range(3))
+    fotos = []
+    for i in range(cantidad):
+        sha = uuid.uuid4().hex * 2
+        url = f"/api/fotos/files/blobs/{sha[:2]}/{sha[2:4]}/{sha}"
+        fotos.append({
+            "id": str(uuid.uuid4()),
+            "nombre_archivo": f"IMG_{i:05d}.jpg",
+            "archivo_url": f"{url}.jpg",
+            "miniatura_url": f"{url}_256.webp",
+            "derivados": {str(t): f"{url}_{t}.webp" for t in server.DERIVADOS_TAMANOS},
+            "album_id": album_id,
+            "familia_id": familia_id,
+            "subida_por": usuario_id,
+            "fecha_subida": base + timedelta(days=i, seconds=i),
+            "fecha_captura": base + timedelta(days=i) if i % 3 else None,
+            "ubicacion": {"lat": 4.6 + i * 1e-5, "lng": -74.0 - i * 1e-5} if i % 2 else None,
+            "lugar_nombre": "Bogotá" if i % 2 else None,
+            "personas_etiquetadas": ["abuela", "tío Carlos"],
+            "descripcion": "Cumpleaños de la abuela",
+            "anecdota": None,
+            "metadata": {"camera_make": "Canon", "camera_model": "EOS 5D", "ancho": 4000, "alto": 3000, "formato": "JPEG"},
+            "sha256": sha,
+            "total_comentarios": i % 7,
+            "reacciones": {"like": i % 5, "love": i % 3},
+        })
+    return fotos
+
+
+def camino_pydantic(fotos: list) -> bytes:
+    contenido = [server.Foto(**foto).dict() for foto in fotos]
+    return JSONResponse(jsonable_encoder(contenido)).body
+
+
+def camino_directo(fotos: list) -> bytes:
+    return server.RespuestaJSON(fotos).body
+
+
+def medir(funcion, fotos: list, repeticiones: int) -> float:
+    """Mejor tiempo de varias repeticiones, en segundos"""
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(fotos)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tamanos", default="1000,10000,50000")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="salida legible por máquina")
+    args = parser.parse_args()
+
+    resultados = []
+    for cantidad in (int(t) for t in args.tamanos.split(",")):
+        fotos = generar_fotos(cantidad)
+        for nombre, funcion in (("pydantic+jsonable_encoder", camino_pydantic), ("RespuestaJSON", camino_directo)):
+            segundos = medir(funcion, fotos, args.repeticiones)
+            resultados.append({
+                "documentos": cantidad,
+                "camino": nombre,
+                "total_ms": round(segundos * 1000, 2),
+                "us_por_documento": round(segundos / cantidad * 1e6, 3),
+            })
+
+    if args.json:
+        print(json.dumps({"encoder": "orjson" if server.orjson else "json", "resultados": resultados}))
+        return
+
+    print(f"Encoder: {'orjson' if server.orjson else 'json (stdlib)'}")
+    print(f"{'documentos':>10}  {'camino':<26} {'total ms':>10} {'µs/doc':>8}")
+    for r in resultados:
+        print(f"{r['documentos']:>10}  {r['camino']:<26} {r['total_ms']:>10} {r['us_por_documento']:>8}")
+
+
+if __name__ == "__main__":
+    main()
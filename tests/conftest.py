@@ -0,0 +1,56 @@
+"""Fixtures comunes de las pruebas: server.py contra un MongoDB en memoria (mongomock-motor).
+
+Cada prueba importa server.py de nuevo en un directorio temporal, así las cachés,
+métricas y uploads/ de una prueba no se ven en la siguiente.
+"""
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("mongomock_motor")
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """server.py recién importado, con la base de datos en memoria y uploads/ en tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("MONGO_URL", "mongodb://localhost:27017")
+    monkeypatch.syspath_prepend(str(BACKEND_DIR))
+    sys.modules.pop("server", None)
+    import server
+
+    server.client = AsyncMongoMockClient()
+    server.db = server.client["memoria_viva_test"]
+    yield server
+    pool = getattr(server, "_process_pool", None)
+    if pool is not None:
+        pool.shutdown()
+    sys.modules.pop("server", None)
+
+
+def cliente(server) -> httpx.AsyncClient:
+    """Cliente HTTP contra la app en el mismo proceso (sin eventos de arranque)"""
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://prueba")
+
+
+async def registrar(api: httpx.AsyncClient, email: str = "ana@example.com", **datos) -> dict:
+    """Registrar un usuario y devolver las cabeceras con su token"""
+    respuesta = await api.post("/api/auth/register", json={
+        "email": email, "password": "secreto", "nombre": "Ana", "apellido": "Pérez", **datos
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    return {"Authorization": f"Bearer {respuesta.json()['access_token']}"}
+
+
+def jpeg(color=(200, 100, 50), ancho: int = 64, alto: int = 48) -> bytes:
+    salida = io.BytesIO()
+    Image.new("RGB", (ancho, alto), color).save(salida, "JPEG")
+    return salida.getvalue()
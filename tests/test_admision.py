@@ -0,0 +1,85 @@
+"""Control de admisión de subidas: cola acotada, límite por familia y 429 con Retry-After."""
+import asyncio
+
+import pytest
+
+from .conftest import cliente, jpeg, registrar
+from .test_subidas import abrir_sesion
+
+
+def test_cola_por_familia_y_rechazos(server):
+    control = server.ControlAdmision(
+        "prueba", max_global=2, max_familia=1, max_en_espera=2, max_en_espera_familia=1, espera_max=0.05
+    )
+
+    async def ocupar(familia_id, liberar, admitida):
+        async with control.admitir(familia_id):
+            admitida.set()
+            await liberar.wait()
+
+    async def probar():
+        liberar_a, admitida_a = asyncio.Event(), asyncio.Event()
+        ocupada = asyncio.create_task(ocupar("a", liberar_a, admitida_a))
+        await admitida_a.wait()
+
+        # La misma familia espera su turno; otra familia entra sin esperar
+        segunda = asyncio.create_task(ocupar("a", asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0)
+        async with control.admitir("b"):
+            pass
+        # Cola de la familia llena: rechazo inmediato
+        with pytest.raises(server.AdmisionRechazada, match="cola_llena"):
+            async with control.admitir("a"):
+                pass
+        # La que esperaba no consigue turno a tiempo
+        with pytest.raises(server.AdmisionRechazada, match="espera_agotada"):
+            await segunda
+
+        liberar_a.set()
+        await ocupada
+        async with control.admitir("a"):
+            pass
+        assert control._familias == {}
+
+    asyncio.run(probar())
+
+
+def test_subida_sin_turno_responde_429(server, monkeypatch):
+    monkeypatch.setattr(server, "admision_subidas", server.ControlAdmision(
+        "subidas", max_global=1, max_familia=1, max_en_espera=0, max_en_espera_familia=0, espera_max=1
+    ))
+    contenido = jpeg()
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            primera, segunda = [await abrir_sesion(api, cabeceras, contenido) for _ in range(2)]
+            enviando = asyncio.Event()
+
+            async def parte_lenta():
+                yield contenido[:10]
+                enviando.set()
+                await asyncio.sleep(0.05)
+                yield contenido[10:]
+
+            lenta = asyncio.create_task(api.put(
+                f"/api/fotos/upload/sesiones/{primera}", params={"offset": 0}, content=parte_lenta(), headers=cabeceras
+            ))
+            await enviando.wait()
+            respuesta = await api.put(
+                f"/api/fotos/upload/sesiones/{segunda}", params={"offset": 0}, content=contenido, headers=cabeceras
+            )
+            assert respuesta.status_code == 429
+            assert respuesta.headers["retry-after"] == str(server.SUBIDAS_REINTENTO_SEGUNDOS)
+            # Las rutas que no son subidas no pasan por la admisión
+            assert (await api.get(f"/api/fotos/upload/sesiones/{segunda}", headers=cabeceras)).status_code == 200
+
+            assert (await lenta).status_code == 200
+            respuesta = await api.put(
+                f"/api/fotos/upload/sesiones/{segunda}", params={"offset": 0}, content=contenido, headers=cabeceras
+            )
+            assert respuesta.status_code == 200
+            metricas = (await api.get("/api/metrics")).text
+            assert 'memoria_viva_admision_rechazos_total{limite="subidas",motivo="cola_llena"} 1' in metricas
+
+    asyncio.run(probar())
@@ -0,0 +1,53 @@
+"""Archivos de fotos: ETag, peticiones condicionales y rangos de bytes."""
+import asyncio
+
+from .conftest import cliente
+
+
+def test_etag_rangos_y_416(server):
+    contenido = bytes(range(256)) * 4
+    blob = server.BLOBS_DIR / "ab" / "cd" / "abcd.jpg"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(contenido)
+    (server.PARCIALES_DIR / "sesion.part").write_bytes(b"a medias")
+    ruta = "/api/fotos/files/blobs/ab/cd/abcd.jpg"
+
+    async def probar():
+        async with cliente(server) as api:
+            completa = await api.get(ruta)
+            assert completa.status_code == 200
+            assert completa.content == contenido
+            assert completa.headers["etag"] == '"abcd"'
+            assert completa.headers["accept-ranges"] == "bytes"
+            assert "immutable" in completa.headers["cache-control"]
+
+            assert (await api.get(ruta, headers={"If-None-Match": '"abcd"'})).status_code == 304
+            assert (await api.get(ruta, headers={"If-None-Match": '"otro", W/"abcd"'})).status_code == 304
+            assert (await api.get(ruta, headers={"If-None-Match": '"otro"'})).status_code == 200
+            desde = completa.headers["last-modified"]
+            assert (await api.get(ruta, headers={"If-Modified-Since": desde})).status_code == 304
+
+            parcial = await api.get(ruta, headers={"Range": "bytes=10-19"})
+            assert parcial.status_code == 206
+            assert parcial.content == contenido[10:20]
+            assert parcial.headers["content-range"] == f"bytes 10-19/{len(contenido)}"
+            # Sufijo y final abierto
+            assert (await api.get(ruta, headers={"Range": "bytes=-5"})).content == contenido[-5:]
+            assert (await api.get(ruta, headers={"Range": "bytes=1000-"})).content == contenido[1000:]
+
+            fuera = await api.get(ruta, headers={"Range": f"bytes={len(contenido)}-"})
+            assert fuera.status_code == 416
+            assert fuera.headers["content-range"] == f"bytes */{len(contenido)}"
+            assert (await api.get(ruta, headers={"Range": "bytes=20-10"})).status_code == 416
+
+            # If-Range de otra versión o varios rangos: el archivo completo
+            respuesta = await api.get(ruta, headers={"Range": "bytes=0-9", "If-Range": '"otro"'})
+            assert respuesta.status_code == 200 and respuesta.content == contenido
+            respuesta = await api.get(ruta, headers={"Range": "bytes=0-9,20-29"})
+            assert respuesta.status_code == 200 and respuesta.content == contenido
+
+            # Nada fuera de uploads ni subidas sin terminar
+            assert (await api.get("/api/fotos/files/parciales/sesion.part")).status_code == 404
+            assert (await api.get("/api/fotos/files/..%2F..%2Fetc%2Fpasswd")).status_code == 404
+
+    asyncio.run(probar())
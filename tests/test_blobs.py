@@ -0,0 +1,68 @@
+"""Almacén de blobs por contenido: referencias y borrado frente a subidas simultáneas."""
+import asyncio
+
+from .conftest import jpeg
+
+
+async def almacenar(server, contenido: bytes):
+    temporal = server.PARCIALES_DIR / f"{len(contenido)}-{id(contenido)}.part"
+    temporal.write_bytes(contenido)
+    return await server.almacenar_blob(temporal, "ab" * 32, ".jpg")
+
+
+def test_subida_mientras_se_borra_el_mismo_blob(server, monkeypatch):
+    contenido = jpeg()
+    # El delete_one tarda en responder: la subida llega mientras liberar_blob sigue en curso
+    coleccion = type(server.db.blobs)
+    delete_one = coleccion.delete_one
+
+    async def delete_one_lento(self, *args, **kwargs):
+        resultado = await delete_one(self, *args, **kwargs)
+        if self.name == "blobs":
+            await asyncio.sleep(0.05)
+        return resultado
+
+    monkeypatch.setattr(coleccion, "delete_one", delete_one_lento)
+
+    async def probar():
+        await server.crear_indices(["blobs"])
+        destino = await almacenar(server, contenido)
+        (destino.parent / f"{destino.stem}_256.webp").write_bytes(b"miniatura")
+
+        borrado = asyncio.create_task(server.liberar_blob("ab" * 32))
+        await asyncio.sleep(0)
+        assert await almacenar(server, bytes(contenido)) == destino
+        await borrado
+
+        # La foto nueva apunta a un archivo que sigue existiendo
+        assert destino.read_bytes() == contenido
+        blob = await server.db.blobs.find_one({"sha256": "ab" * 32})
+        assert blob["referencias"] == 1
+        assert "borrando" not in blob
+
+        await server.liberar_blob("ab" * 32)
+        assert not destino.exists()
+        assert await server.db.blobs.count_documents({}) == 0
+
+    asyncio.run(probar())
+
+
+def test_borrado_que_se_cayo_a_medias(server, monkeypatch):
+    contenido = jpeg()
+
+    async def probar():
+        await server.crear_indices(["blobs"])
+        destino = await almacenar(server, contenido)
+        # liberar_blob marcó el blob y el proceso murió tras borrar el archivo
+        await server.db.blobs.update_one({}, {"$set": {
+            "referencias": 0, "borrando": "caido",
+            "borrando_hasta": server.datetime.now(server.timezone.utc) - server.timedelta(seconds=1)
+        }})
+        destino.unlink()
+
+        assert await almacenar(server, contenido) == destino
+        assert destino.read_bytes() == contenido
+        blob = await server.db.blobs.find_one({})
+        assert blob["referencias"] == 1 and "borrando" not in blob
+
+    asyncio.run(probar())
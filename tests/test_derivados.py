@@ -0,0 +1,25 @@
+"""Derivados de las fotos: se reutilizan solo si están todos y nunca quedan a medias."""
+from .conftest import jpeg
+
+
+def test_completa_los_derivados_que_faltan(server):
+    blob = server.UPLOAD_DIR / "blobs" / "ab" / "cd" / "abcd.jpg"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(jpeg(ancho=1500, alto=1000))
+    extension = ".webp" if server.DERIVADOS_FORMATO == "WEBP" else ".jpg"
+
+    derivados = server.generar_derivados(str(blob))
+    assert sorted(derivados, key=int) == ["256", "1024"]  # 2048 ampliaría la foto
+    assert [ruta.name for ruta in sorted(blob.parent.iterdir())] == [
+        "abcd.jpg", f"abcd_1024{extension}", f"abcd_256{extension}"
+    ]
+
+    # Un proceso que se cayó tras escribir solo la miniatura pequeña no deja el blob incompleto
+    grande = server.UPLOAD_DIR / derivados["1024"]
+    grande.unlink()
+    assert server.generar_derivados(str(blob)) == derivados
+    assert grande.exists()
+
+    (blob.parent / f".abcd_1024{extension}.0f.tmp").write_bytes(b"a medias")
+    server.eliminar_derivados(blob)
+    assert [ruta.name for ruta in blob.parent.iterdir()] == ["abcd.jpg"]
@@ -0,0 +1,82 @@
+"""Fotos casi iguales: el índice de dHash frente a la comparación de todos los pares."""
+import io
+import random
+
+from PIL import Image
+
+
+def grupos_por_fuerza_bruta(ids, hashes, umbral):
+    padres = list(range(len(ids)))
+
+    def raiz(i):
+        while padres[i] != i:
+            i = padres[i]
+        return i
+
+    for a in range(len(ids)):
+        for b in range(a + 1, len(ids)):
+            if bin((hashes[a] ^ hashes[b]) & 0xFFFFFFFFFFFFFFFF).count("1") <= umbral:
+                padres[max(raiz(a), raiz(b))] = min(raiz(a), raiz(b))
+    grupos = {}
+    for i in range(len(ids)):
+        grupos.setdefault(raiz(i), []).append(ids[i])
+    return sorted(sorted(grupo) for grupo in grupos.values() if len(grupo) > 1)
+
+
+def con_signo(valor: int) -> int:
+    # Como se guarda en MongoDB: int64 con signo
+    return valor - (1 << 64) if valor >= 1 << 63 else valor
+
+
+def test_grupos_iguales_a_comparar_todos_los_pares(server):
+    rng = random.Random(11)
+    hashes = []
+    for _ in range(40):
+        base = rng.getrandbits(64)
+        # Variantes a pocos bits de la original (recompresiones, recortes leves)
+        for _ in range(rng.randint(1, 4)):
+            variante = base
+            for bit in rng.sample(range(64), rng.randint(0, 8)):
+                variante ^= 1 << bit
+            hashes.append(con_signo(variante))
+    # Muchas fotos lisas con el mismo hash y alguna casi lisa
+    hashes += [0] * 200 + [1, 3]
+    ids = [f"foto-{n:03d}" for n in range(len(hashes))]
+
+    for umbral in (0, 4, 10):
+        indice = server.IndiceHashes(ids, hashes)
+        assert sorted(sorted(grupo) for grupo in indice.grupos(umbral)) == grupos_por_fuerza_bruta(ids, hashes, umbral)
+
+
+def test_buscar_y_agregar(server):
+    indice = server.IndiceHashes(["a", "b", "c"], [0b1111, 0b0111, con_signo(0xFFFF000000000000)])
+    assert indice.buscar(0b1111, 2) == [("a", 0), ("b", 1)]
+    assert indice.grupos(1) == [["a", "b"]]
+
+    # Una foto nueva invalida los grupos calculados
+    for n in range(20):
+        indice.agregar(f"n{n}", con_signo(0xFFFF000000000001))
+    assert indice.grupos(1)[0] == ["c"] + [f"n{n}" for n in range(20)]
+    assert indice.total == 23 and len(indice.buscar(0, 64)) == 23
+
+
+def test_dhash_resiste_cambios_de_tamano(server, tmp_path):
+    rng = random.Random(5)
+    original = Image.new("RGB", (320, 240))
+    original.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(320 * 240)])
+    original = original.resize((32, 24)).resize((320, 240), Image.BILINEAR)  # manchas, no ruido
+    otra = Image.new("RGB", (320, 240), (0, 0, 0))
+    otra.paste((255, 255, 255), (0, 0, 160, 240))
+
+    rutas = {}
+    for nombre, imagen in (("original", original), ("reducida", original.resize((160, 120))), ("otra", otra)):
+        salida = io.BytesIO()
+        imagen.save(salida, "JPEG", quality=70)
+        rutas[nombre] = tmp_path / f"{nombre}.jpg"
+        rutas[nombre].write_bytes(salida.getvalue())
+
+    hashes = {nombre: server.calcular_dhash(str(ruta)) for nombre, ruta in rutas.items()}
+    distancia = lambda a, b: bin((hashes[a] ^ hashes[b]) & 0xFFFFFFFFFFFFFFFF).count("1")
+    assert all(-(1 << 63) <= valor < 1 << 63 for valor in hashes.values())
+    assert distancia("original", "reducida") <= server.DUPLICADOS_UMBRAL
+    assert distancia("original", "otra") > server.DUPLICADOS_UMBRAL
@@ -0,0 +1,61 @@
+"""Importación masiva (python server.py importar): álbumes únicos aunque Mongo tarde en responder."""
+import asyncio
+from pathlib import Path
+
+from .conftest import jpeg
+
+
+def crear_archivo(base: Path) -> Path:
+    """Varias fotos por carpeta: con varios trabajadores, más de uno empieza por la misma carpeta"""
+    for carpeta, total in (("Boda", 4), ("Viajes/1985", 6)):
+        (base / carpeta).mkdir(parents=True)
+        for n in range(total):
+            (base / carpeta / f"foto{n}.jpg").write_bytes(jpeg((n * 40, len(carpeta) * 10, 90)))
+    (base / "suelta.jpg").write_bytes(jpeg((10, 200, 10)))
+    (base / "notas.txt").write_text("no es una foto")
+    return base
+
+
+async def crear_usuario(server):
+    usuario = server.User(email="ana@example.com", nombre="Ana", apellido="Pérez", familia_id="familia-1")
+    await server.db.usuarios.insert_one(usuario.dict())
+    return usuario
+
+
+async def titulos_albumes(server) -> list:
+    return sorted([album["titulo"] async for album in server.db.albumes.find({}, {"_id": 0, "titulo": 1})])
+
+
+def test_importar_no_duplica_albumes_con_mongo_lento(server, tmp_path, monkeypatch):
+    origen = crear_archivo(tmp_path / "archivo")
+    # Con un find_one que tarda en responder como un Mongo real, los trabajadores
+    # que empiezan por la misma carpeta se solapan al buscar su álbum
+    coleccion = type(server.db.albumes)
+    find_one = coleccion.find_one
+
+    async def find_one_lento(self, *args, **kwargs):
+        documento = await find_one(self, *args, **kwargs)
+        if self.name == "albumes":
+            await asyncio.sleep(0.01)  # la respuesta llega después de leer la colección
+        return documento
+
+    monkeypatch.setattr(coleccion, "find_one", find_one_lento)
+    monkeypatch.setattr(server, "IMPORTACION_CONCURRENCIA", 4)
+
+    async def probar():
+        await server.crear_indices()
+        await crear_usuario(server)
+        await server.importar_archivo(origen, "ana@example.com", tmp_path / "checkpoint.jsonl")
+        assert await titulos_albumes(server) == ["Boda", "Viajes / 1985", "archivo"]
+        assert await server.db.fotos.count_documents({}) == 11
+        assert await server.db.fotos.count_documents({"estado_procesamiento": "lista"}) == 11
+
+        # Reanudar sin checkpoint: los álbumes se reutilizan y las fotos no se repiten
+        (tmp_path / "checkpoint.jsonl").unlink()
+        await server.importar_archivo(origen, "ana@example.com", tmp_path / "checkpoint.jsonl")
+        assert await titulos_albumes(server) == ["Boda", "Viajes / 1985", "archivo"]
+        assert await server.db.fotos.count_documents({}) == 11
+        referencias = [blob["referencias"] async for blob in server.db.blobs.find({})]
+        assert referencias == [1] * 11
+
+    asyncio.run(probar())
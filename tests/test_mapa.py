@@ -0,0 +1,69 @@
+"""Clusters y puntos del mapa: las celdas y el bbox son el mismo rectángulo plano."""
+import asyncio
+import random
+
+from .conftest import cliente, registrar
+
+
+async def sembrar_fotos(server, familia_id: str, ubicaciones) -> None:
+    await server.db.fotos.insert_many([
+        {
+            "id": f"foto-{n}", "familia_id": familia_id, "album_id": "album-1",
+            "archivo_url": f"/f/{n}.jpg", "miniatura_url": f"/f/{n}_256.webp",
+            "ubicacion": {"lat": lat, "lng": lng}, "fecha_captura": None, "fecha_subida": None,
+        }
+        for n, (lat, lng) in enumerate(ubicaciones)
+    ])
+
+
+async def familia_de(api, cabeceras) -> str:
+    return (await api.get("/api/auth/me", headers=cabeceras)).json()["familia_id"]
+
+
+def test_cada_cluster_cuenta_los_puntos_de_su_celda(server):
+    rng = random.Random(7)
+    ubicaciones = [(rng.uniform(-85, 85), rng.uniform(-180, 180)) for _ in range(300)]
+    # Puntos justo en los bordes de las celdas, que no deben contar en dos a la vez
+    ubicaciones += [(0.0, 0.0), (11.25, 22.5), (-45.0, -90.0), (90.0, 180.0)]
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            await sembrar_fotos(server, await familia_de(api, cabeceras), ubicaciones)
+            for zoom in (0, 1, 3):
+                respuesta = await api.get(
+                    "/api/mapa/clusters", params={"bbox": "-180,-90,180,90", "zoom": zoom}, headers=cabeceras
+                )
+                clusters = respuesta.json()["clusters"]
+                assert sum(cluster["total"] for cluster in clusters) == len(ubicaciones)
+                for cluster in clusters:
+                    puntos = await api.get(
+                        "/api/mapa/puntos",
+                        params={"bbox": ",".join(map(str, cluster["bbox"])), "limite": 1000},
+                        headers=cabeceras
+                    )
+                    assert len(puntos.json()) == cluster["total"], (zoom, cluster)
+
+    asyncio.run(probar())
+
+
+def test_bbox_ancho_y_que_cruza_el_antimeridiano(server):
+    ubicaciones = [(0.0, 179.5), (0.0, -179.5), (0.0, 0.0), (0.0, 150.0), (0.0, -150.0)]
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            await sembrar_fotos(server, await familia_de(api, cabeceras), ubicaciones)
+
+            async def puntos(bbox):
+                respuesta = await api.get("/api/mapa/puntos", params={"bbox": bbox}, headers=cabeceras)
+                assert respuesta.status_code == 200, respuesta.text
+                return sorted(foto["ubicacion"]["lng"] for foto in respuesta.json())
+
+            # Más de 180° de ancho: sigue filtrando por longitud
+            assert await puntos("-100,-10,100,10") == [0.0]
+            # minLng > maxLng: de 170 a 180 y de -180 a -170
+            assert await puntos("170,-10,-170,10") == [-179.5, 179.5]
+            assert await puntos("140,-10,-140,10") == [-179.5, -150.0, 150.0, 179.5]
+
+    asyncio.run(probar())
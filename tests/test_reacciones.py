@@ -0,0 +1,63 @@
+"""Contadores de reacciones y comentarios de cada foto bajo peticiones simultáneas."""
+import asyncio
+import random
+
+from .conftest import cliente, registrar
+
+
+def test_contadores_con_reacciones_simultaneas(server, monkeypatch):
+    # find_one_and_update tarda en responder: las peticiones de un mismo usuario se solapan
+    coleccion = type(server.db.reacciones)
+    find_one_and_update = coleccion.find_one_and_update
+
+    async def find_one_and_update_lento(self, *args, **kwargs):
+        documento = await find_one_and_update(self, *args, **kwargs)
+        if self.name == "reacciones":
+            await asyncio.sleep(random.uniform(0, 0.01))
+        return documento
+
+    monkeypatch.setattr(coleccion, "find_one_and_update", find_one_and_update_lento)
+    rng = random.Random(3)
+
+    async def probar():
+        await server.crear_indices(["reacciones"])
+        async with cliente(server) as api:
+            ana = await registrar(api)
+            codigo = (await api.get("/api/familia/codigo-invitacion", headers=ana)).json()["codigo_invitacion"]
+            luis = await registrar(api, email="luis@example.com", codigo_familia=codigo)
+            familia_id = (await api.get("/api/auth/me", headers=ana)).json()["familia_id"]
+            await server.db.albumes.insert_one({"id": "album-1", "familia_id": familia_id, "titulo": "Boda"})
+            await server.db.fotos.insert_one({
+                "id": "foto-1", "familia_id": familia_id, "album_id": "album-1", "subida_por": "ana",
+                "nombre_archivo": "foto.jpg", "archivo_url": "/f/1.jpg", "total_comentarios": 0, "reacciones": {}
+            })
+            ruta = "/api/fotos/foto-1"
+
+            # Dobles toques y cambios de tipo de los dos usuarios a la vez
+            peticiones = [
+                api.post(f"{ruta}/reacciones", json={"tipo": rng.choice(["like", "love", "wow"])}, headers=usuario)
+                for usuario in (ana, luis) for _ in range(15)
+            ]
+            peticiones += [
+                api.post(f"{ruta}/comentarios", json={"contenido": f"comentario {n}"}, headers=ana) for n in range(5)
+            ]
+            respuestas = await asyncio.gather(*peticiones)
+            assert all(respuesta.status_code == 200 for respuesta in respuestas)
+
+            reacciones = [r async for r in server.db.reacciones.find({"foto_id": "foto-1"})]
+            assert len(reacciones) == 2  # una por usuario
+            esperados = {}
+            for reaccion in reacciones:
+                esperados[reaccion["tipo"]] = esperados.get(reaccion["tipo"], 0) + 1
+
+            foto = (await api.get(ruta, headers=luis)).json()
+            assert {tipo: total for tipo, total in foto["reacciones"].items() if total} == esperados
+            assert foto["total_comentarios"] == 5
+
+            # La migración calcula lo mismo desde cero
+            await server.db.fotos.update_one({"id": "foto-1"}, {"$set": {"total_comentarios": None}})
+            await server.migrar_contadores_fotos()
+            recalculada = await server.db.fotos.find_one({"id": "foto-1"})
+            assert recalculada["reacciones"] == esperados and recalculada["total_comentarios"] == 5
+
+    asyncio.run(probar())
@@ -0,0 +1,104 @@
+"""Subidas por partes: reanudar, offsets en conflicto y finalizar repetido."""
+import asyncio
+
+from .conftest import cliente, jpeg, registrar
+
+
+async def abrir_sesion(api, cabeceras, contenido: bytes) -> str:
+    album = (await api.post("/api/albumes", json={"titulo": "Boda"}, headers=cabeceras)).json()
+    respuesta = await api.post("/api/fotos/upload/sesiones", json={
+        "album_id": album["id"], "nombre_archivo": "foto.jpg",
+        "content_type": "image/jpeg", "tamano_total": len(contenido)
+    }, headers=cabeceras)
+    assert respuesta.status_code == 200, respuesta.text
+    return respuesta.json()["id"]
+
+
+def test_reanudar_y_offset_incorrecto(server):
+    contenido = jpeg()
+    mitad = len(contenido) // 2
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            sesion_id = await abrir_sesion(api, cabeceras, contenido)
+            ruta = f"/api/fotos/upload/sesiones/{sesion_id}"
+
+            respuesta = await api.put(ruta, params={"offset": 0}, content=contenido[:mitad], headers=cabeceras)
+            assert respuesta.json()["recibido"] == mitad
+            # Un offset que no es el confirmado se rechaza con el offset bueno
+            respuesta = await api.put(ruta, params={"offset": 0}, content=contenido[:mitad], headers=cabeceras)
+            assert respuesta.status_code == 409
+            assert respuesta.json()["recibido"] == mitad
+            # El cliente reanuda desde lo que dice el servidor
+            recibido = (await api.get(ruta, headers=cabeceras)).json()["recibido"]
+            respuesta = await api.put(ruta, params={"offset": recibido}, content=contenido[recibido:], headers=cabeceras)
+            assert respuesta.json() == {"id": sesion_id, "recibido": len(contenido), "tamano_total": len(contenido)}
+
+            respuesta = await api.post(f"{ruta}/finalizar", headers=cabeceras)
+            assert respuesta.status_code == 200, respuesta.text
+            blob = server.ruta_blob(respuesta.json()["sha256"], ".jpg")
+            assert blob.read_bytes() == contenido
+
+    asyncio.run(probar())
+
+
+def test_dos_partes_al_mismo_offset(server):
+    contenido = jpeg()
+    mitad = len(contenido) // 2
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            sesion_id = await abrir_sesion(api, cabeceras, contenido)
+            ruta = f"/api/fotos/upload/sesiones/{sesion_id}"
+            escribiendo = asyncio.Event()
+
+            async def parte_lenta():
+                yield contenido[:10]
+                escribiendo.set()
+                await asyncio.sleep(0.05)
+                yield contenido[10:mitad]
+
+            lenta = asyncio.create_task(
+                api.put(ruta, params={"offset": 0}, content=parte_lenta(), headers=cabeceras)
+            )
+            await escribiendo.wait()
+            # Un reintento mientras la primera parte sigue llegando no trunca el archivo
+            respuesta = await api.put(ruta, params={"offset": 0}, content=contenido[:mitad], headers=cabeceras)
+            assert respuesta.status_code == 409
+            assert respuesta.json()["recibido"] == 0
+
+            assert (await lenta).json()["recibido"] == mitad
+            respuesta = await api.put(ruta, params={"offset": mitad}, content=contenido[mitad:], headers=cabeceras)
+            assert respuesta.json()["recibido"] == len(contenido)
+            assert server.ruta_parcial(sesion_id).read_bytes() == contenido
+
+    asyncio.run(probar())
+
+
+def test_finalizar_repetido_devuelve_la_misma_foto(server):
+    contenido = jpeg()
+
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            sesion_id = await abrir_sesion(api, cabeceras, contenido)
+            ruta = f"/api/fotos/upload/sesiones/{sesion_id}"
+            await api.put(ruta, params={"offset": 0}, content=contenido, headers=cabeceras)
+
+            primera = await api.post(f"{ruta}/finalizar", headers=cabeceras)
+            assert primera.status_code == 200, primera.text
+            # La respuesta se perdió: el reintento encuentra la foto aunque la sesión ya no exista
+            segunda = await api.post(f"{ruta}/finalizar", headers=cabeceras)
+            assert segunda.status_code == 200, segunda.text
+            assert segunda.json()["id"] == primera.json()["id"] == sesion_id
+            assert segunda.json()["archivo_url"] == primera.json()["archivo_url"]
+            assert await server.db.fotos.count_documents({}) == 1
+            assert (await server.db.blobs.find_one({}))["referencias"] == 1
+
+            # Otro usuario no la ve
+            ajeno = await registrar(api, email="luis@example.com")
+            assert (await api.post(f"{ruta}/finalizar", headers=ajeno)).status_code == 404
+
+    asyncio.run(probar())
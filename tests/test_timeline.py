@@ -0,0 +1,103 @@
+"""Timeline: paginación por cursor, filtro por año y portadas del resumen mensual."""
+import asyncio
+from datetime import datetime, timezone
+
+from .conftest import cliente, registrar
+
+SUBIDA = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+def foto(n: int, fecha_captura, fecha_subida=SUBIDA, familia_id="familia-1") -> dict:
+    return {
+        "id": f"foto-{n:03d}", "familia_id": familia_id, "album_id": "album-1",
+        "archivo_url": f"/f/{n}.jpg", "miniatura_url": f"/f/{n}_256.webp",
+        "fecha_captura": fecha_captura, "fecha_subida": fecha_subida,
+    }
+
+
+async def recorrer(api, cabeceras, cursor=None, **params) -> list:
+    ids = []
+    while True:
+        respuesta = await api.get("/api/timeline", params={**params, "cursor": cursor} if cursor else params, headers=cabeceras)
+        assert respuesta.status_code == 200, respuesta.text
+        pagina = respuesta.json()
+        ids += [f["id"] for f in pagina["fotos"]]
+        cursor = pagina["siguiente_cursor"]
+        if not cursor:
+            return ids
+
+
+# Fechas repetidas y fotos sin fecha de captura: el cursor desempata por subida e id
+FOTOS = [foto(n, datetime(2019 + n % 3, 1 + n % 12, 1)) for n in range(30)]
+FOTOS += [foto(30 + n, None, datetime(2020, 3, 1 + n % 2)) for n in range(5)]
+
+
+def orden_timeline(f) -> tuple:
+    return (f["fecha_captura"] is not None, f["fecha_captura"] or datetime.min, f["fecha_subida"], f["id"])
+
+
+async def sembrar(server, api, cabeceras) -> str:
+    familia_id = (await api.get("/api/auth/me", headers=cabeceras)).json()["familia_id"]
+    await server.db.fotos.insert_many([{**f, "familia_id": familia_id} for f in FOTOS])
+    return familia_id
+
+
+def test_cursor_sin_saltos_ni_repetidas(server):
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            familia_id = await sembrar(server, api, cabeceras)
+            todas = [f["id"] for f in sorted(FOTOS, key=orden_timeline, reverse=True)]
+            for limite in (1, 4, 7, 50):
+                assert await recorrer(api, cabeceras, limite=limite) == todas
+
+            # Una foto subida mientras se pagina no desplaza las páginas siguientes
+            primera = (await api.get("/api/timeline", params={"limite": 10}, headers=cabeceras)).json()
+            await server.db.fotos.insert_one(foto(99, datetime(2030, 1, 1), familia_id=familia_id))
+            resto = await recorrer(api, cabeceras, cursor=primera["siguiente_cursor"], limite=10)
+            assert [f["id"] for f in primera["fotos"]] + resto == todas
+
+            respuesta = await api.get("/api/timeline", params={"cursor": "basura"}, headers=cabeceras)
+            assert respuesta.status_code == 400
+
+    asyncio.run(probar())
+
+
+def test_filtro_por_anio_con_cursor(server):
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            await sembrar(server, api, cabeceras)
+            # El cursor de un año solo pasa por las fotos de ese año
+            del2020 = [f["id"] for f in sorted(FOTOS, key=orden_timeline, reverse=True)
+                       if (f["fecha_captura"] or f["fecha_subida"]).year == 2020]
+            assert len(del2020) == 15
+            assert await recorrer(api, cabeceras, anio=2020, limite=4) == del2020
+            assert await recorrer(api, cabeceras, anio=1990) == []
+
+    asyncio.run(probar())
+
+
+def test_la_portada_es_la_misma_al_subir_y_al_reconstruir(server):
+    # Llegan en desorden: la primera subida del mes no es la más antigua
+    fotos = [
+        foto(1, datetime(2020, 5, 20)),
+        foto(2, None, datetime(2020, 5, 3, tzinfo=timezone.utc)),
+        foto(3, datetime(2020, 5, 3)),
+        foto(4, datetime(2020, 5, 9)),
+    ]
+
+    async def probar():
+        await server.crear_indices(["resumen_timeline"])
+        await server.db.fotos.insert_many([dict(f) for f in fotos])
+        await server.actualizar_resumen_timeline("familia-1", fotos[:1])
+        await server.actualizar_resumen_timeline("familia-1", fotos[1:])
+        incremental = await server.db.resumen_timeline.find_one({}, {"_id": 0})
+        assert incremental["total"] == 4
+        # Misma fecha: desempata el id
+        assert incremental["portada"]["id"] == "foto-002"
+
+        await server.reconstruir_resumen_timeline("familia-1")
+        assert await server.db.resumen_timeline.find_one({}, {"_id": 0}) == incremental
+
+    asyncio.run(probar())
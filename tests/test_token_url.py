@@ -0,0 +1,61 @@
+"""Eventos y descargas por URL (?token=): solo valen tokens de un minuto emitidos para ese recurso."""
+import asyncio
+
+from .conftest import cliente, registrar
+
+
+def test_export_solo_acepta_el_token_de_su_recurso(server):
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            sesion = cabeceras["Authorization"].split()[1]
+            album = (await api.post("/api/albumes", json={"titulo": "Boda"}, headers=cabeceras)).json()
+            otro = (await api.post("/api/albumes", json={"titulo": "Viajes"}, headers=cabeceras)).json()
+
+            async def token_url(alcance):
+                respuesta = await api.post("/api/auth/token-url", json={"alcance": alcance}, headers=cabeceras)
+                assert respuesta.status_code == 200, respuesta.text
+                return respuesta.json()["token"]
+
+            ruta = f"/api/albumes/{album['id']}/export"
+            # El token de la sesión no vale en la URL
+            assert (await api.get(ruta, params={"token": sesion})).status_code == 401
+            # Ni el emitido para otro álbum o para otro uso
+            assert (await api.get(ruta, params={"token": await token_url(f"export_album:{otro['id']}")})).status_code == 401
+            assert (await api.get(ruta, params={"token": await token_url("export_familia")})).status_code == 401
+
+            token = await token_url(f"export_album:{album['id']}")
+            respuesta = await api.get(ruta, params={"token": token})
+            assert respuesta.status_code == 200
+            assert respuesta.headers["content-type"] == "application/zip"
+            # Y un token de URL no sirve como sesión
+            assert (await api.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})).status_code == 401
+            # Con la cabecera de la sesión la descarga sigue funcionando
+            assert (await api.get(ruta, headers=cabeceras)).status_code == 200
+
+            respuesta = await api.post("/api/auth/token-url", json={"alcance": "cualquier_cosa"}, headers=cabeceras)
+            assert respuesta.status_code == 422
+
+    asyncio.run(probar())
+
+
+def test_eventos_solo_aceptan_el_token_de_su_recurso(server):
+    async def probar():
+        async with cliente(server) as api:
+            cabeceras = await registrar(api)
+            sesion = cabeceras["Authorization"].split()[1]
+
+            respuesta = await api.post("/api/auth/token-url", json={"alcance": "eventos"}, headers=cabeceras)
+            assert respuesta.status_code == 200, respuesta.text
+            token = respuesta.json()["token"]
+
+            # El token de la sesión no vale en la URL
+            assert (await api.get("/api/eventos", params={"token": sesion})).status_code == 401
+            assert (await api.get("/api/eventos")).status_code == 401
+            # Y un token de URL no sirve como sesión
+            assert (await api.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})).status_code == 401
+
+            respuesta = await api.post("/api/auth/token-url", json={"alcance": "cualquier_cosa"}, headers=cabeceras)
+            assert respuesta.status_code == 422
+
+    asyncio.run(probar())
@@ -0,0 +1,107 @@
+"""Cola de trabajos persistente: claves únicas, leases, reintentos y apagado."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+
+def hace(segundos: float) -> datetime:
+    return datetime.now(timezone.utc) - timedelta(seconds=segundos)
+
+
+async def trabajo(server, clave: str = "prueba:1"):
+    return await server.db.trabajos.find_one({"clave": clave}, {"_id": 0})
+
+
+def test_reintento_con_espera_y_lease_vencido(server):
+    fallos = {"restantes": 2}
+
+    async def manejador(datos):
+        if fallos["restantes"]:
+            fallos["restantes"] -= 1
+            raise OSError("disco lleno")
+        return {"valor": datos["valor"] * 2}
+
+    cola = server.ColaTrabajos({"prueba": manejador})
+
+    async def probar():
+        await server.crear_indices(["trabajos"])
+        nuevo = server.nuevo_trabajo("prueba", {"valor": 21}, "prueba:1", "familia-1")
+        await server.encolar_trabajos([nuevo])
+        await server.encolar_trabajos([server.nuevo_trabajo("prueba", {"valor": 0}, "prueba:1", "familia-1")])
+        assert await server.db.trabajos.count_documents({}) == 1  # la misma clave no se duplica
+
+        # Falla: vuelve a la cola con espera y no se puede reclamar hasta entonces
+        await cola._ejecutar(await cola._reclamar("a"), "a")
+        pendiente = await trabajo(server)
+        assert pendiente["estado"] == "pendiente" and pendiente["error"] == "disco lleno"
+        assert pendiente["disponible_desde"] > hace(-1).replace(tzinfo=None)  # MongoDB devuelve UTC sin zona
+        assert await cola._reclamar("a") is None
+
+        await server.db.trabajos.update_one({}, {"$set": {"disponible_desde": hace(1)}})
+        await cola._ejecutar(await cola._reclamar("a"), "a")
+        await server.db.trabajos.update_one({}, {"$set": {"disponible_desde": hace(1)}})
+
+        # El trabajador «a» lo reclama y se cae: pasado el lease lo retoma «b»
+        abandonado = await cola._reclamar("a")
+        assert abandonado["intentos"] == 3
+        assert await cola._reclamar("b") is None
+        await server.db.trabajos.update_one({}, {"$set": {"lease_hasta": hace(1)}})
+        retomado = await cola._reclamar("b")
+        assert retomado["trabajador"] == "b" and retomado["intentos"] == 4
+        await cola._ejecutar(retomado, "b")
+
+        # «a» vuelve en sí y termina tarde: su resultado no pisa el de «b»
+        await cola._ejecutar(abandonado, "a")
+        terminado = await trabajo(server)
+        assert terminado["estado"] == "completado" and terminado["trabajador"] == "b"
+        assert terminado["resultado"] == {"valor": 42} and terminado["error"] is None
+
+    asyncio.run(probar())
+
+
+def test_lease_vencido_en_todos_los_intentos(server):
+    async def manejador(datos):
+        raise AssertionError("no debería ejecutarse")
+
+    cola = server.ColaTrabajos({"prueba": manejador})
+
+    async def probar():
+        await server.crear_indices(["trabajos"])
+        nuevo = server.nuevo_trabajo("prueba", {}, "prueba:1")
+        await server.encolar_trabajos([{**nuevo, "max_intentos": 2, "intentos": 2, "estado": "en_curso", "lease_hasta": hace(1)}])
+        await cola._ejecutar(await cola._reclamar("a"), "a")
+        fallido = await trabajo(server)
+        assert fallido["estado"] == "fallido" and fallido["error"] == "Lease vencido en todos los intentos"
+
+    asyncio.run(probar())
+
+
+def test_trabajadores_y_apagado(server, monkeypatch):
+    monkeypatch.setattr(server, "TRABAJOS_SONDEO_SEGUNDOS", 0.01)
+    liberar = asyncio.Event()
+
+    async def rapido(datos):
+        return {"n": datos["n"]}
+
+    async def lento(datos):
+        await liberar.wait()
+
+    cola = server.ColaTrabajos({"rapido": rapido, "lento": lento})
+
+    async def probar():
+        await server.crear_indices(["trabajos"])
+        cola.iniciar(3)
+        await server.encolar_trabajos([server.nuevo_trabajo("rapido", {"n": n}, f"rapido:{n}", "familia-1") for n in range(10)])
+        await server.encolar_trabajos([server.nuevo_trabajo("lento", {}, "lento:1", "familia-2")])
+        for _ in range(200):
+            if await server.db.trabajos.count_documents({"tipo": "rapido", "estado": "completado"}) == 10:
+                break
+            await asyncio.sleep(0.01)
+        assert await server.db.trabajos.count_documents({"tipo": "rapido", "estado": "completado"}) == 10
+        assert (await trabajo(server, "lento:1"))["estado"] == "en_curso"
+
+        # Apagado ordenado: el trabajo en curso vuelve a la cola sin gastar el intento
+        await cola.detener()
+        devuelto = await trabajo(server, "lento:1")
+        assert devuelto["estado"] == "pendiente" and devuelto["intentos"] == 0
+
+    asyncio.run(probar())